@@ -0,0 +1,145 @@
+"""In-process read-through cache for API responses.
+
+Responses are cached as encoded bytes, keyed by endpoint and the parsed query
+parameters. Entries are bounded by count and total size (least recently used
+go first) and expire after API_CACHE_TTL seconds. Every API_CACHE_GENERATION_POLL
+seconds the cache reads the catalog generation counter (see db.generation);
+when the crawler or change detector has bumped it, everything is dropped.
+"""
+import functools
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+from dotenv import load_dotenv
+from fastapi.responses import Response
+from db.client import db
+from db.generation import read_generation
+from utils.logger import logger
+from utils.metrics import counter
+
+load_dotenv()
+
+# endpoints served through the cache: any of books, book, facets, changes, history
+API_CACHE_ENDPOINTS = {e.strip() for e in os.getenv("API_CACHE_ENDPOINTS", "books,book,facets,changes,history").split(",")
+                       if e.strip()}
+API_CACHE_MAX_ENTRIES = int(os.getenv("API_CACHE_MAX_ENTRIES", "1024"))
+API_CACHE_MAX_BYTES = int(os.getenv("API_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+API_CACHE_TTL = float(os.getenv("API_CACHE_TTL", "300"))  # seconds
+API_CACHE_GENERATION_POLL = float(os.getenv("API_CACHE_GENERATION_POLL", "1.0"))  # seconds
+
+CACHE_LOOKUPS = counter("api_cache_lookups_total", "Response cache lookups by endpoint and result (hit, miss, bypass)",
+                        ("endpoint", "result"))
+
+class ResponseCache:
+    def __init__(self, generation: Callable[[], Awaitable[int]], max_entries: Optional[int] = None,
+                 max_bytes: Optional[int] = None, ttl: Optional[float] = None, poll: Optional[float] = None):
+        self.generation = generation
+        self.max_entries = max_entries or API_CACHE_MAX_ENTRIES
+        self.max_bytes = max_bytes or API_CACHE_MAX_BYTES
+        self.ttl = ttl if ttl is not None else API_CACHE_TTL
+        self.poll = poll if poll is not None else API_CACHE_GENERATION_POLL
+        self.hits = self.misses = self.evictions = self.expirations = self.invalidations = 0
+        self.bytes = 0
+        self._entries: OrderedDict = OrderedDict()  # key -> (expires_at, body, status_code, media_type)
+        self._generation = None
+        self._checked_at = float("-inf")
+        self._readable = False
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    async def refresh(self) -> bool:
+        """Re-read the generation when the poll interval has passed; False if it can't be read"""
+        now = time.monotonic()
+        if now - self._checked_at < self.poll:
+            return self._readable
+        self._checked_at = now  # concurrent requests keep using the current view meanwhile
+        try:
+            generation = await self.generation()
+        except Exception as e:
+            logger.warning("Reading the catalog generation failed, bypassing the response cache: %s", e)
+            self._readable = False
+            self._generation = None
+            self.clear()
+            return False
+        self._readable = True
+        if generation != self._generation:
+            if self._entries:
+                self.invalidations += 1
+            self.clear()
+            self._generation = generation
+        return True
+
+    def get(self, key) -> Optional[Response]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, body, status_code, media_type = entry
+        if expires_at < time.monotonic():
+            self._drop(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return Response(content=body, status_code=status_code, media_type=media_type, headers={"X-Cache": "HIT"})
+
+    def put(self, key, response: Response, generation=None):
+        body = response.body
+        if response.status_code != 200 or len(body) > self.max_bytes or generation != self._generation:
+            return  # generation moved on while the response was being built: it may be stale
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = (time.monotonic() + self.ttl, body, response.status_code, response.media_type)
+        self.bytes += len(body)
+        while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+        response.headers["X-Cache"] = "MISS"
+
+    def _drop(self, key):
+        _, body, _, _ = self._entries.pop(key)
+        self.bytes -= len(body)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries), "bytes": self.bytes, "generation": self._generation,
+            "hits": self.hits, "misses": self.misses, "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions, "expirations": self.expirations, "invalidations": self.invalidations,
+        }
+
+_cache = ResponseCache(generation=lambda: read_generation(db.meta))
+
+def get_response_cache() -> ResponseCache:
+    return _cache
+
+def cache_key(endpoint: str, params: dict) -> tuple:
+    """Parameters as parsed by FastAPI (so 10 and 10.0 agree), minus the unset ones"""
+    return (endpoint,) + tuple(sorted((k, v) for k, v in params.items() if v is not None))
+
+def cached(endpoint: str):
+    """Serve an endpoint returning a Response through the cache when `endpoint` is enabled"""
+    def decorate(fn):
+        @functools.wraps(fn)
+        async def wrapper(**params):
+            cache = get_response_cache()
+            if endpoint not in API_CACHE_ENDPOINTS or not await cache.refresh():
+                CACHE_LOOKUPS.inc(endpoint=endpoint, result="bypass")
+                return await fn(**params)
+            key = cache_key(endpoint, params)
+            response = cache.get(key)
+            CACHE_LOOKUPS.inc(endpoint=endpoint, result="miss" if response is None else "hit")
+            if response is None:
+                generation = cache._generation
+                response = await fn(**params)
+                cache.put(key, response, generation)
+            return response
+        return wrapper
+    return decorate
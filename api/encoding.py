@@ -0,0 +1,50 @@
+import json
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+from bson import ObjectId
+from fastapi.responses import Response
+from crawler.models import Book
+
+try:
+    import orjson
+except ImportError:  # fall back to the stdlib encoder
+    orjson = None
+
+# Fields served by the API; everything else (snapshots, validators, hashes) stays in Mongo
+BOOK_PUBLIC_FIELDS = [
+    field.alias for name, field in Book.__fields__.items() if name not in ("id", "raw_html_snapshot")
+]
+BOOK_PROJECTION = {field: 1 for field in BOOK_PUBLIC_FIELDS}
+
+# Model defaults, so documents missing an optional field serialize exactly like Book would
+_BOOK_DEFAULTS = {"_id": None}
+_BOOK_DEFAULTS.update({field.alias: field.default for name, field in Book.__fields__.items()
+                       if name not in ("id", "raw_html_snapshot") and field.default_factory is None})
+
+def _default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def dump_json(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, default=_default)
+    return json.dumps(content, default=_default, separators=(",", ":")).encode("utf-8")
+
+def public_book(doc: Dict) -> Dict:
+    """Shape a projected book document like the Book model, without validating it.
+
+    Documents come from our own crawler, so per-row model validation (HttpUrl
+    parsing and friends) buys nothing on the read path.
+    """
+    return {**_BOOK_DEFAULTS, **doc}
+
+def json_response(content: Any, status_code: int = 200) -> Response:
+    """Encode straight to JSON bytes, bypassing FastAPI's response_model serialization"""
+    return Response(content=dump_json(content), status_code=status_code, media_type="application/json")
+
+def books_response(page: int, per_page: int, docs: List[Dict], next_cursor: Optional[str] = None) -> Response:
+    return json_response({"page": page, "per_page": per_page, "data": [public_book(d) for d in docs],
+                          "next_cursor": next_cursor})
@@ -1,39 +1,42 @@
 import os
-from fastapi import FastAPI, Depends, HTTPException, Header, Query
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Depends, HTTPException, Header, Query, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from typing import Optional, List, Dict, Any # Added Dict, Any for BookListResponse
 from db.client import db, ensure_indexes
 from dotenv import load_dotenv
 from pydantic import BaseModel, Field
 import asyncio
-from datetime import datetime, timedelta, timezone
+from datetime import date, datetime, timedelta
 from crawler.models import Book # Import the Book model
 from bson import ObjectId
-from scheduler.reporter import generate_daily_change_report
+from scheduler.reporter import generate_daily_change_report, stream_daily_change_report
+from scheduler.rollups import change_report
+from api.encoding import BOOK_PROJECTION, books_response, json_response, public_book
+from db.history import HISTORY_FIELDS, read_history
+from db.facets import DEFAULT_BUCKET_WIDTH, FACET_PRICE_STEP, query_facets
+from api.cache import cached, get_response_cache
+from api.ratelimit import RateLimitHeadersMiddleware, get_rate_limiter
+from api.metrics import RequestMetricsMiddleware
+from utils.metrics import CONTENT_TYPE, get_registry
+from api.queries import build_book_query, decode_cursor, encode_cursor, keyset_filter, sort_spec
 
 load_dotenv()
 
 API_KEY = os.getenv("API_KEY", "testkey123")
-RATE_LIMIT_PER_HOUR = int(os.getenv("RATE_LIMIT_PER_HOUR", "100"))
+REPORT_MAX_DAYS = int(os.getenv("REPORT_MAX_DAYS", "366"))
 
 app = FastAPI(title="Books API")
+app.add_middleware(RateLimitHeadersMiddleware)
+app.add_middleware(RequestMetricsMiddleware)
 
-# Simple in-memory rate limiter: {api_key: [(timestamp1),(timestamp2),...]}
-RATE_STORE = {}
-
-async def require_api_key(x_api_key: str = Header(...)):
+async def require_api_key(request: Request, x_api_key: str = Header(...)):
     if x_api_key != API_KEY:
         raise HTTPException(status_code=401, detail="Invalid API Key")
-    # rate limiting
-    now = datetime.now(timezone.utc)
-    window_start = now - timedelta(hours=1)
-    hits = RATE_STORE.get(x_api_key, [])
-    # remove old hits
-    hits = [t for t in hits if t > window_start]
-    if len(hits) >= RATE_LIMIT_PER_HOUR:
+    # rate limiting; the middleware copies the result into the X-RateLimit-* headers
+    result = await get_rate_limiter().hit(x_api_key)
+    request.scope["rate_limit"] = result
+    if not result.allowed:
         raise HTTPException(status_code=429, detail="Rate limit exceeded")
-    hits.append(now)
-    RATE_STORE[x_api_key] = hits
     return x_api_key
 
 @app.on_event("startup")
@@ -45,12 +48,14 @@ class BookListResponse(BaseModel):
     page: int
     per_page: int
     data: List[Book]
+    next_cursor: Optional[str] = None
 
 @app.get("/books", response_model=BookListResponse, response_model_exclude={
     "data": {
         "__all__": {"raw_html_snapshot"}
     }
-}, dependencies=[Depends(require_api_key)])
+}, dependencies=[Depends(require_api_key)])  # response_model documents the schema; rows are encoded directly
+@cached("books")
 async def list_books(
     category: Optional[str] = None,
     min_price: Optional[float] = None,
@@ -58,56 +63,77 @@ async def list_books(
     rating: Optional[int] = None,
     sort_by: Optional[str] = "rating",
     page: int = 1,
-    per_page: int = 20
+    per_page: int = 20,
+    cursor: Optional[str] = Query(None, description="next_cursor of the previous page; replaces page")
 ):
-    query = {}
-    if category:
-        query["category"] = category
-    if rating:
-        query["rating"] = rating
-    if min_price is not None or max_price is not None:
-        sub = {}
-        if min_price is not None:
-            sub["$gte"] = min_price
-        if max_price is not None:
-            sub["$lte"] = max_price
-        query["price_including_tax"] = sub
-
-    cursor = db.books.find(query)
-    if sort_by == "price":
-        cursor = cursor.sort("price_including_tax", 1)
-    elif sort_by == "rating":
-        cursor = cursor.sort("rating", -1)
-    elif sort_by == "reviews":
-        cursor = cursor.sort("num_reviews", -1)
-
-    skip = (page - 1) * per_page
-    docs = await cursor.skip(skip).limit(per_page).to_list(length=per_page)
-    
-    # Convert ObjectId to str for each document
-    for doc in docs:
-        if "_id" in doc:
-            doc["_id"] = str(doc["_id"])
-
-    return {"page": page, "per_page": per_page, "data": docs}
+    query = build_book_query(category, min_price, max_price, rating)
+    if cursor:
+        # keyset pagination: resume right after the last row of the previous page
+        try:
+            value, last_id = decode_cursor(cursor, sort_by)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        after = keyset_filter(sort_by, value, last_id)
+        query = {"$and": [query, after]} if query else after
+
+    # project only the public fields so snapshots never leave Mongo
+    books_cursor = db.books.find(query, BOOK_PROJECTION).sort(sort_spec(sort_by))
+    if not cursor:
+        books_cursor = books_cursor.skip((page - 1) * per_page)
+    docs = await books_cursor.limit(per_page).to_list(length=per_page)
+    next_cursor = encode_cursor(sort_by, docs[-1]) if len(docs) == per_page else None
+    return books_response(page, per_page, docs, next_cursor)
+
+@app.get("/books/facets", dependencies=[Depends(require_api_key)])
+@cached("facets")
+async def book_facets(
+    category: Optional[str] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    rating: Optional[int] = None,
+    bucket: float = Query(DEFAULT_BUCKET_WIDTH, gt=0, description="Width of the price buckets")
+):
+    # counts per category, rating and price bucket, read from the materialized book_facets cells
+    if bucket % FACET_PRICE_STEP:
+        raise HTTPException(status_code=400, detail=f"bucket must be a multiple of {FACET_PRICE_STEP:g}")
+    query = build_book_query(category, min_price, max_price, rating)
+    return json_response(await query_facets(query, bucket))
 
 @app.get("/books/{book_id}", response_model=Book, response_model_exclude={"raw_html_snapshot"}, dependencies=[Depends(require_api_key)])
+@cached("book")
 async def get_book(book_id: str):
     # book_id is assumed to be the Mongo _id as string OR source_url; we will check both
     from bson import ObjectId
     doc = None
     try:
-        doc = await db.books.find_one({"_id": ObjectId(book_id)})
+        doc = await db.books.find_one({"_id": ObjectId(book_id)}, BOOK_PROJECTION)
     except Exception:
-        doc = await db.books.find_one({"source_url": book_id})
+        doc = await db.books.find_one({"source_url": book_id}, BOOK_PROJECTION)
     if not doc:
         raise HTTPException(status_code=404, detail="Book not found")
     
-    # Convert ObjectId to str for the document
-    if "_id" in doc:
-        doc["_id"] = str(doc["_id"])
-    
-    return doc
+    return json_response(public_book(doc))
+
+@app.get("/books/{book_id}/history", dependencies=[Depends(require_api_key)])
+@cached("history")
+async def get_book_history(
+    book_id: str,
+    since: Optional[datetime] = None,
+    limit: int = Query(1000, ge=1, le=10000)
+):
+    # price and availability over time, oldest first; book_id is resolved like GET /books/{book_id}
+    projection = {"_id": 0, "source_url": 1, "crawl_timestamp": 1, **{field: 1 for field in HISTORY_FIELDS}}
+    try:
+        doc = await db.books.find_one({"_id": ObjectId(book_id)}, projection)
+    except Exception:
+        doc = await db.books.find_one({"source_url": book_id}, projection)
+    if not doc:
+        raise HTTPException(status_code=404, detail="Book not found")
+    points = await read_history(doc["source_url"], since, limit)
+    if not points and since is None:
+        # stored before history was kept: the current values are the only known point
+        points = [{"ts": doc.get("crawl_timestamp"), **{field: doc.get(field) for field in HISTORY_FIELDS}}]
+    return json_response({"source_url": doc["source_url"], "points": points})
 
 # Define a Pydantic model for the change records if they also contain ObjectIds
 # For simplicity, assuming changes collection might also have _id, let's define a basic one.
@@ -115,9 +141,12 @@ class ChangeRecord(BaseModel):
     id: Optional[str] = Field(alias="_id")
     source_url: str
     changed_at: datetime
+    title: Optional[str]
+    category: Optional[str]
     old_fingerprint: Optional[str]
     new_fingerprint: Optional[str]
-    old: Optional[Dict[str, Any]] # Store old and new as generic dicts for now
+    changes: Optional[List[str]]
+    old: Optional[Dict[str, Any]] # old and new values of the changed fields only
     new: Optional[Dict[str, Any]]
 
     class Config:
@@ -126,18 +155,48 @@ class ChangeRecord(BaseModel):
             ObjectId: str
         }
 
+CHANGE_PROJECTION = {field.alias: 1 for field in ChangeRecord.__fields__.values()}
+
 @app.get("/changes", response_model=List[ChangeRecord], dependencies=[Depends(require_api_key)])
+@cached("changes")
 async def get_changes(limit: int = 50):
-    docs = await db.changes.find().sort("changed_at", -1).limit(limit).to_list(length=limit)
-    return docs
+    docs = await db.changes.find({}, CHANGE_PROJECTION).sort("changed_at", -1).limit(limit).to_list(length=limit)
+    return json_response(docs)
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    # Prometheus text format; no API key, so a scraper needs no credentials
+    return PlainTextResponse(get_registry().render(), media_type=CONTENT_TYPE)
+
+@app.get("/cache/stats", dependencies=[Depends(require_api_key)])
+async def cache_stats():
+    return get_response_cache().stats()
 
 @app.get("/report/daily_changes", dependencies=[Depends(require_api_key)])
-async def get_daily_change_report(format: str = Query("json", regex="^(json|csv)$")):
+async def get_daily_change_report(format: str = Query("json", regex="^(json|csv|ndjson)$")):
     if format == "json":
         report = await generate_daily_change_report(format="json")
         return JSONResponse(content=report)
-    elif format == "csv":
-        report = await generate_daily_change_report(format="csv")
-        return JSONResponse(content=report, media_type="text/csv")
+    elif format in ("csv", "ndjson"):
+        # streamed straight from the cursor, a batch at a time
+        media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+        filename = f"changes-{datetime.utcnow():%Y-%m-%d}.{format}"
+        return StreamingResponse(stream_daily_change_report(format), media_type=media_type,
+                                 headers={"Content-Disposition": f'attachment; filename="{filename}"'})
     else:
-        raise HTTPException(status_code=400, detail="Invalid format. Choose 'json' or 'csv'.")
+        raise HTTPException(status_code=400, detail="Invalid format. Choose 'json', 'csv' or 'ndjson'.")
+
+
+@app.get("/report/changes", dependencies=[Depends(require_api_key)])
+async def get_change_report(
+    date_from: Optional[date] = Query(None, alias="from", description="First day (UTC), default: 6 days before `to`"),
+    date_to: Optional[date] = Query(None, alias="to", description="Last day (UTC), default: today"),
+):
+    # closed days come from the per-day rollups; only today is aggregated from raw changes
+    date_to = date_to or datetime.utcnow().date()
+    date_from = date_from or date_to - timedelta(days=6)
+    if date_from > date_to:
+        raise HTTPException(status_code=400, detail="'from' must not be after 'to'")
+    if (date_to - date_from).days >= REPORT_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"Reports cover at most {REPORT_MAX_DAYS} days")
+    return json_response(await change_report(date_from, date_to))
@@ -0,0 +1,32 @@
+"""Per-route request metrics for the API; GET /metrics renders them with everything else in the registry."""
+import time
+from utils.metrics import histogram
+
+REQUEST_SECONDS = histogram("api_request_seconds", "API request latency by route template, method and status",
+                            ("route", "method", "status"))
+
+class RequestMetricsMiddleware:
+    """Time each HTTP request and label it with the matched route's path template, not the raw path"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # the router put the matched route into the scope; unmatched paths share one label
+            route = scope.get("route")
+            REQUEST_SECONDS.observe(time.perf_counter() - started, route=getattr(route, "path", "unmatched"),
+                                    method=scope["method"], status=status)
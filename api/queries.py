@@ -0,0 +1,69 @@
+import base64
+import binascii
+import json
+from typing import List, Optional, Tuple
+from bson import ObjectId
+from bson.errors import InvalidId
+from db.client import BOOK_SORTS
+
+def build_book_query(category: Optional[str] = None, min_price: Optional[float] = None,
+                     max_price: Optional[float] = None, rating: Optional[int] = None) -> dict:
+    """Mongo filter for the book filters accepted by the API"""
+    query = {}
+    if category:
+        query["category"] = category
+    if rating:
+        query["rating"] = rating
+    if min_price is not None or max_price is not None:
+        sub = {}
+        if min_price is not None:
+            sub["$gte"] = min_price
+        if max_price is not None:
+            sub["$lte"] = max_price
+        query["price_including_tax"] = sub
+    return query
+
+def sort_spec(sort_by: Optional[str]) -> List[Tuple[str, int]]:
+    """Sort keys for `sort_by`, always ending in _id so the order is total"""
+    field, direction = BOOK_SORTS.get(sort_by, ("_id", 1))
+    if field == "_id":
+        return [("_id", direction)]
+    return [(field, direction), ("_id", direction)]
+
+def encode_cursor(sort_by: Optional[str], doc: dict) -> str:
+    """Opaque continuation token: the sort key and _id of the last row served"""
+    field, _ = sort_spec(sort_by)[0]
+    payload = {"s": sort_by, "v": doc.get(field) if field != "_id" else None, "id": str(doc["_id"])}
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode("utf-8")).decode("ascii")
+
+def decode_cursor(token: str, sort_by: Optional[str]) -> Tuple[object, ObjectId]:
+    """Return (sort value, _id) from a token; ValueError if it is malformed or for another sort"""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+        last_id = ObjectId(payload["id"])
+    except (ValueError, KeyError, TypeError, InvalidId, binascii.Error) as e:
+        raise ValueError("Malformed cursor") from e
+    if payload.get("s") != sort_by:
+        raise ValueError("Cursor was issued for a different sort order")
+    return payload.get("v"), last_id
+
+def keyset_filter(sort_by: Optional[str], value, last_id: ObjectId) -> dict:
+    """Filter selecting the rows strictly after (value, last_id) in sort_spec order.
+
+    Missing/null sort values sort lowest in Mongo, so they come last in
+    descending order and first in ascending order.
+    """
+    keys = sort_spec(sort_by)
+    field, direction = keys[0]
+    after = "$gt" if direction > 0 else "$lt"
+    if field == "_id":
+        return {"_id": {after: last_id}}
+    if value is None:
+        same = {field: None, "_id": {after: last_id}}
+        if direction > 0:
+            return {"$or": [{field: {"$ne": None}}, same]}
+        return same
+    clauses = [{field: {after: value}}, {field: value, "_id": {after: last_id}}]
+    if direction < 0:
+        clauses.append({field: None})
+    return {"$or": clauses}
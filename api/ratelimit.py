@@ -0,0 +1,138 @@
+"""Per-API-key rate limiting with a sliding-window counter.
+
+Each key keeps two counters, one for the current fixed window and one for
+the previous window. The number of hits in the last RATE_LIMIT_WINDOW seconds
+is estimated as the current count plus the previous count weighted by how much
+of the previous window still overlaps. Time and memory per request are
+constant, whatever the number of hits.
+
+Backends (RATE_LIMIT_BACKEND):
+  memory  per process (default)
+  mongo   shared by every API worker: atomic $inc on one document per key and
+          window in `rate_limits`, removed by a TTL index
+"""
+import hashlib
+import os
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from dotenv import load_dotenv
+from pymongo import ReturnDocument
+from db.client import db
+
+load_dotenv()
+
+RATE_LIMIT_PER_HOUR = int(os.getenv("RATE_LIMIT_PER_HOUR", "100"))
+RATE_LIMIT_WINDOW = int(os.getenv("RATE_LIMIT_WINDOW", "3600"))  # seconds
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+
+class RateLimitResult(NamedTuple):
+    allowed: bool
+    limit: int
+    remaining: int
+    reset: int  # seconds until the current window ends
+
+    def headers(self) -> Dict[str, str]:
+        headers = {"X-RateLimit-Limit": str(self.limit), "X-RateLimit-Remaining": str(self.remaining),
+                   "X-RateLimit-Reset": str(self.reset)}
+        if not self.allowed:
+            headers["Retry-After"] = str(self.reset)
+        return headers
+
+class MemoryRateLimitBackend:
+    def __init__(self):
+        self._counters: Dict[str, List[int]] = {}  # key -> [window_start, current, previous]
+
+    async def hit(self, key: str, window_start: int, window: int) -> Tuple[int, int]:
+        """Count one hit; return (previous window count, current window count)"""
+        counter = self._counters.get(key)
+        if counter is None:
+            counter = self._counters[key] = [window_start, 0, 0]
+        elif counter[0] != window_start:
+            # roll over: the old current window becomes the previous one if adjacent
+            counter[2] = counter[1] if window_start - counter[0] == window else 0
+            counter[0], counter[1] = window_start, 0
+        counter[1] += 1
+        return counter[2], counter[1]
+
+    async def undo(self, key: str, window_start: int):
+        counter = self._counters.get(key)
+        if counter and counter[0] == window_start:
+            counter[1] -= 1
+
+class MongoRateLimitBackend:
+    def __init__(self, collection=None):
+        self.collection = collection if collection is not None else db.rate_limits
+        self._previous: Dict[str, Tuple[int, int]] = {}  # key -> (window_start, count): closed windows don't change
+
+    @staticmethod
+    def _id(key: str, window_start: int) -> str:
+        return f"{key}:{window_start}"
+
+    async def hit(self, key: str, window_start: int, window: int) -> Tuple[int, int]:
+        expires_at = datetime.fromtimestamp(window_start + 2 * window, timezone.utc)
+        doc = await self.collection.find_one_and_update(
+            {"_id": self._id(key, window_start)},
+            {"$inc": {"count": 1}, "$setOnInsert": {"expires_at": expires_at}},
+            upsert=True, return_document=ReturnDocument.AFTER,
+        )
+        prev_start = window_start - window
+        cached = self._previous.get(key)
+        if cached is None or cached[0] != prev_start:
+            prev = await self.collection.find_one({"_id": self._id(key, prev_start)}, {"count": 1})
+            cached = self._previous[key] = (prev_start, prev["count"] if prev else 0)
+        return cached[1], doc["count"]
+
+    async def undo(self, key: str, window_start: int):
+        await self.collection.update_one({"_id": self._id(key, window_start)}, {"$inc": {"count": -1}})
+
+class RateLimiter:
+    def __init__(self, backend, limit: Optional[int] = None, window: Optional[int] = None):
+        self.backend = backend
+        self.limit = limit or RATE_LIMIT_PER_HOUR
+        self.window = window or RATE_LIMIT_WINDOW
+
+    async def hit(self, api_key: str, now: Optional[float] = None) -> RateLimitResult:
+        """Count one request for api_key; rejected requests are not counted"""
+        now = time.time() if now is None else now
+        window_start = int(now // self.window) * self.window
+        key = hashlib.blake2b(api_key.encode("utf-8"), digest_size=16).hexdigest()
+        previous, current = await self.backend.hit(key, window_start, self.window)
+        overlap = 1 - (now - window_start) / self.window
+        used = previous * overlap + current
+        reset = max(int(window_start + self.window - now), 1)
+        if used > self.limit:
+            await self.backend.undo(key, window_start)
+            return RateLimitResult(False, self.limit, 0, reset)
+        return RateLimitResult(True, self.limit, int(self.limit - used), reset)
+
+def make_backend(name: str):
+    if name == "mongo":
+        return MongoRateLimitBackend()
+    if name == "memory":
+        return MemoryRateLimitBackend()
+    raise ValueError(f"Unknown RATE_LIMIT_BACKEND: {name}")
+
+_limiter = RateLimiter(make_backend(RATE_LIMIT_BACKEND))
+
+def get_rate_limiter() -> RateLimiter:
+    return _limiter
+
+class RateLimitHeadersMiddleware:
+    """Add the X-RateLimit-* headers of the request (set by require_api_key) to its response"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        async def send_with_headers(message):
+            result = scope.get("rate_limit")
+            if message["type"] == "http.response.start" and result is not None:
+                extra = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in result.headers().items()]
+                message["headers"] = list(message.get("headers", [])) + extra
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
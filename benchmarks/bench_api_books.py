@@ -0,0 +1,80 @@
+"""Serialization cost of GET /books: Pydantic response_model path vs the direct JSON fast path,
+and end-to-end latency with the response cache off and on.
+
+    python -m benchmarks.bench_api_books
+"""
+import argparse
+import json
+import time
+from datetime import datetime
+
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
+from fastapi.testclient import TestClient
+
+from api import cache as api_cache
+from api import main as api_main
+from api.ratelimit import get_rate_limiter
+from api.encoding import BOOK_PROJECTION, books_response
+from db.generation import read_generation
+from benchmarks.fakes import FakeDB, book_url, install_fake_db
+
+SNAPSHOT = "<html>" + "x" * 50_000 + "</html>"
+
+
+def make_doc(i: int) -> dict:
+    return {
+        "_id": ObjectId(), "source_url": book_url(i), "title": f"Book {i}", "description": "Lorem ipsum " * 40,
+        "category": "Poetry", "price_including_tax": 51.77, "price_excluding_tax": 51.77,
+        "availability": "In stock (22 available)", "num_reviews": i % 7, "rating": i % 5 + 1,
+        "image_url": f"https://books.toscrape.com/media/cache/{i:04d}.jpg", "crawl_timestamp": datetime.utcnow(),
+        "fingerprint": "ab" * 32, "validators": {"etag": '"x"'}, "raw_html_snapshot": SNAPSHOT,
+    }
+
+
+def legacy_encode(docs, per_page):
+    """What list_books did before: stringify _id, validate every row, then jsonable_encoder + json.dumps"""
+    for doc in docs:
+        doc["_id"] = str(doc["_id"])
+    model = api_main.BookListResponse(page=1, per_page=per_page, data=docs)
+    content = jsonable_encoder(model, exclude={"data": {"__all__": {"raw_html_snapshot"}}}, by_alias=True)
+    return json.dumps(content).encode("utf-8")
+
+
+def timed(fn, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - started) / rounds * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+
+    all_docs = [make_doc(i) for i in range(500)]
+    projected = [{k: v for k, v in d.items() if k in BOOK_PROJECTION or k == "_id"} for d in all_docs]
+    fake_db = FakeDB(books=all_docs)
+    install_fake_db(fake_db, [api_main])
+    api_cache._cache = api_cache.ResponseCache(generation=lambda: read_generation(fake_db.meta))
+    client = TestClient(api_main.app)
+    get_rate_limiter().limit = 10 ** 9
+    endpoints = api_cache.API_CACHE_ENDPOINTS
+
+    print("per_page   legacy encode   fast encode   speedup   end-to-end uncached   cached")
+    for per_page in (20, 100, 500):
+        legacy = timed(lambda: legacy_encode([dict(d) for d in all_docs[:per_page]], per_page), args.rounds)
+        fast = timed(lambda: books_response(1, per_page, projected[:per_page]).body, args.rounds)
+        get = lambda: client.get(f"/books?per_page={per_page}", headers={"x-api-key": api_main.API_KEY})
+        api_cache.API_CACHE_ENDPOINTS = set()
+        uncached = timed(get, max(args.rounds // 5, 1))
+        api_cache.API_CACHE_ENDPOINTS = endpoints
+        cached = timed(get, args.rounds)
+        print(f"{per_page:8d}   {legacy:10.2f} ms   {fast:8.2f} ms   x{legacy / fast:6.1f}"
+              f"   {uncached:16.2f} ms   {cached:6.2f} ms")
+    print(api_cache.get_response_cache().stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Wall-clock time and request count of change detection against a mocked, slow site.
+
+    python -m benchmarks.bench_change_detection --books 200 --latency 0.05
+
+"full" re-fetches every book page; "listing" reads the catalogue pages and
+fetches only books whose listing summary changed, plus a random sample.
+"""
+import argparse
+import asyncio
+import logging
+import random
+import tempfile
+import time
+
+import httpx
+
+from crawler.fingerprint import fingerprint
+from crawler.parser import parse_book_page
+from benchmarks.fakes import (FakeDB, PER_PAGE, book_html, book_url, install_fake_db, listing_html, listing_url,
+                              site_transport)
+from db import snapshots
+from scheduler import change_detector
+
+
+def build_catalog(n_books: int, changed_every: int):
+    pages, docs, prices = {}, [], {}
+    for i in range(n_books):
+        url = book_url(i)
+        doc = parse_book_page(book_html(i), url)
+        doc["fingerprint"] = fingerprint(doc)
+        docs.append(doc)
+        # every `changed_every`-th book has a new price on the site so the writer stage gets work
+        if changed_every and i % changed_every == 0:
+            prices[i] = 12.0
+        pages[url] = book_html(i, price=prices.get(i, 10.0))
+    n_pages = max(1, -(-n_books // PER_PAGE))
+    for page in range(1, n_pages + 1):
+        numbers = range((page - 1) * PER_PAGE, min(page * PER_PAGE, n_books))
+        pages[listing_url(page)] = listing_html(page, numbers, last=page == n_pages, prices=prices)
+    return pages, docs
+
+
+async def skip_rollups(days):
+    """Rollups are a Mongo aggregation; bench_rollups covers them"""
+
+
+async def run_once(mode: str, pages, docs, latency: float, concurrency: int, sample_rate: float):
+    fake_db = FakeDB(books=docs)
+    install_fake_db(fake_db, [change_detector])
+    change_detector.write_rollups = skip_rollups
+    transport = site_transport(pages, latency)
+    serve, requests = transport.handler, []
+
+    async def counting(request):
+        requests.append(request.url)
+        return await serve(request)
+
+    transport.handler = counting
+    with tempfile.TemporaryDirectory() as tmp:
+        # keep snapshots of changed pages on local disk rather than in MongoDB
+        snapshots._store = snapshots.SnapshotStore(snapshots.DirectorySnapshotBackend(tmp))
+        async with httpx.AsyncClient(transport=transport) as client:
+            started = time.perf_counter()
+            if mode == "full":
+                stats = await change_detector.detect_changes_for_all_books(client=client, concurrency=concurrency)
+            else:
+                stats = await change_detector.detect_changes_from_listings(
+                    client=client, concurrency=concurrency, sample_rate=sample_rate, rng=random.Random(0))
+            elapsed = time.perf_counter() - started
+    return elapsed, len(requests), len(fake_db.changes.docs), stats["avoided"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--books", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.05, help="simulated round trip in seconds")
+    parser.add_argument("--changed-every", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    parser.add_argument("--modes", nargs="+", choices=["full", "listing"], default=["full", "listing"])
+    parser.add_argument("--sample-rate", type=float, default=0.05, help="listing mode's random re-fetch share")
+    args = parser.parse_args()
+    logging.getLogger("books_crawler").setLevel(logging.WARNING)
+
+    pages, docs = build_catalog(args.books, args.changed_every)
+    print(f"{args.books} books, {args.latency * 1000:.0f} ms simulated latency")
+    for mode in args.modes:
+        baseline = None
+        for concurrency in args.concurrency:
+            elapsed, requests, changes, avoided = asyncio.run(
+                run_once(mode, pages, docs, args.latency, concurrency, args.sample_rate))
+            baseline = baseline or elapsed
+            print(f"{mode:7s} concurrency={concurrency:<4d} {elapsed:7.2f}s  {args.books / elapsed:8.1f} books/s  "
+                  f"x{baseline / elapsed:<5.1f} {requests:6d} requests  {changes:4d} changes  {avoided:5d} avoided")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""Size of change records that embed both book documents vs compact diffs, and /changes latency.
+
+    python -m benchmarks.bench_changes --books 1000 --changes 20000
+
+The record sizes run offline (BSON-encoded, as Mongo stores them). The storage
+and latency part needs a reachable MONGO_URI and works in a throwaway
+`bench_changes` database: legacy records are loaded, measured, rewritten by
+db.migrate_changes and measured again.
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+from datetime import datetime, timedelta, timezone
+
+import bson
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from api.main import CHANGE_PROJECTION
+from benchmarks.fakes import book_html, book_url
+from crawler.fingerprint import delta_update, field_hashes, fingerprint
+from crawler.parser import parse_book_page
+from db import migrate_changes
+from db.client import MONGO_URI
+from db.history import change_record
+
+# books.toscrape descriptions run to about a kilobyte
+DESCRIPTION = "It's hard to imagine a world without A Light in the Attic. " * 16
+START = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+def stored_book(n: int, price: float, availability: str, ts: datetime) -> dict:
+    doc = parse_book_page(book_html(n, price, availability), book_url(n))
+    doc.update(description=DESCRIPTION, crawl_timestamp=ts, snapshot_ref=f"{n:040x}",
+               validators={"etag": f'"{n}"', "last_modified": None})
+    doc["fingerprint"] = fingerprint(doc)
+    doc["field_hashes"] = field_hashes(doc)
+    return doc
+
+
+def change_stream(n_books: int, n_changes: int, seed: int = 1):
+    """(old, new, changed, changed_at) for random price and stock moves"""
+    rng = random.Random(seed)
+    books = {n: stored_book(n, 10.0 + n % 40, "In stock (20 available)", START) for n in range(n_books)}
+    for i in range(n_changes):
+        n = rng.randrange(n_books)
+        old = books[n]
+        ts = START + timedelta(minutes=i)
+        price = old["price_including_tax"]
+        availability = old["availability"]
+        if rng.random() < 0.7:
+            price = round(price * rng.uniform(0.8, 1.2), 2)
+        else:
+            availability = "Out of stock" if availability.startswith("In") else "In stock (3 available)"
+        new = stored_book(n, price, availability, ts)
+        changed, _ = delta_update(old, new)
+        books[n] = new
+        yield old, new, changed, ts
+
+
+def legacy_record(old, new, changed, ts) -> dict:
+    return {"source_url": new["source_url"], "changed_at": ts, "old_fingerprint": old["fingerprint"],
+            "new_fingerprint": new["fingerprint"], "old": old, "new": new, "changes": changed}
+
+
+def offline_report(stream):
+    print(f"{len(stream)} change records")
+    for label, make in (("legacy", legacy_record), ("compact", change_record)):
+        started = time.perf_counter()
+        encoded = [bson.encode(make(*change)) for change in stream]
+        elapsed = time.perf_counter() - started
+        sizes = [len(e) for e in encoded]
+        print(f"  {label:7s} {statistics.mean(sizes):7.0f} B/record  {sum(sizes) / 1e6:7.1f} MB total  "
+              f"{len(stream) / elapsed:8.0f} records/s built+encoded")
+
+
+async def changes_latency(db, rounds=50):
+    timings = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        await db.changes.find({}, CHANGE_PROJECTION).sort("changed_at", -1).limit(50).to_list(length=50)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+
+async def size_report(db, label):
+    changes = await db.command("collStats", "changes")
+    latency = await changes_latency(db)
+    print(f"  {label:7s} changes={changes['size'] / 1e6:7.1f} MB  storage={changes['storageSize'] / 1e6:7.1f} MB  "
+          f"/changes p50={latency:6.2f} ms")
+
+
+async def online_report(stream, n_books):
+    client = AsyncIOMotorClient(MONGO_URI, serverSelectionTimeoutMS=2000)
+    try:
+        await client.admin.command("ping")
+    except Exception as e:
+        print(f"MongoDB not reachable ({e.__class__.__name__}); skipping size/latency comparison")
+        return
+    db = client["bench_changes"]
+    await client.drop_database("bench_changes")
+    try:
+        await db.create_collection("price_history", timeseries={"timeField": "ts", "metaField": "source_url",
+                                                                "granularity": "hours"})
+        await db.changes.create_index([("changed_at", -1)])
+        await db.changes.insert_many([legacy_record(*change) for change in stream])
+        await size_report(db, "before")
+
+        migrate_changes.db = db
+        await migrate_changes.compact_changes(500)
+        await db.command("compact", "changes")
+        await size_report(db, "after")
+        history = await db.command("collStats", "price_history")
+        print(f"  price_history: {await db.price_history.count_documents({})} points for {n_books} books, "
+              f"{history.get('storageSize', 0) / 1e6:.1f} MB on disk")
+    finally:
+        await client.drop_database("bench_changes")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--books", type=int, default=1000)
+    parser.add_argument("--changes", type=int, default=20000)
+    args = parser.parse_args()
+    stream = list(change_stream(args.books, args.changes))
+    offline_report(stream)
+    asyncio.run(online_report(stream, args.books))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""Throughput of crawl_all with parsing on the event loop vs on a thread or process pool.
+
+    python -m benchmarks.bench_crawl --books 1000 --latency 0.02 --workers 1 2 4
+
+The site is mocked, with simulated latency, and pages are padded to --page-kb
+so parsing costs what it does on real pages. With parsing inline every page
+parsed stalls all in-flight requests; with a process pool the parse stage
+scales with cores until fetch latency or the single event loop is the limit.
+
+A second table crawls at INFO level (one alert per new book) with the log
+written straight from the event loop, as it used to be, and through the
+logging queue, and reports how long the loop stalled: the time a 1 ms ticker
+task woke up late, summed, and its p99 and worst wake-up delay.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.fakes import FakeDB, book_html, book_url, install_fake_db, listing_html, listing_url, site_transport
+from crawler import crawler, parse_pool
+from db import facets, snapshots
+from utils import logger as log
+
+TICK = 0.001
+
+PER_PAGE = 20
+
+
+def build_site(n_books: int, page_kb: int):
+    # a hidden block of product-page-like markup to bring each page to real-world size
+    filler = "<div hidden>" + '<p class="x"><span>lorem</span> ipsum</p>' * (page_kb * 1024 // 40) + "</div>"
+    pages = {book_url(i): book_html(i).replace("</body>", filler + "</body>") for i in range(n_books)}
+    n_pages = max(1, -(-n_books // PER_PAGE))
+    for page in range(1, n_pages + 1):
+        numbers = range((page - 1) * PER_PAGE, min(page * PER_PAGE, n_books))
+        pages[listing_url(page)] = listing_html(page, numbers, last=page == n_pages)
+    return pages
+
+
+async def watch_loop(lags: list):
+    """Record how late each TICK-second sleep wakes up: the time the loop was busy elsewhere"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(TICK)
+        lags.append(max(time.perf_counter() - started - TICK, 0.0))
+
+
+async def run_once(pages, latency: float, pool: parse_pool.ParsePool, lags: list = None) -> float:
+    install_fake_db(FakeDB(), [crawler, facets])
+    parse_pool._pool = pool
+    # start the worker processes before the clock does
+    await asyncio.gather(*(pool.parse_book(book_html(0), book_url(0)) for _ in range(max(pool.workers, 1))))
+    transport = site_transport(pages, latency)
+    crawler.make_client = lambda **kwargs: httpx.AsyncClient(transport=transport)
+    with tempfile.TemporaryDirectory() as tmp:
+        snapshots._store = snapshots.SnapshotStore(snapshots.DirectorySnapshotBackend(tmp))
+        watcher = asyncio.create_task(watch_loop(lags if lags is not None else []))
+        started = time.perf_counter()
+        try:
+            await crawler.crawl_all()
+            return time.perf_counter() - started
+        finally:
+            watcher.cancel()
+
+
+class TimedHandlers:
+    """Time spent in the books_crawler logger's handlers, i.e. on the thread that logged"""
+
+    def __init__(self):
+        self.seconds = 0.0
+        self._logger = logging.getLogger("books_crawler")
+
+    def __enter__(self):
+        call_handlers = self._logger.callHandlers
+
+        def timed(record):
+            started = time.perf_counter()
+            call_handlers(record)
+            self.seconds += time.perf_counter() - started
+        self._logger.callHandlers = timed
+        return self
+
+    def __exit__(self, *exc):
+        del self._logger.callHandlers
+
+
+def logging_stalls(n_books: int, latency: float, log_dir: str):
+    # small pages parsed inline, so the parser is not what stalls the loop
+    pages = build_site(n_books, 1)
+    print(f"\nINFO logging to {log_dir}, 1 KiB pages parsed inline:")
+    with tempfile.TemporaryDirectory(dir=log_dir) as tmp, open(os.devnull, "w") as devnull:
+        for mode in ("direct", "queue"):
+            log_file = os.path.join(tmp, f"{mode}.log")
+            log.setup_logging(level="INFO", log_file=log_file, use_queue=mode == "queue", stream=devnull)
+            pool = parse_pool.make_parse_pool("inline")
+            lags = []
+            try:
+                with TimedHandlers() as handlers:
+                    elapsed = asyncio.run(run_once(pages, latency, pool, lags))
+            finally:
+                pool.shutdown()
+                log.shutdown_logging()
+            with open(log_file) as f:
+                lines = sum(1 for _ in f)
+            lags.sort()
+            print(f"{mode:8s} {elapsed:7.2f}s  {lines:6d} lines  in handlers {handlers.seconds * 1000:7.1f} ms  "
+                  f"loop stalled {sum(lags) * 1000:8.1f} ms  p99 {lags[int(len(lags) * 0.99)] * 1000:6.2f} ms  "
+                  f"max {lags[-1] * 1000:6.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--books", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.02, help="simulated round trip in seconds")
+    parser.add_argument("--page-kb", type=int, default=50)
+    parser.add_argument("--workers", type=int, nargs="+", default=sorted({1, 2, os.cpu_count() or 1}))
+    parser.add_argument("--log-dir", default=tempfile.gettempdir(), help="where the logging comparison writes")
+    args = parser.parse_args()
+    logging.getLogger("books_crawler").setLevel(logging.WARNING)
+
+    pages = build_site(args.books, args.page_kb)
+    print(f"{args.books} books of ~{args.page_kb} KiB, {args.latency * 1000:.0f} ms simulated latency, "
+          f"concurrency {crawler.CONCURRENCY}, {os.cpu_count()} CPUs")
+    configs = [("inline", 1)] + [("thread", w) for w in args.workers[-1:]] + [("process", w) for w in args.workers]
+    baseline = None
+    for kind, workers in configs:
+        pool = parse_pool.make_parse_pool(kind, workers)
+        try:
+            elapsed = asyncio.run(run_once(pages, args.latency, pool))
+        finally:
+            pool.shutdown()
+        baseline = baseline or elapsed
+        batch = pool.stats["pages"] / pool.stats["batches"] if pool.stats["batches"] else 1
+        print(f"{kind:8s} workers={workers:<3d} {elapsed:7.2f}s  {args.books / elapsed:8.1f} books/s  "
+              f"avg batch {batch:5.1f}  x{baseline / elapsed:.1f}")
+    logging_stalls(args.books, args.latency, args.log_dir)
+
+
+if __name__ == "__main__":
+    main()
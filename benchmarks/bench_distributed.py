@@ -0,0 +1,89 @@
+"""Crawl throughput of the lease-queue crawl as worker processes are added.
+
+    python -m benchmarks.bench_distributed --books 2000 --workers 1 2 4
+
+Needs a reachable MONGO_URI and works in a throwaway `bench_distributed`
+database. For each worker count the catalogue is discovered afresh, then that
+many processes drain the queue from a simulated site (per-request latency
+--latency). Parsing is inline so each worker's CPU stays in its own process.
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+
+DB_NAME = "bench_distributed"
+os.environ["DB_NAME"] = DB_NAME  # inherited by the spawned workers before they import db.client
+
+
+def worker(worker_id: str, n_books: int, latency: float, concurrency: int):
+    import httpx
+    from benchmarks.fakes import lazy_site
+    from crawler import distributed, parse_pool
+
+    logging.getLogger("books_crawler").setLevel(logging.WARNING)
+    parse_pool._pool = parse_pool.ParsePool()
+    client = httpx.AsyncClient(transport=lazy_site(n_books, latency))
+    asyncio.run(distributed.run_worker(worker_id, concurrency, client, poll=0.1))
+
+
+async def discover(n_books: int):
+    import httpx
+    from benchmarks.fakes import lazy_site
+    from crawler import distributed
+    from db.client import client, ensure_indexes
+
+    await client.drop_database(DB_NAME)
+    await ensure_indexes()
+    async with httpx.AsyncClient(transport=lazy_site(n_books)) as http:
+        await distributed.discover(http)
+
+
+async def crawl(args):
+    from motor.motor_asyncio import AsyncIOMotorClient
+    from db.client import MONGO_URI, client
+
+    probe = AsyncIOMotorClient(MONGO_URI, serverSelectionTimeoutMS=2000)
+    try:
+        await probe.admin.command("ping")
+    except Exception as e:
+        print(f"MongoDB not reachable ({e.__class__.__name__}); this benchmark needs a mongod")
+        return
+    finally:
+        probe.close()
+
+    ctx = multiprocessing.get_context("spawn")
+    print(f"{args.books} books, {args.latency * 1000:.0f} ms latency, {args.concurrency} in flight per worker")
+    print(f"{'workers':>7s} {'total':>9s} {'books/s':>8s} {'per worker':>11s}")
+    try:
+        for n in args.workers:
+            await discover(args.books)
+            procs = [ctx.Process(target=worker, args=(f"bench-{i}", args.books, args.latency, args.concurrency))
+                     for i in range(n)]
+            started = time.perf_counter()
+            for proc in procs:
+                proc.start()
+            for proc in procs:
+                await asyncio.to_thread(proc.join)
+            elapsed = time.perf_counter() - started
+            rate = args.books / elapsed
+            print(f"{n:7d} {elapsed:8.2f}s {rate:8.0f} {rate / n:11.0f}")
+    finally:
+        await client.drop_database(DB_NAME)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--books", type=int, default=2000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--latency", type=float, default=0.02, help="simulated round trip in seconds")
+    parser.add_argument("--concurrency", type=int, default=8, help="books in flight per worker")
+    args = parser.parse_args()
+    logging.getLogger("books_crawler").setLevel(logging.WARNING)
+    asyncio.run(crawl(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+"""End-to-end crawl and change detection against a replayed site.
+
+    python -m benchmarks.bench_e2e --books 500 --latency 0.02 --jitter 0.01 --error-rate 0.01
+    python -m benchmarks.bench_e2e --archive fixtures/site --mongo
+
+Runs crawl_all on an empty database, then detect_changes_for_all_books over
+what it stored, both through crawler.replay.ReplayTransport. Without
+--archive a synthetic catalogue is recorded first (through the recorder, so
+that path is exercised too), plus a second recording in which --change-rate of
+the books have a new price for the detection run to find.
+
+The database is the in-memory fake by default, or with --mongo a throwaway
+`bench_e2e` database on MONGO_URI. Snapshots go to a temporary directory in
+both cases. Per phase it reports pages served per second, p50/p99 from a
+book's first request to its write landing in `books`, database operations per
+book and the process's peak RSS so far.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import resource
+import statistics
+import tempfile
+import time
+from collections import Counter
+
+DB_NAME = "bench_e2e"
+os.environ["DB_NAME"] = DB_NAME  # before db.client is imported, for --mongo
+
+import httpx
+
+from benchmarks.fakes import FakeDB, PER_PAGE, book_html, book_url, listing_html, listing_url, site_transport
+from crawler import crawler, parse_pool, throttle
+from crawler.replay import FixtureArchive, RecordingTransport, ReplayTransport, record_site
+from db import facets, snapshots
+from scheduler import change_detector
+
+
+def build_site(n_books: int, page_kb: int, prices=None):
+    prices = prices or {}
+    filler = "<div hidden>" + '<p class="x"><span>lorem</span> ipsum</p>' * (page_kb * 1024 // 40) + "</div>"
+    pages = {book_url(i): book_html(i, prices.get(i, 10.0)).replace("</body>", filler + "</body>")
+             for i in range(n_books)}
+    n_pages = max(1, -(-n_books // PER_PAGE))
+    for page in range(1, n_pages + 1):
+        numbers = range((page - 1) * PER_PAGE, min(page * PER_PAGE, n_books))
+        pages[listing_url(page)] = listing_html(page, numbers, last=page == n_pages, prices=prices)
+    return pages
+
+
+async def record_synthetic(root: str, pages) -> FixtureArchive:
+    archive = FixtureArchive(root)
+    async with httpx.AsyncClient(transport=RecordingTransport(archive, site_transport(pages, etags=True))) as client:
+        await record_site(client, archive)
+    archive.save()
+    return archive
+
+
+class TimedReplay(ReplayTransport):
+    """Remembers when each URL was first requested"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.first_request = {}
+
+    async def handle_async_request(self, request):
+        self.first_request.setdefault(str(request.url), time.perf_counter())
+        return await super().handle_async_request(request)
+
+
+class Instrumented:
+    """A collection that counts the operations issued on it and notes when each book's write landed"""
+
+    def __init__(self, collection, ops: Counter, stored: dict):
+        self._collection = collection
+        self._ops = ops
+        self._stored = stored
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if not callable(attr):
+            return attr
+        if name == "bulk_write":
+            async def bulk_write(requests, *args, **kwargs):
+                self._ops[name] += 1
+                result = await attr(requests, *args, **kwargs)
+                now = time.perf_counter()
+                for op in requests:
+                    # updates are keyed by their filter, inserts by the document
+                    target = getattr(op, "_filter", None) or getattr(op, "_doc", {})
+                    if "source_url" in target:
+                        self._stored.setdefault(target["source_url"], now)
+                return result
+            return bulk_write
+
+        def call(*args, **kwargs):
+            self._ops[name] += 1
+            return attr(*args, **kwargs)
+        return call
+
+
+class InstrumentedDB:
+    def __init__(self, db):
+        self._db = db
+        self._collections = {}
+        self.ops = Counter()
+        self.stored = {}  # source_url -> when its first books write of the phase landed
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        if name not in self._collections:
+            stored = self.stored if name == "books" else {}
+            self._collections[name] = Instrumented(getattr(self._db, name), self.ops, stored)
+        return self._collections[name]
+
+    def reset(self):
+        self.ops.clear()
+        self.stored.clear()
+
+
+async def skip_rollups(days):
+    """Rollups are a Mongo aggregation; bench_rollups covers them"""
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def phase(name: str, run, transport: TimedReplay, idb: InstrumentedDB, raw_db):
+    idb.reset()
+    transport.first_request.clear()
+    requests, injected = transport.requests, transport.injected
+    started = time.perf_counter()
+    await run()
+    elapsed = time.perf_counter() - started
+    pages = (transport.requests - requests) - (transport.injected - injected)
+    books = await raw_db.books.count_documents({})
+    latencies = sorted(at - transport.first_request[url] for url, at in idb.stored.items()
+                       if url in transport.first_request)
+    p50 = statistics.median(latencies) * 1000 if latencies else float("nan")
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000 if latencies else float("nan")
+    print(f"{name:8s} {elapsed:7.2f}s {pages / elapsed:8.1f} {len(latencies):7d} {p50:8.1f} {p99:8.1f} "
+          f"{sum(idb.ops.values()) / max(books, 1):8.2f} {peak_rss_mb():8.1f}")
+
+
+async def bench(args, crawl_archive: FixtureArchive, revisit_archive: FixtureArchive):
+    if args.mongo:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        from db.client import MONGO_URI, client, db, ensure_indexes
+
+        probe = AsyncIOMotorClient(MONGO_URI, serverSelectionTimeoutMS=2000)
+        try:
+            await probe.admin.command("ping")
+        except Exception as e:
+            print(f"MongoDB not reachable ({e.__class__.__name__}); run without --mongo for the in-memory fake")
+            return
+        finally:
+            probe.close()
+        await client.drop_database(DB_NAME)
+        await ensure_indexes()
+        raw_db = db
+    else:
+        raw_db = FakeDB()
+        change_detector.write_rollups = skip_rollups
+    # limits adapted while recording the synthetic site start over
+    throttle._limiters, throttle._budget = throttle.HostLimiters(), throttle.RetryBudget()
+    idb = InstrumentedDB(raw_db)
+    for module in (crawler, change_detector, facets):
+        module.db = idb
+    errors = dict(error_rate=args.error_rate, errors=[503, 429, "timeout"])
+    crawl_transport = TimedReplay(crawl_archive, args.latency, args.jitter, seed=args.seed, **errors)
+    revisit_transport = TimedReplay(revisit_archive, args.latency, args.jitter, seed=args.seed + 1, **errors)
+    crawler.make_client = lambda **kwargs: httpx.AsyncClient(transport=crawl_transport)
+
+    async def detect():
+        async with httpx.AsyncClient(transport=revisit_transport) as client:
+            await change_detector.detect_changes_for_all_books(client=client)
+
+    print(f"{'phase':8s} {'elapsed':>8s} {'pages/s':>8s} {'stored':>7s} {'p50 ms':>8s} {'p99 ms':>8s} "
+          f"{'ops/book':>8s} {'RSS MB':>8s}")
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            snapshots._store = snapshots.SnapshotStore(snapshots.DirectorySnapshotBackend(tmp))
+            await phase("crawl", crawler.crawl_all, crawl_transport, idb, raw_db)
+            await phase("detect", detect, revisit_transport, idb, raw_db)
+    finally:
+        if args.mongo:
+            await client.drop_database(DB_NAME)
+    print(f"injected failures: {crawl_transport.injected + revisit_transport.injected}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--archive", help="recorded site to crawl (default: record a synthetic one)")
+    parser.add_argument("--revisit-archive", help="recorded site to detect changes against (default: --archive)")
+    parser.add_argument("--books", type=int, default=500, help="size of the synthetic catalogue")
+    parser.add_argument("--page-kb", type=int, default=50, help="synthetic book page size")
+    parser.add_argument("--change-rate", type=float, default=0.1, help="synthetic books repriced for detection")
+    parser.add_argument("--latency", type=float, default=0.02, help="simulated round trip in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this much extra latency per request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests failed (503/429/timeout)")
+    parser.add_argument("--parse", default=parse_pool.PARSE_EXECUTOR, choices=["inline", "thread", "process"])
+    parser.add_argument("--mongo", action="store_true", help=f"use the `{DB_NAME}` database on MONGO_URI")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    logging.getLogger("books_crawler").setLevel(logging.ERROR)  # injected failures make retry warnings
+
+    parse_pool._pool = parse_pool.make_parse_pool(args.parse)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            if args.archive:
+                crawl_archive = FixtureArchive(args.archive)
+                revisit_archive = FixtureArchive(args.revisit_archive) if args.revisit_archive else crawl_archive
+                print(f"archive {args.archive}: {len(crawl_archive)} responses")
+            else:
+                rng = random.Random(args.seed)
+                repriced = {i: 12.0 for i in range(args.books) if rng.random() < args.change_rate}
+                crawl_archive = asyncio.run(record_synthetic(os.path.join(tmp, "v1"),
+                                                             build_site(args.books, args.page_kb)))
+                revisit_archive = asyncio.run(record_synthetic(os.path.join(tmp, "v2"),
+                                                               build_site(args.books, args.page_kb, repriced)))
+                print(f"synthetic site: {args.books} books of ~{args.page_kb} KiB, {len(repriced)} repriced")
+            print(f"{args.latency * 1000:.0f} ms latency, {args.jitter * 1000:.0f} ms jitter, "
+                  f"{args.error_rate:.1%} errors, {args.parse} parsing, "
+                  f"{'mongo' if args.mongo else 'in-memory'} database")
+            asyncio.run(bench(args, crawl_archive, revisit_archive))
+    finally:
+        parse_pool.get_parse_pool().shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""GET /books/facets from the materialized book_facets cells vs an on-demand $group over books.
+
+    python -m benchmarks.bench_facets --books 20000
+
+Needs a reachable MONGO_URI; works in a throwaway `bench_facets` database.
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from benchmarks.fakes import book_url
+from db import facets
+from db.client import MONGO_URI
+
+CATEGORIES = [f"Category {i}" for i in range(50)]
+FILTERS = {
+    "no filter": {},
+    "category": {"category": "Category 7"},
+    "price range": {"price_including_tax": {"$gte": 22.5, "$lte": 41.0}},
+    "category+rating": {"category": "Category 7", "rating": 4},
+}
+
+
+async def timed(fn, rounds):
+    timings = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        await fn()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+
+async def run(n_books: int, rounds: int):
+    client = AsyncIOMotorClient(MONGO_URI, serverSelectionTimeoutMS=2000)
+    try:
+        await client.admin.command("ping")
+    except Exception as e:
+        print(f"MongoDB not reachable ({e.__class__.__name__}); this benchmark needs a mongod")
+        return
+    await client.drop_database("bench_facets")
+    db = client["bench_facets"]
+    facets.db = db
+    try:
+        rnd = random.Random(1)
+        await db.books.insert_many([{
+            "source_url": book_url(i), "title": f"Book {i}", "description": "Lorem ipsum " * 40,
+            "category": rnd.choice(CATEGORIES), "rating": rnd.randint(1, 5),
+            "price_including_tax": round(rnd.uniform(10, 60), 2),
+        } for i in range(n_books)])
+        await db.books.create_index([("category", 1), ("rating", 1)])
+        await db.books.create_index([("price_including_tax", 1)])
+        await facets.rebuild_facets()
+        cells = await db.book_facets.estimated_document_count()
+        print(f"{n_books} books -> {cells} facet cells")
+        print(f"{'filter':18s} {'$group':>10s} {'cells':>10s}  speedup")
+        for label, query in FILTERS.items():
+            on_demand = await timed(lambda: facets.aggregate_facets(query), rounds)
+            materialized = await timed(lambda: facets.query_facets(query), rounds)
+            assert await facets.aggregate_facets(query) == await facets.query_facets(query)
+            print(f"{label:18s} {on_demand:8.2f}ms {materialized:8.2f}ms  x{on_demand / materialized:.1f}")
+    finally:
+        await client.drop_database("bench_facets")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--books", type=int, default=20000)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(run(args.books, args.rounds))
+
+
+if __name__ == "__main__":
+    main()
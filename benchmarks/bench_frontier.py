@@ -0,0 +1,115 @@
+"""Time-to-first-book and peak RSS of crawl_all as the catalogue grows.
+
+    python -m benchmarks.bench_frontier --books 200 2000 20000
+
+Each catalogue size is crawled in a fresh process so its peak RSS is its own.
+The site is generated on request and the database and snapshot store discard
+what they are given, so what grows with the catalogue is the crawler itself.
+Parsing is inline, keeping all the work in the measured process.
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import resource
+import time
+
+import httpx
+
+from benchmarks.fakes import lazy_site
+
+
+class SinkCollection:
+    """Accepts every write and keeps nothing"""
+
+    async def bulk_write(self, requests, ordered=True):
+        return type("BulkWriteResult", (), {"upserted_ids": {}})()
+
+    async def update_one(self, *args, **kwargs):
+        return type("UpdateResult", (), {"upserted_id": None})()
+
+    async def find_one(self, *args, **kwargs):
+        return None
+
+    async def estimated_document_count(self):
+        return 0
+
+    async def delete_many(self, *args, **kwargs):
+        pass
+
+    def find(self, *args, **kwargs):
+        return self
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        raise StopAsyncIteration
+
+
+class SinkDB:
+    def __getattr__(self, name):
+        return SinkCollection()
+
+
+class SinkSnapshots:
+    async def put(self, key, codec, data, size):
+        pass
+
+    async def get(self, key):
+        return None
+
+
+def rss_mib() -> float:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 2 ** 20
+
+
+def crawl(n_books: int, latency: float, concurrency: int, out):
+    from crawler import crawler, parse_pool
+    from db import facets, snapshots
+
+    logging.getLogger("books_crawler").setLevel(logging.WARNING)
+    crawler.db = facets.db = SinkDB()
+    snapshots._store = snapshots.SnapshotStore(SinkSnapshots())
+    parse_pool._pool = parse_pool.ParsePool()
+    transport = lazy_site(n_books, latency)
+    crawler.make_client = lambda **kwargs: httpx.AsyncClient(transport=transport)
+
+    first = []
+    fetch_book_and_store = crawler.fetch_book_and_store
+
+    async def timed_fetch(*args, **kwargs):
+        await fetch_book_and_store(*args, **kwargs)
+        if not first:
+            first.append(time.perf_counter())
+
+    crawler.fetch_book_and_store = timed_fetch
+    baseline = rss_mib()
+    started = time.perf_counter()
+    asyncio.run(crawler.crawl_all(concurrency))
+    elapsed = time.perf_counter() - started
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    out.send((first[0] - started, elapsed, baseline, peak))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--books", type=int, nargs="+", default=[200, 2000, 20000])
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated round trip in seconds")
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context("spawn")
+    print(f"{'books':>7s} {'first book':>11s} {'total':>9s} {'books/s':>8s} {'RSS before':>11s} {'peak RSS':>9s}")
+    for n in args.books:
+        recv, send = ctx.Pipe(duplex=False)
+        proc = ctx.Process(target=crawl, args=(n, args.latency, args.concurrency, send))
+        proc.start()
+        first, elapsed, baseline, peak = recv.recv()
+        proc.join()
+        print(f"{n:7d} {first * 1000:8.1f} ms {elapsed:8.2f}s {n / elapsed:8.0f} {baseline:7.1f} MiB {peak:5.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
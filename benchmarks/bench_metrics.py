@@ -0,0 +1,57 @@
+"""Cost of a metrics update on the hot path, and of rendering /metrics.
+
+    python -m benchmarks.bench_metrics --rounds 1000000
+
+Updates run against a private registry holding metrics shaped like the crawler's
+(labelled counters and latency histograms); rendering is timed with --series
+label combinations per metric, about what a long crawl with many hosts reaches.
+"""
+import argparse
+import time
+
+from utils.metrics import Counter, Gauge, Histogram, MetricsRegistry
+
+
+def ns_per_call(fn, rounds: int) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - started) / rounds * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=1_000_000)
+    parser.add_argument("--series", type=int, default=200)
+    args = parser.parse_args()
+
+    registry = MetricsRegistry()
+    plain = registry.register(Counter("bench_plain_total", "No labels"))
+    responses = registry.register(Counter("bench_responses_total", "By status", ("status",)))
+    depth = registry.register(Gauge("bench_depth", "By queue", ("queue",)))
+    latency = registry.register(Histogram("bench_seconds", "By kind", ("kind",)))
+
+    def timed():
+        with latency.time(kind="book"):
+            pass
+
+    baseline = ns_per_call(lambda: None, args.rounds)
+    for label, fn in (("counter, no labels", plain.inc),
+                      ("counter, one label", lambda: responses.inc(status=200)),
+                      ("gauge set", lambda: depth.set(5, queue="frontier")),
+                      ("histogram observe", lambda: latency.observe(0.042, kind="book")),
+                      ("histogram time()", timed)):
+        print(f"{label:20s} {ns_per_call(fn, args.rounds) - baseline:8.0f} ns/update")
+
+    for i in range(args.series):
+        responses.inc(status=i)
+        depth.set(i, queue=i)
+        latency.observe(i / 1000, kind=i)
+    started = time.perf_counter()
+    text = registry.render()
+    elapsed = time.perf_counter() - started
+    print(f"render: {len(text.splitlines())} lines, {len(text) / 1024:.0f} KiB in {elapsed * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Pages/second and memory of parse_book_page's bs4 and lxml backends over saved pages.
+
+    python -m benchmarks.bench_parser --rounds 20
+    python -m benchmarks.bench_parser --pages /path/to/saved/pages --rounds 3
+
+Timing runs without tracemalloc; the peak traced memory of parsing one page is
+measured in a separate pass, as is the number of blocks still allocated after
+the pass (a leak check). tracemalloc only sees the Python heap: libxml2's own
+tree is not counted, which flatters lxml but is also where bs4's cost lies (one
+Python object per node). Both backends are first checked to agree on every page.
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+from pathlib import Path
+
+from crawler.parser import parse_book_page
+
+FIXTURES = Path(__file__).resolve().parent.parent / "tests" / "fixtures" / "pages"
+BACKENDS = ["bs4", "lxml"]
+
+
+def load_corpus(directory: Path):
+    return [(f"https://books.toscrape.com/catalogue/{p.stem}/index.html", p.read_text(encoding="utf-8"))
+            for p in sorted(directory.glob("*.html"))]
+
+
+def pages_per_second(corpus, backend: str, rounds: int) -> float:
+    gc.collect()
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for url, html in corpus:
+            parse_book_page(html, url, backend=backend)
+    return rounds * len(corpus) / (time.perf_counter() - started)
+
+
+def memory(corpus, backend: str):
+    gc.collect()
+    tracemalloc.start()
+    peak = 0
+    for url, html in corpus:
+        tracemalloc.reset_peak()
+        parse_book_page(html, url, backend=backend)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return peak / 1024, retained / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pages", type=Path, default=FIXTURES, help="directory of saved book pages (*.html)")
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.pages)
+    if not corpus:
+        raise SystemExit(f"no *.html pages in {args.pages}")
+    for url, html in corpus:
+        if parse_book_page(html, url, backend="lxml") != parse_book_page(html, url, backend="bs4"):
+            raise SystemExit(f"backends disagree on {url}")
+
+    print(f"{len(corpus)} pages x {args.rounds} rounds, avg {sum(len(h) for _, h in corpus) / len(corpus) / 1024:.1f} KiB")
+    print(f"{'backend':8s} {'pages/s':>10s} {'peak KiB/page':>14s} {'retained KiB':>13s}")
+    baseline = None
+    for backend in BACKENDS:
+        rate = pages_per_second(corpus, backend, args.rounds)
+        peak, retained = memory(corpus, backend)
+        baseline = baseline or rate
+        print(f"{backend:8s} {rate:10.0f} {peak:14.0f} {retained:13.1f}  x{rate / baseline:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Per-request cost of rate limiting as a key's hit count grows: the old list-of-timestamps
+limiter vs the sliding-window counter (memory backend, and the Mongo backend when reachable).
+
+    python -m benchmarks.bench_ratelimit
+"""
+import argparse
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from api.ratelimit import MemoryRateLimitBackend, MongoRateLimitBackend, RateLimiter
+from db.client import MONGO_URI
+
+HIT_COUNTS = (100, 1_000, 10_000, 100_000)
+
+
+def legacy_hit(store, key, limit):
+    """What require_api_key did before: rebuild the list of hit timestamps on every request"""
+    now = datetime.now(timezone.utc)
+    window_start = now - timedelta(hours=1)
+    hits = [t for t in store.get(key, []) if t > window_start]
+    if len(hits) >= limit:
+        return False
+    hits.append(now)
+    store[key] = hits
+    return True
+
+
+async def per_request_us(limiter_hit, warmup: int, rounds: int) -> float:
+    for _ in range(warmup):
+        await limiter_hit()
+    started = time.perf_counter()
+    for _ in range(rounds):
+        await limiter_hit()
+    return (time.perf_counter() - started) / rounds * 1e6
+
+
+async def run(rounds: int):
+    client = AsyncIOMotorClient(MONGO_URI, serverSelectionTimeoutMS=2000)
+    try:
+        await client.admin.command("ping")
+        mongo = client["bench_ratelimit"]
+    except Exception as e:
+        print(f"MongoDB not reachable ({e.__class__.__name__}); skipping the mongo backend column")
+        client.close()
+        mongo = None
+
+    print(f"{'hits so far':>12s} {'legacy list':>14s} {'memory':>10s} {'mongo':>10s}")
+    for hits in HIT_COUNTS:
+        # prefill instead of replaying: warming the legacy limiter up is itself quadratic
+        now = datetime.now(timezone.utc)
+        store = {"k": [now - timedelta(microseconds=i) for i in range(hits, 0, -1)]}
+
+        async def legacy():
+            legacy_hit(store, "k", 10 ** 9)
+
+        memory = RateLimiter(MemoryRateLimitBackend(), limit=10 ** 9)
+        legacy_us = await per_request_us(legacy, 0, rounds)
+        memory_us = await per_request_us(lambda: memory.hit("k"), hits, rounds)
+        mongo_col = "      n/a"
+        if mongo is not None:
+            await mongo.rate_limits.drop()
+            shared = RateLimiter(MongoRateLimitBackend(mongo.rate_limits), limit=10 ** 9)
+            # the counter is one document whatever the hit count, so a short warmup is representative
+            mongo_col = f"{await per_request_us(lambda: shared.hit('k'), 10, rounds):7.1f} us"
+        print(f"{hits:12d} {legacy_us:11.1f} us {memory_us:7.1f} us {mongo_col}")
+    if mongo is not None:
+        await client.drop_database("bench_ratelimit")
+        client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(run(args.rounds))
+
+
+if __name__ == "__main__":
+    main()
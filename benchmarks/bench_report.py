@@ -0,0 +1,69 @@
+"""Peak memory and time of the daily change CSV: the in-memory report vs the streamed export.
+
+    python -m benchmarks.bench_report --changes 1000 5000 20000
+
+Change records embed full old/new book documents, as the change detector wrote
+them before snapshots moved out, so each one weighs tens of kilobytes. Peak
+memory is measured with tracemalloc, excluding the fake collection itself.
+"""
+import argparse
+import asyncio
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+from benchmarks.fakes import FakeDB, book_url, install_fake_db
+from scheduler import reporter
+
+SNAPSHOT = "<html>" + "x" * 20_000 + "</html>"
+
+
+def make_change(i: int, now: datetime) -> dict:
+    book = {"source_url": book_url(i), "title": f"Book {i}", "description": "Lorem ipsum " * 80,
+            "category": "Poetry", "price_including_tax": 10.0, "price_excluding_tax": 10.0,
+            "availability": "In stock (20 available)", "num_reviews": 3, "rating": 4,
+            "raw_html_snapshot": SNAPSHOT}
+    return {"source_url": book_url(i), "changed_at": now, "old_fingerprint": "a" * 64, "new_fingerprint": "b" * 64,
+            "changes": ["price_including_tax"], "old": book, "new": dict(book, price_including_tax=11.0)}
+
+
+async def measure(fn):
+    tracemalloc.start()
+    started = time.perf_counter()
+    size = await fn()
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed * 1000, peak / 2 ** 20, size
+
+
+async def in_memory():
+    return len(await reporter.generate_daily_change_report("csv"))
+
+
+async def streamed():
+    size = 0
+    async for chunk in reporter.stream_daily_change_report("csv"):
+        size += len(chunk)  # what StreamingResponse does: send the chunk and let it go
+    return size
+
+
+async def run(counts):
+    print(f"{'changes':>8s} {'in-memory':>22s} {'streamed':>22s}")
+    for n in counts:
+        now = datetime.now(timezone.utc)
+        install_fake_db(FakeDB(changes=[make_change(i, now) for i in range(n)]), [reporter])
+        legacy_ms, legacy_mb, _ = await measure(in_memory)
+        stream_ms, stream_mb, _ = await measure(streamed)
+        print(f"{n:8d} {legacy_ms:9.0f} ms {legacy_mb:7.1f} MiB {stream_ms:9.0f} ms {stream_mb:7.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--changes", type=int, nargs="+", default=[1000, 5000, 20000])
+    args = parser.parse_args()
+    asyncio.run(run(args.changes))
+
+
+if __name__ == "__main__":
+    main()
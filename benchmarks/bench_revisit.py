@@ -0,0 +1,129 @@
+"""Freshness per request of the revisit planner against the daily full revisit.
+
+    python -m benchmarks.bench_revisit --books 1000 --days 30
+
+Each book changes as a Poisson process at a rate drawn from a skewed mix (most
+books almost never change, a few change several times a day). The planner
+starts from a synthetic history such as the daily change detector would have
+recorded: at most one change per book per day over REVISIT_HISTORY_DAYS. The
+simulation then runs hourly ticks. Freshness is the share of stored copies
+that are current, sampled at every tick before that tick's revisits.
+"""
+import argparse
+import bisect
+import random
+
+from scheduler.planner import DAY, REVISIT_HISTORY_DAYS, RevisitPlanner
+
+HOUR = 3600.0
+# (share of books, changes per day)
+RATE_MIX = [(0.60, 1 / 365), (0.25, 1 / 7), (0.10, 1 / 1.5), (0.05, 4.0)]
+
+
+def change_times(rate_per_day: float, start: float, end: float, rng: random.Random):
+    times, t = [], start
+    while True:
+        t += rng.expovariate(rate_per_day / DAY)
+        if t >= end:
+            return times
+        times.append(t)
+
+
+def synthetic_catalog(n_books: int, start: float, end: float, rng: random.Random):
+    books = {}
+    for i in range(n_books):
+        r, acc = rng.random(), 0.0
+        for share, rate in RATE_MIX:
+            acc += share
+            if r < acc:
+                break
+        books[f"book-{i}"] = change_times(rate, start, end, rng)
+    return books
+
+
+def simulate(books, t0: float, days: int, policy):
+    """Run hourly ticks; `policy(now)` returns the books to revisit and learns what it found"""
+    stored = {url: bisect.bisect_right(times, t0) for url, times in books.items()}
+    fresh_samples, requests, found = [], 0, 0
+    for tick in range(1, int(days * 24) + 1):
+        now = t0 + tick * HOUR
+        versions = {url: bisect.bisect_right(times, now) for url, times in books.items()}
+        fresh_samples.append(sum(stored[url] == v for url, v in versions.items()) / len(books))
+        visits = policy(now)
+        changed = set()
+        for url in visits:
+            if stored[url] != versions[url]:
+                changed.add(url)
+                stored[url] = versions[url]
+        requests += len(visits)
+        found += len(changed)
+        if hasattr(policy, "learn"):
+            policy.learn(now, visits, changed)
+    return sum(fresh_samples) / len(fresh_samples), requests, found
+
+
+class DailyAll:
+    """What scheduler.jobs used to do: every book once a day"""
+
+    def __init__(self, books):
+        self.urls = list(books)
+
+    def __call__(self, now):
+        return self.urls if int(now // HOUR) % 24 == 2 else []
+
+
+class RoundRobin:
+    """The same budget as the planner, spread evenly over all books"""
+
+    def __init__(self, books, budget):
+        self.urls, self.budget, self.next = list(books), budget, 0
+
+    def __call__(self, now):
+        picked = [self.urls[(self.next + i) % len(self.urls)] for i in range(min(self.budget, len(self.urls)))]
+        self.next = (self.next + len(picked)) % len(self.urls)
+        return picked
+
+
+class Planned:
+    def __init__(self, books, budget, t0, history_days):
+        self.planner = RevisitPlanner(budget=budget)
+        since = t0 - history_days * DAY
+        for url, times in books.items():
+            # the daily detector saw at most one change per day
+            seen = len({int(t // DAY) for t in times if since <= t < t0})
+            self.planner.add(url, seen, since, t0, now=t0)
+
+    def __call__(self, now):
+        return self.planner.due(now)
+
+    def learn(self, now, visits, changed):
+        for url in visits:
+            self.planner.visited(url, now, url in changed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--books", type=int, default=1000)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--budgets", type=int, nargs="+", help="planner fetches per hourly tick (default: books/24, /48, /96)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    t0 = (REVISIT_HISTORY_DAYS + 1) * DAY
+    books = synthetic_catalog(args.books, t0 - REVISIT_HISTORY_DAYS * DAY, t0 + (args.days + 1) * DAY, rng)
+    budgets = args.budgets or [max(1, args.books // n) for n in (24, 48, 96)]
+
+    print(f"{args.books} books over {args.days} days, hourly ticks")
+    print(f"{'policy':24s} {'requests/day':>12s} {'freshness':>10s} {'changes found':>14s} {'found/request':>14s}")
+    runs = [("daily full revisit", DailyAll(books))]
+    for budget in budgets:
+        runs.append((f"round robin, {budget}/tick", RoundRobin(books, budget)))
+        runs.append((f"planner, {budget}/tick", Planned(books, budget, t0, REVISIT_HISTORY_DAYS)))
+    for name, policy in runs:
+        freshness, requests, found = simulate(books, t0, args.days, policy)
+        print(f"{name:24s} {requests / args.days:12.0f} {freshness:10.3f} {found:14d} {found / max(requests, 1):14.3f}")
+
+
+if __name__ == "__main__":
+    main()
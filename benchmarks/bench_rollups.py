@@ -0,0 +1,85 @@
+"""A 90-day GET /report/changes from per-day rollups vs aggregating 90 days of raw change records.
+
+    python -m benchmarks.bench_rollups --per-day 500
+
+Needs a reachable MONGO_URI; works in a throwaway `bench_rollups` database.
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+from datetime import datetime, timedelta, timezone
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from benchmarks.fakes import book_url
+from db.client import MONGO_URI
+from scheduler import rollups
+
+DAYS = 90
+
+
+def make_change(rnd: random.Random, i: int, changed_at: datetime) -> dict:
+    old_price = round(rnd.uniform(10, 60), 2)
+    book = {"source_url": book_url(i), "title": f"Book {i}", "description": "Lorem ipsum " * 80,
+            "category": f"Category {i % 50}", "price_including_tax": old_price,
+            "availability": "In stock (20 available)", "snapshot_ref": "ab" * 20}
+    new = dict(book, price_including_tax=round(old_price * rnd.uniform(0.8, 1.2), 2))
+    return {"source_url": book_url(i), "changed_at": changed_at, "old_fingerprint": "a" * 64,
+            "new_fingerprint": "b" * 64, "changes": ["price_including_tax"], "old": book, "new": new}
+
+
+async def timed(fn, rounds):
+    timings = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        await fn()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+
+async def run(per_day: int, rounds: int):
+    client = AsyncIOMotorClient(MONGO_URI, serverSelectionTimeoutMS=2000)
+    try:
+        await client.admin.command("ping")
+    except Exception as e:
+        print(f"MongoDB not reachable ({e.__class__.__name__}); this benchmark needs a mongod")
+        client.close()
+        return
+    await client.drop_database("bench_rollups")
+    db = client["bench_rollups"]
+    rollups.db = db
+    try:
+        rnd = random.Random(1)
+        today = datetime.now(timezone.utc).date()
+        first = today - timedelta(days=DAYS - 1)
+        for n, day in enumerate(rollups.days_between(first, today)):
+            start, _ = rollups.day_bounds(day)
+            await db.changes.insert_many([make_change(rnd, n * per_day + i, start + timedelta(seconds=i))
+                                          for i in range(per_day)])
+        await db.changes.create_index([("changed_at", -1)])
+        await rollups.write_rollups(rollups.days_between(first, today - timedelta(days=1)))
+
+        raw = rollups.rollup_pipeline(today)
+        raw[0] = {"$match": {"changed_at": {"$gte": rollups.day_bounds(first)[0],
+                                            "$lt": rollups.day_bounds(today)[1]}}}
+        scan = await timed(lambda: db.changes.aggregate(raw).to_list(length=1), rounds)
+        report = await timed(lambda: rollups.change_report(first, today), rounds)
+        print(f"{DAYS} days x {per_day} changes: raw aggregation {scan:.1f} ms, rollups {report:.1f} ms "
+              f"(x{scan / report:.1f})")
+    finally:
+        await client.drop_database("bench_rollups")
+        client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--per-day", type=int, default=500)
+    parser.add_argument("--rounds", type=int, default=10)
+    args = parser.parse_args()
+    asyncio.run(run(args.per_day, args.rounds))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Collection size and /books query latency with embedded vs externalized snapshots.
+
+    python -m benchmarks.bench_snapshots --books 2000
+
+The compression/dedup part runs offline. The size and latency part needs a
+reachable MONGO_URI and works in a throwaway `bench_snapshots` database.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from benchmarks.fakes import book_html, book_url
+from db import migrate_snapshots, snapshots
+from db.client import MONGO_URI
+
+# books.toscrape pages carry ~50 KB of navigation and sidebar markup around the book itself
+PAGE_CHROME = "".join(f'<li><a href="../books/category_{i}/index.html">Category {i}</a></li>\n' for i in range(600))
+
+
+def page(n: int) -> str:
+    return book_html(n).replace("<body>", "<body><ul class='nav'>" + PAGE_CHROME + "</ul>", 1)
+
+
+def offline_report(pages):
+    raw = sum(len(p) for p in pages)
+    print(f"{len(pages)} pages, {raw / len(pages) / 1024:.1f} KB average")
+    for codec in ("none", "zlib", "zstd"):
+        if codec == "zstd" and snapshots.zstandard is None:
+            print("  zstd: skipped (zstandard not installed)")
+            continue
+        started = time.perf_counter()
+        size = sum(len(snapshots.compress(p, codec)) for p in pages)
+        elapsed = time.perf_counter() - started
+        print(f"  {codec:5s} {size / raw * 100:6.1f}% of raw  {len(pages) / elapsed:8.0f} pages/s")
+    unique = len({snapshots.snapshot_key(p) for p in pages + pages[: len(pages) // 2]})
+    print(f"  dedup: {len(pages) + len(pages) // 2} puts -> {unique} stored snapshots")
+
+
+async def query_latency(db, rounds=50):
+    timings = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        await db.books.find({"category": "Poetry"}).sort("rating", -1).limit(20).to_list(length=20)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+
+async def size_report(db, label):
+    books = await db.command("collStats", "books")
+    changes = await db.command("collStats", "changes")
+    latency = await query_latency(db)
+    print(f"  {label:7s} books={books['size'] / 1e6:7.1f} MB  changes={changes['size'] / 1e6:7.1f} MB  "
+          f"/books p50={latency:6.2f} ms")
+
+
+async def online_report(pages):
+    client = AsyncIOMotorClient(MONGO_URI, serverSelectionTimeoutMS=2000)
+    try:
+        await client.admin.command("ping")
+    except Exception as e:
+        print(f"MongoDB not reachable ({e.__class__.__name__}); skipping size/latency comparison")
+        return
+    db = client["bench_snapshots"]
+    await client.drop_database("bench_snapshots")
+    try:
+        docs = [{"source_url": book_url(i), "title": f"Book {i}", "category": "Poetry", "rating": i % 5,
+                 "raw_html_snapshot": html} for i, html in enumerate(pages)]
+        await db.books.insert_many(docs)
+        await db.changes.insert_many([{"source_url": d["source_url"], "old": dict(d, _id=None), "new": dict(d, _id=None)}
+                                      for d in docs[: len(docs) // 5]])
+        await size_report(db, "before")
+
+        migrate_snapshots.db = db
+        store = snapshots.SnapshotStore(snapshots.MongoSnapshotBackend(db.snapshots))
+        await migrate_snapshots.migrate_books(store, 200)
+        await migrate_snapshots.migrate_changes(store, 200)
+        await db.command("compact", "books")
+        await db.command("compact", "changes")
+        await size_report(db, "after")
+        stored = await db.command("collStats", "snapshots")
+        print(f"  snapshots collection: {stored['count']} documents, {stored['size'] / 1e6:.1f} MB")
+    finally:
+        await client.drop_database("bench_snapshots")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--books", type=int, default=2000)
+    args = parser.parse_args()
+    pages = [page(i) for i in range(args.books)]
+    offline_report(pages)
+    asyncio.run(online_report(pages))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+"""In-memory stand-ins for the Mongo collections and the books.toscrape site.
+
+Only the small subset of the Motor API that the crawler, change detector and API
+actually use is implemented. Good enough to measure our own code paths without a
+mongod or network access.
+"""
+import asyncio
+import copy
+import re
+from typing import Dict, List, Optional
+
+import httpx
+from bson import ObjectId
+from pymongo import InsertOne, UpdateOne
+
+from db.facets import BUILT_ID as FACETS_BUILT_ID
+
+
+def _matches(doc: dict, query: dict) -> bool:
+    for key, cond in query.items():
+        value = doc.get(key)
+        if isinstance(cond, dict) and any(k.startswith("$") for k in cond):
+            for op, arg in cond.items():
+                if op == "$gte" and not (value is not None and value >= arg):
+                    return False
+                if op == "$lte" and not (value is not None and value <= arg):
+                    return False
+                if op == "$gt" and not (value is not None and value > arg):
+                    return False
+                if op == "$lt" and not (value is not None and value < arg):
+                    return False
+                if op == "$ne" and value == arg:
+                    return False
+                if op == "$in" and value not in arg:
+                    return False
+        elif value != cond:
+            return False
+    return True
+
+
+def _project(doc: dict, projection) -> dict:
+    if not projection:
+        return copy.deepcopy(doc)
+    included = {k for k, v in projection.items() if v}
+    if included:
+        out = {}
+        for key in included:
+            if "." in key:  # one level of dotted paths, e.g. "old.title"
+                parent, child = key.split(".", 1)
+                if child in (doc.get(parent) or {}):
+                    out.setdefault(parent, {})[child] = doc[parent][child]
+            elif key in doc:
+                out[key] = doc[key]
+        if projection.get("_id", 1) and "_id" in doc:
+            out["_id"] = doc["_id"]
+        return copy.deepcopy(out)
+    return copy.deepcopy({k: v for k, v in doc.items() if k not in projection})
+
+
+class UpdateResult:
+    def __init__(self, matched_count=0, modified_count=0, upserted_id=None):
+        self.matched_count = matched_count
+        self.modified_count = modified_count
+        self.upserted_id = upserted_id
+
+
+class FakeCursor:
+    """Holds references to the matching documents; copies are projected as they are read"""
+
+    def __init__(self, docs: List[dict], projection=None):
+        self._docs = docs
+        self._projection = projection
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key, direction=None):
+        keys = key if isinstance(key, list) else [(key, direction or 1)]
+        for field, order in reversed(keys):
+            self._docs.sort(key=lambda d: (d.get(field) is not None, d.get(field)), reverse=order < 0)
+        return self
+
+    def skip(self, n):
+        self._skip = n
+        return self
+
+    def limit(self, n):
+        self._limit = n
+        return self
+
+    def batch_size(self, n):
+        return self
+
+    def _window(self):
+        end = self._skip + self._limit if self._limit else None
+        return self._docs[self._skip:end]
+
+    async def to_list(self, length=None):
+        docs = self._window()
+        return [_project(d, self._projection) for d in (docs[:length] if length else docs)]
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self._window():
+            yield _project(doc, self._projection)
+
+
+class FakeCollection:
+    """A list-backed collection that counts the operations issued against it"""
+
+    def __init__(self, docs=None, name="fake"):
+        self.name = name
+        self.docs: List[dict] = []
+        self.ops: Dict[str, int] = {}
+        for doc in docs or []:
+            self._insert(doc)
+
+    def _count(self, op):
+        self.ops[op] = self.ops.get(op, 0) + 1
+
+    def _insert(self, doc):
+        doc = copy.deepcopy(doc)
+        doc.setdefault("_id", ObjectId())
+        self.docs.append(doc)
+        return doc["_id"]
+
+    def find(self, query=None, projection=None):
+        self._count("find")
+        return FakeCursor([d for d in self.docs if _matches(d, query or {})], projection)
+
+    async def find_one(self, query=None, projection=None):
+        self._count("find_one")
+        for doc in self.docs:
+            if _matches(doc, query or {}):
+                return _project(doc, projection)
+        return None
+
+    async def insert_one(self, doc):
+        self._count("insert_one")
+        return type("InsertOneResult", (), {"inserted_id": self._insert(doc)})()
+
+    async def update_one(self, query, update, upsert=False):
+        self._count("update_one")
+        return self._update(query, update, upsert)
+
+    def _update(self, query, update, upsert):
+        for doc in self.docs:
+            if _matches(doc, query):
+                doc.update(copy.deepcopy(update.get("$set", {})))
+                for key, n in update.get("$inc", {}).items():
+                    doc[key] = doc.get(key, 0) + n
+                return UpdateResult(1, 1)
+        if not upsert:
+            return UpdateResult()
+        doc = {k: v for k, v in query.items() if not isinstance(v, dict)}
+        doc.update(update.get("$setOnInsert", {}))
+        doc.update(update.get("$set", {}))
+        doc.update(update.get("$inc", {}))
+        return UpdateResult(upserted_id=self._insert(doc))
+
+    async def bulk_write(self, requests, ordered=True):
+        self._count("bulk_write")
+        upserted = {}
+        for index, op in enumerate(requests):
+            if isinstance(op, InsertOne):
+                self._insert(op._doc)
+            elif isinstance(op, UpdateOne):
+                result = self._update(op._filter, op._doc, op._upsert)
+                if result.upserted_id is not None:
+                    upserted[index] = result.upserted_id
+        return type("BulkWriteResult", (), {"upserted_ids": upserted})()
+
+    async def delete_many(self, query):
+        self._count("delete_many")
+        self.docs = [d for d in self.docs if not _matches(d, query)]
+
+    async def estimated_document_count(self):
+        self._count("estimated_document_count")
+        return len(self.docs)
+
+    async def count_documents(self, query):
+        self._count("count_documents")
+        return sum(1 for d in self.docs if _matches(d, query))
+
+
+class FakeDB:
+    """Attribute access creates collections on demand, like a Motor database"""
+
+    def __init__(self, **collections):
+        # facet cells count as built from the seeded books (there is no aggregation to build them with)
+        collections.setdefault("meta", [{"_id": FACETS_BUILT_ID}])
+        for name, docs in collections.items():
+            setattr(self, name, FakeCollection(docs, name))
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        coll = FakeCollection(name=name)
+        setattr(self, name, coll)
+        return coll
+
+    def total_ops(self) -> int:
+        return sum(sum(c.ops.values()) for c in vars(self).values() if isinstance(c, FakeCollection))
+
+
+def install_fake_db(fake_db, modules):
+    """Point the module-level `db` of each module at the fake"""
+    for module in modules:
+        module.db = fake_db
+
+
+def book_html(n: int, price: float = 10.0, availability: str = "In stock (20 available)") -> str:
+    return f"""<html><body>
+<ul class="breadcrumb"><li><a href="../../index.html">Home</a></li>
+<li><a href="../category/books_1/index.html">Books</a></li>
+<li><a href="../category/books/poetry_23/index.html">Poetry</a></li><li class="active">Book {n}</li></ul>
+<div class="content"><div id="content_inner"><article class="product_page">
+<div class="row"><div class="col-sm-6"><div id="product_gallery" class="carousel"><div class="thumbnail">
+<div class="carousel-inner"><div class="item active"><img src="../../media/cache/{n:04d}.jpg" alt="Book {n}" /></div></div>
+</div></div></div>
+<div class="col-sm-6 product_main"><h1>Book {n}</h1><p class="price_color">£{price:.2f}</p>
+<p class="instock availability"><i class="icon-ok"></i> {availability}</p>
+<p class="star-rating {["One", "Two", "Three", "Four", "Five"][n % 5]}"></p></div></div>
+<div id="product_description" class="sub-header"><h2>Product Description</h2></div>
+<p>Description of book {n}.</p>
+<table class="table table-striped">
+<tr><th>UPC</th><td>{n:016x}</td></tr><tr><th>Product Type</th><td>Books</td></tr>
+<tr><th>Price (excl. tax)</th><td>£{price:.2f}</td></tr><tr><th>Price (incl. tax)</th><td>£{price:.2f}</td></tr>
+<tr><th>Tax</th><td>£0.00</td></tr><tr><th>Availability</th><td>{availability}</td></tr>
+<tr><th>Number of reviews</th><td>{n % 7}</td></tr></table>
+</article></div></div></body></html>"""
+
+
+def book_url(n: int) -> str:
+    return f"https://books.toscrape.com/catalogue/book-{n}_{n}/index.html"
+
+
+def listing_url(page: int) -> str:
+    return "https://books.toscrape.com/" if page == 1 else f"https://books.toscrape.com/catalogue/page-{page}.html"
+
+
+def listing_html(page: int, book_numbers, last: bool, prices: Optional[Dict[int, float]] = None) -> str:
+    """A catalogue page linking to the given books, and to the next page unless `last`.
+
+    Each pod shows what book_html(n) shows, at `prices[n]` if given (10.00 otherwise).
+    """
+    prices = prices or {}
+    pods = "".join(
+        f'<li><article class="product_pod"><p class="star-rating {["One", "Two", "Three", "Four", "Five"][n % 5]}"></p>'
+        f'<h3><a href="{book_url(n)}" title="Book {n}">Book {n}</a></h3><div class="product_price">'
+        f'<p class="price_color">£{prices.get(n, 10.0):.2f}</p><p class="instock availability">In stock</p></div>'
+        f'</article></li>'
+        for n in book_numbers)
+    pager = "" if last else f'<ul class="pager"><li class="next"><a href="{listing_url(page + 1)}">next</a></li></ul>'
+    return f'<html><body><ol class="row">{pods}</ol>{pager}</body></html>'
+
+
+def site_transport(pages: Dict[str, str], latency: float = 0.0, etags: bool = False) -> httpx.MockTransport:
+    """Serve `pages` (url -> html) with an optional simulated round-trip latency"""
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if latency:
+            await asyncio.sleep(latency)
+        html = pages.get(str(request.url))
+        if html is None:
+            return httpx.Response(404)
+        headers = {}
+        if etags:
+            etag = '"%x"' % (hash(html) & 0xFFFFFFFF)
+            if request.headers.get("if-none-match") == etag:
+                return httpx.Response(304, headers={"etag": etag})
+            headers["etag"] = etag
+        return httpx.Response(200, text=html, headers=headers)
+
+    return httpx.MockTransport(handler)
+
+
+PER_PAGE = 20
+_BOOK = re.compile(r"book-(\d+)_\d+/index\.html$")
+_LISTING = re.compile(r"page-(\d+)\.html$")
+
+
+def lazy_site(n_books: int, latency: float = 0.0) -> httpx.MockTransport:
+    """A catalogue of `n_books`, PER_PAGE to a listing page, generated as it is requested"""
+    n_pages = max(1, -(-n_books // PER_PAGE))
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if latency:
+            await asyncio.sleep(latency)
+        url = str(request.url)
+        if m := _BOOK.search(url):
+            return httpx.Response(200, text=book_html(int(m.group(1))))
+        page = int(m.group(1)) if (m := _LISTING.search(url)) else 1
+        numbers = range((page - 1) * PER_PAGE, min(page * PER_PAGE, n_books))
+        return httpx.Response(200, text=listing_html(page, numbers, last=page == n_pages))
+
+    return httpx.MockTransport(handler)
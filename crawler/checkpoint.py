@@ -0,0 +1,113 @@
+"""Per-URL crawl progress, kept in the `crawl_urls` collection.
+
+One small document per discovered book URL (_id is the URL) moves from
+"pending" to "done" or "failed", counting attempts. Writes go through a
+BulkWriter, so checkpointing costs a constant few bytes per book however large
+the catalogue is, and a resumed crawl re-queues exactly the unfinished URLs.
+"""
+import asyncio
+import os
+from contextlib import suppress
+from datetime import datetime, timezone
+from typing import List, Optional, Set, Tuple
+from pymongo import UpdateOne
+from dotenv import load_dotenv
+from db.bulk import BulkWriter
+
+load_dotenv()
+
+# A book that failed this many crawl attempts is left "failed" instead of re-queued on resume
+CRAWL_MAX_ATTEMPTS = int(os.getenv("CRAWL_MAX_ATTEMPTS", "3"))
+
+PENDING, DONE, FAILED = "pending", "done", "failed"
+LEASED = "leased"  # claimed by a worker of the distributed crawl (crawler.distributed)
+_LEASE = {"lease_owner": "", "lease_expires": "", "claim_id": ""}
+
+class CrawlCheckpoint:
+    """Buffered status updates for the crawl_urls collection.
+
+    "done" is only written once the book's own write has been applied:
+    `flush()` first flushes `books_writer`, and a book whose write it reports as
+    failed goes back to "pending" instead. A crash can make a book run twice but
+    never lose it. Inside `async with`, markers are flushed every `max_delay`
+    seconds as well, long before a distributed worker's lease runs out.
+    """
+
+    def __init__(self, collection, books_writer: Optional[BulkWriter] = None, max_ops: Optional[int] = None,
+                 max_delay: Optional[float] = None):
+        self.collection = collection
+        self.books_writer = books_writer
+        self._writer = BulkWriter(collection, max_ops, max_delay)
+        self._done: List[Tuple[str, datetime]] = []
+        self._ticker = None
+        # one flush at a time, and failed book writes kept until their book is marked
+        self._flush_lock = asyncio.Lock()
+        self._lost: Set[str] = set()
+
+    async def __aenter__(self):
+        await self._writer.__aenter__()
+        self._ticker = asyncio.create_task(self._tick())
+        return self
+
+    async def __aexit__(self, *exc):
+        self._ticker.cancel()
+        with suppress(asyncio.CancelledError):
+            await self._ticker
+        await self.flush()
+        await self._writer.__aexit__(*exc)
+
+    async def _tick(self):
+        while True:
+            await asyncio.sleep(self._writer.max_delay)
+            if self._done:
+                await self.flush()
+
+    async def discovered(self, url: str):
+        now = datetime.now(timezone.utc)
+        await self._writer.add(UpdateOne(
+            {"_id": url}, {"$setOnInsert": {"status": PENDING, "attempts": 0, "discovered_at": now}}, upsert=True))
+
+    async def done(self, url: str):
+        self._done.append((url, datetime.now(timezone.utc)))
+        if len(self._done) >= self._writer.max_ops:
+            await self.flush()
+
+    async def failed(self, url: str, error: Exception):
+        await self._writer.add(UpdateOne(
+            {"_id": url}, {"$set": {"status": FAILED, "error": str(error), "updated_at": datetime.now(timezone.utc)},
+                           "$inc": {"attempts": 1}, "$unset": _LEASE}))
+
+    async def flush(self):
+        """Make every status recorded so far durable"""
+        async with self._flush_lock:
+            done, self._done = self._done, []
+            if self.books_writer is not None:
+                if done:
+                    # every book in `done` queued its write before being marked: land those first
+                    await self.books_writer.flush()
+                self._lost |= self.books_writer.take_failed()
+            for url, at in done:
+                if url in self._lost:
+                    self._lost.discard(url)
+                    # its write never landed: run it again
+                    await self._writer.add(UpdateOne(
+                        {"_id": url}, {"$set": {"status": PENDING, "error": "book write failed", "updated_at": at},
+                                       "$inc": {"attempts": 1}, "$unset": _LEASE}))
+                else:
+                    await self._writer.add(UpdateOne(
+                        {"_id": url}, {"$set": {"status": DONE, "updated_at": at},
+                                       "$inc": {"attempts": 1}, "$unset": {"error": "", **_LEASE}}))
+            await self._writer.flush()
+
+    async def load(self) -> Tuple[Set[str], List[str]]:
+        """All URLs of the interrupted crawl, and those still to (re)try"""
+        seen, unfinished = set(), []
+        async for doc in self.collection.find({}, {"status": 1, "attempts": 1}):
+            seen.add(doc["_id"])
+            if doc["status"] == PENDING or (doc["status"] == FAILED and doc.get("attempts", 0) < CRAWL_MAX_ATTEMPTS):
+                unfinished.append(doc["_id"])
+        return seen, unfinished
+
+    async def reset(self):
+        """Forget the previous crawl's URLs before a fresh one"""
+        await self.collection.delete_many({})
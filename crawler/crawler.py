@@ -1,152 +1,399 @@
 
 import asyncio
-import hashlib
 import os
+import time
+from collections import Counter
 from datetime import datetime, timezone
+from typing import Optional, Tuple
 import httpx
-from tenacity import retry, wait_exponential, stop_after_attempt, retry_if_exception_type
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin
-from .parser import parse_book_page
+from .parse_pool import get_parse_pool, parse_pool_run
+from .checkpoint import CrawlCheckpoint
+from .index import FingerprintIndex
+from .throttle import CONCURRENCY, CRAWL_MAX_CONCURRENCY, backoff_delay, get_host_limiters, get_retry_budget, \
+    parse_retry_after
+from .fingerprint import FINGERPRINT_FIELDS, delta_update
+from pymongo import UpdateOne
 from db.client import db
+from db.bulk import BulkWriter
+from db.snapshots import get_snapshot_store
+from db.facets import ensure_facets, update_facets
+from db.generation import bump_generation
+from db.history import record_history, touches_history
 from dotenv import load_dotenv
-from utils.logger import logger
+from utils.logger import log_context, logger, new_id
+from utils.metrics import counter, dumps_metrics, gauge, histogram
 
 load_dotenv()
 BASE = "https://books.toscrape.com/"
-CONCURRENCY = int(os.getenv("CRAWL_CONCURRENCY", "8"))
+# Connection pool limits for the shared httpx client; the adaptive limit may grow up to CRAWL_MAX_CONCURRENCY
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", str(CRAWL_MAX_CONCURRENCY)))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", str(CONCURRENCY)))
+# How many discovered book URLs may wait for a free book worker
+CRAWL_QUEUE_SIZE = int(os.getenv("CRAWL_QUEUE_SIZE", str(CONCURRENCY * 4)))
+REQUEST_TIMEOUT = 20.0
 
-def fingerprint(content: str) -> str:
-    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+FETCH_SECONDS = histogram("crawler_fetch_seconds", "Round trip of one HTTP attempt")
+FETCH_RESPONSES = counter("crawler_fetch_responses_total", "HTTP attempts by status code ('error' for transport errors)",
+                          ("status",))
+FETCH_RETRIES = counter("crawler_fetch_retries_total", "HTTP attempts that were retries")
+FETCH_BYTES = counter("crawler_fetch_bytes_total", "Response body bytes received")
+QUEUE_DEPTH = gauge("crawler_queue_depth", "Items waiting in a crawl or detection pipeline queue", ("queue",))
+
+def make_client(**kwargs) -> httpx.AsyncClient:
+    """Create the pooled client shared by all fetch workers of a run"""
+    limits = httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                          max_keepalive_connections=HTTP_MAX_KEEPALIVE)
+    return httpx.AsyncClient(limits=limits, **kwargs)
+
+def _overloaded(response: httpx.Response) -> bool:
+    return response.status_code == 429 or response.status_code >= 500
+
+async def request(client: httpx.AsyncClient, url: str, headers: Optional[dict] = None,
+                  stats: Optional[Counter] = None) -> httpx.Response:
+    """GET through the host's adaptive limiter, retrying within the shared retry budget.
+
+    429, 5xx, timeouts and transport errors are retried; the backoff (or the
+    server's Retry-After) is slept outside the concurrency slot. Other 4xx and
+    exhausted retries raise. Status codes and retries are tallied into `stats`.
+    """
+    limiter = get_host_limiters().for_url(url)
+    budget = get_retry_budget()
+    budget.record_attempt()
+    retries = 0
+    while True:
+        retry_after = None
+        async with limiter:
+            started = time.monotonic()
+            try:
+                response = await client.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+            except httpx.RequestError as e:
+                FETCH_SECONDS.observe(time.monotonic() - started)
+                FETCH_RESPONSES.inc(status="error")
+                limiter.on_overload()
+                error = e
+            else:
+                FETCH_SECONDS.observe(time.monotonic() - started)
+                FETCH_RESPONSES.inc(status=response.status_code)
+                FETCH_BYTES.inc(len(response.content))
+                if stats is not None:
+                    stats[response.status_code] += 1
+                if not _overloaded(response):
+                    limiter.on_success(time.monotonic() - started)
+                    if response.status_code >= 400:
+                        response.raise_for_status()  # e.g. a 404: retrying will not help
+                    return response
+                retry_after = parse_retry_after(response.headers.get("retry-after"))
+                limiter.on_overload(retry_after)
+                error = httpx.HTTPStatusError(f"{response.status_code} from {url}", request=response.request,
+                                              response=response)
+        if not budget.try_spend(retries):
+            raise error
+        retries += 1
+        FETCH_RETRIES.inc()
+        if stats is not None:
+            stats["retries"] += 1
+        logger.warning("Retrying %s (%d of %d) after %s", url, retries, budget.per_url, error,
+                       extra={"url": url, "summarize": "retry"})
+        await asyncio.sleep(retry_after if retry_after is not None else backoff_delay(retries))
 
-@retry(wait=wait_exponential(min=1, max=10), stop=stop_after_attempt(5),
-       retry=retry_if_exception_type(httpx.RequestError))
 async def fetch(client: httpx.AsyncClient, url: str) -> str:
-    r = await client.get(url, timeout=20.0)
-    r.raise_for_status()
+    r = await request(client, url)
     return r.text
 
-async def store_book(doc: dict):
+def conditional_headers(validators: Optional[dict]) -> dict:
+    """Build If-None-Match / If-Modified-Since headers from stored validators"""
+    headers = {}
+    if not validators:
+        return headers
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+def extract_validators(response: httpx.Response) -> dict:
+    """Pick the cache validators we persist with each book document"""
+    content_length = response.headers.get("content-length")
+    return {
+        "etag": response.headers.get("etag"),
+        "last_modified": response.headers.get("last-modified"),
+        "content_length": int(content_length) if content_length and content_length.isdigit() else None,
+    }
+
+async def fetch_conditional(client: httpx.AsyncClient, url: str, validators: Optional[dict] = None,
+                            stats: Optional[Counter] = None) -> Tuple[Optional[str], Optional[dict]]:
+    """Revalidate a page against its stored validators.
+
+    Returns (None, validators) when the server answers 304 Not Modified, otherwise
+    the new body and the validators of the fresh response. Response status codes
+    are tallied into `stats` when given.
+    """
+    r = await request(client, url, conditional_headers(validators), stats)
+    if r.status_code == 304:
+        return None, validators
+    return r.text, extract_validators(r)
+
+def log_fetch_stats(run: str, stats: Counter):
+    """Log how many revisits were answered with 304 vs a full 200 body, and how many were retried"""
+    others = sum(n for code, n in stats.items() if isinstance(code, int) and code not in (200, 304))
+    logger.info("%s fetch stats: 200=%d, 304=%d, other=%d, retries=%d",
+                run, stats.get(200, 0), stats.get(304, 0), others, stats.get("retries", 0))
+    logger.info("%s host limits: %s", run, get_host_limiters().snapshot())
+
+def alert_new_book(doc: dict):
+    msg = f"New book discovered:\n"
+    msg += f"Title: {doc.get('title', 'Unknown Title')}\n"
+    msg += f"Category: {doc.get('category', 'Unknown Category')}\n"
+    msg += f"Price: £{doc.get('price_including_tax', 0.0):.2f}\n"
+    msg += f"URL: {doc['source_url']}"
+    # a first crawl adds every book in the catalogue
+    logger.alert("New Book Added", msg, level="info", extra={"url": doc["source_url"], "summarize": "new_book"})
+
+async def _store_snapshot(doc: dict):
+    """Move an embedded raw_html_snapshot into the snapshot store, leaving only its reference"""
+    html = doc.pop("raw_html_snapshot", None)
+    if html:
+        doc["snapshot_ref"] = await get_snapshot_store().put(html)
+
+async def store_book(doc: dict, writer: Optional[BulkWriter] = None, facets: Optional[BulkWriter] = None,
+                     history: Optional[BulkWriter] = None):
     # upsert by source_url
+    await _store_snapshot(doc)
     doc["crawl_timestamp"] = datetime.now(timezone.utc)
-    result = await db.books.update_one(
-        {"source_url": doc["source_url"]},
-        {"$set": doc, "$setOnInsert": {"created_at": datetime.now(timezone.utc)}},
-        upsert=True
-    )
+    query = {"source_url": doc["source_url"]}
+    update = {"$set": doc, "$setOnInsert": {"created_at": datetime.now(timezone.utc)}}
+    if "snapshot_ref" in doc:
+        # drop a legacy embedded snapshot on re-stored books
+        update["$unset"] = {"raw_html_snapshot": ""}
+    async def on_insert(_id):
+        alert_new_book(doc)
+        await update_facets(facets, None, doc)
+        # the first point of the book's price history
+        await record_history(history, doc, doc["crawl_timestamp"])
+
+    if writer is not None:
+        # the alert fires once the buffered upsert is flushed and turns out to be an insert
+        await writer.add(UpdateOne(query, update, upsert=True), on_insert=on_insert, key=doc["source_url"])
+        return
+
+    result = await db.books.update_one(query, update, upsert=True)
     
     # Check if this was a new book (upserted)
     if result.upserted_id:
-        msg = f"New book discovered:\n"
-        msg += f"Title: {doc.get('title', 'Unknown Title')}\n"
-        msg += f"Category: {doc.get('category', 'Unknown Category')}\n"
-        msg += f"Price: £{doc.get('price_including_tax', 0.0):.2f}\n"
-        msg += f"URL: {doc['source_url']}"
-        logger.alert("New Book Added", msg, level="info")
-
-async def fetch_book_and_store(client: httpx.AsyncClient, book_url: str, sem: asyncio.Semaphore):
-    max_retries = 3
-    retry_delay = 5  # seconds
-    
-    for attempt in range(max_retries):
-        async with sem:
-            try:
-                html = await fetch(client, book_url)
-                parsed = parse_book_page(html, book_url)
-                fp = fingerprint(html)
-                parsed["fingerprint"] = fp
-                parsed["raw_html_snapshot"] = html
-                
-                # check existing fingerprint
-                existing = await db.books.find_one({"source_url": book_url}, {"fingerprint": 1})
-                if existing and existing.get("fingerprint") == fp:
-                    # update crawl timestamp only
-                    await db.books.update_one({"source_url": book_url}, {"$set": {"crawl_timestamp": datetime.now(timezone.utc)}})
-                    return
-                
-                await store_book(parsed)
-                return  # Success, exit the retry loop
-                
-            except Exception as e:
-                if attempt < max_retries - 1:
-                    logger.warning("Failed to process book: %s, attempt %d of %d. Error: %s", 
-                                 book_url, attempt + 1, max_retries, str(e))
-                    await asyncio.sleep(retry_delay * (attempt + 1))  # Exponential backoff
-                else:
-                    logger.error("Failed to process book after %d attempts: %s, %s", 
-                               max_retries, book_url, str(e))
-                    raise  # Re-raise the last exception after all retries are exhausted
+        await on_insert(result.upserted_id)
+
+async def update_book(doc: dict, writer: Optional[BulkWriter] = None, facets: Optional[BulkWriter] = None,
+                      history: Optional[BulkWriter] = None) -> list:
+    """Write only the fields of a known book that changed; returns their names"""
+    projection = {field: 1 for field in FINGERPRINT_FIELDS}
+    projection["field_hashes"] = 1
+    old_doc = await db.books.find_one({"source_url": doc["source_url"]}, projection)
+    if old_doc is None:
+        await store_book(doc, writer, facets, history)
+        return list(FINGERPRINT_FIELDS)
+
+    changed, fields = delta_update(old_doc, doc)
+    fields["validators"] = doc.get("validators")
+    unset = None
+    if changed:
+        await _store_snapshot(doc)
+        if "snapshot_ref" in doc:
+            fields["snapshot_ref"] = doc["snapshot_ref"]
+            unset = ["raw_html_snapshot"]
+    await touch_book(doc["source_url"], fields, writer, unset)
+    await update_facets(facets, old_doc, doc)
+    if touches_history(changed):
+        await record_history(history, doc)
+    return changed
+
+async def touch_book(book_url: str, fields: dict, writer: Optional[BulkWriter] = None,
+                     unset: Optional[list] = None):
+    """$set fields (validators, changed values) on a known book along with its crawl timestamp"""
+    update = {"$set": {"crawl_timestamp": datetime.now(timezone.utc), **fields}}
+    if unset:
+        update["$unset"] = {field: "" for field in unset}
+    if writer is not None:
+        await writer.add(UpdateOne({"source_url": book_url}, update), key=book_url)
+    else:
+        await db.books.update_one({"source_url": book_url}, update)
+
+async def fetch_book_and_store(client: httpx.AsyncClient, book_url: str, stats: Optional[Counter] = None,
+                               writer: Optional[BulkWriter] = None, index: Optional[FingerprintIndex] = None,
+                               facets: Optional[BulkWriter] = None, history: Optional[BulkWriter] = None):
+    """Fetch, parse and store one book; fetch retries come from the shared budget in `request`"""
+    try:
+        # stored fingerprint and validators for a conditional revisit
+        if index is not None:
+            existing = index.get(book_url)
+        else:
+            existing = await db.books.find_one({"source_url": book_url}, {"fingerprint": 1, "validators": 1})
+        validators = existing.get("validators") if existing else None
+        html, validators = await fetch_conditional(client, book_url, validators, stats)
+        if html is None:
+            # 304 Not Modified: nothing to hash, parse or rewrite
+            await touch_book(book_url, {}, writer)
+            return
+
+        # parsed and fingerprinted off the event loop
+        parsed = await get_parse_pool().parse_book(html, book_url)
+        fp = parsed["fingerprint"]
+        if existing and existing.get("fingerprint") == fp:
+            # update crawl timestamp (and possibly rotated validators) only
+            await touch_book(book_url, {"validators": validators}, writer)
+            if index is not None:
+                index.put(book_url, fp, validators)
+            return
+
+        parsed["validators"] = validators
+        parsed["raw_html_snapshot"] = html
+
+        if existing or index is not None:
+            # known book: $set only the fields that changed. An index miss may still be a stored book
+            # (another worker or the detector got there first): update_book looks before it inserts
+            await update_book(parsed, writer, facets, history)
+        else:
+            await store_book(parsed, writer, facets, history)
+        if index is not None:
+            index.put(book_url, fp, validators)
+    except Exception as e:
+        logger.error("Failed to process book: %s, %s", book_url, str(e))
+        raise
 
 async def get_crawler_state():
     """Retrieve the last known state of the crawler"""
     state = await db.crawler_state.find_one({"crawler_id": "main"})
     return state
 
-async def save_crawler_state(next_url: str, completed_urls: list):
-    """Save the current state of the crawler"""
+async def save_crawler_state(next_url: Optional[str]):
+    """Save the listing page to resume from; per-book progress lives in crawl_urls"""
     await db.crawler_state.update_one(
         {"crawler_id": "main"},
         {
             "$set": {
                 "last_page_url": next_url,
-                "completed_urls": completed_urls,
                 "updated_at": datetime.now(timezone.utc)
-            }
+            },
+            "$unset": {"completed_urls": ""},  # the pre-checkpoint state format
         },
         upsert=True
     )
 
-async def crawl_all():
-    async with httpx.AsyncClient() as client:
-        sem = asyncio.Semaphore(CONCURRENCY)
-        completed_urls = []
+_DONE = object()  # frontier sentinel, one per book worker
+
+async def _discover(client: httpx.AsyncClient, next_url: Optional[str], frontier: asyncio.Queue,
+                    checkpoint: CrawlCheckpoint, seen: set, unfinished: list, workers: int):
+    """Walk the listing pages, feeding unseen book URLs into the bounded frontier as they are found.
+
+    URLs left unfinished by an interrupted crawl go first.
+    """
+    for book_url in unfinished:
+        await frontier.put(book_url)
+    while next_url:
+        logger.info("Fetching page: %s", next_url)
+        page_html = await fetch(client, next_url)
+        book_urls, following_url = await get_parse_pool().parse_listing(page_html, next_url)
+
+        for book_url in book_urls:
+            if book_url not in seen:  # Skip already processed books
+                seen.add(book_url)
+                await checkpoint.discovered(book_url)
+                # blocks while the frontier is full, so discovery never runs far ahead of the workers
+                await frontier.put(book_url)
+                QUEUE_DEPTH.set(frontier.qsize(), queue="frontier")
+
+        # the page's books must be on record as pending before the crawl may resume past it
+        await checkpoint.flush()
+        await save_crawler_state(next_url)
+        next_url = following_url
+    for _ in range(workers):
+        await frontier.put(_DONE)
+
+async def _book_worker(client: httpx.AsyncClient, frontier: asyncio.Queue, stats: Counter,
+                       books_writer: BulkWriter, index: FingerprintIndex, facets_writer: BulkWriter,
+                       history_writer: BulkWriter, checkpoint: CrawlCheckpoint):
+    while True:
+        book_url = await frontier.get()
+        QUEUE_DEPTH.set(frontier.qsize(), queue="frontier")
+        if book_url is _DONE:
+            return
+        try:
+            await fetch_book_and_store(client, book_url, stats, books_writer, index, facets_writer, history_writer)
+        except Exception as e:
+            # already logged by fetch_book_and_store; a resumed crawl retries it
+            stats["failed"] += 1
+            await checkpoint.failed(book_url, e)
+        else:
+            await checkpoint.done(book_url)
+
+async def crawl_all(concurrency: Optional[int] = None):
+    """Crawl the whole catalogue.
+
+    Listing-page discovery feeds a bounded frontier queue that `concurrency` book
+    workers drain as it fills, so books are fetched from the first listing page
+    on and memory does not grow with the size of the catalogue. How many of their
+    requests are in flight is up to the host's adaptive limiter. Each book's
+    progress is checkpointed in crawl_urls; an interrupted crawl resumes from the
+    last listing page and re-queues the books it had not finished.
+    """
+    # enough workers for the adaptive limit to grow into
+    concurrency = concurrency or CRAWL_MAX_CONCURRENCY
+    await ensure_facets()
+    # books_writer exits (and flushes) first: its insert callbacks still feed facets_writer and history_writer
+    bump = lambda: bump_generation(db.meta)  # tell API caches the catalog moved on
+    async with log_context(crawl_id=new_id()), parse_pool_run(), make_client() as client, \
+            BulkWriter(db.book_facets, on_flush=bump) as facets_writer, \
+            BulkWriter(db.price_history, on_flush=bump) as history_writer, \
+            BulkWriter(db.books, on_flush=bump) as books_writer, \
+            CrawlCheckpoint(db.crawl_urls, books_writer) as checkpoint:
+        stats = Counter()
+        index = await FingerprintIndex.load(db.books)
 
         # Try to resume from last state
         state = await get_crawler_state()
-        next_url = state.get("last_page_url") if state else BASE
-        if state and state.get("completed_urls"):
-            completed_urls = state["completed_urls"]
-            logger.info("Resuming crawl from page: %s", next_url)
+        if state and state.get("last_page_url"):
+            next_url = state["last_page_url"]
+            seen, unfinished = await checkpoint.load()
+            for book_url in state.get("completed_urls") or []:
+                # a crawl interrupted before per-URL checkpoints: its queued books may not have run
+                if book_url not in seen:
+                    seen.add(book_url)
+                    unfinished.append(book_url)
+            logger.info("Resuming crawl from page: %s with %d unfinished books", next_url, len(unfinished))
         else:
-            next_url = BASE
+            next_url, seen, unfinished = BASE, set(), []
+            await checkpoint.reset()
             logger.info("Starting new crawl from beginning")
 
-        tasks = []
+        frontier = asyncio.Queue(maxsize=max(CRAWL_QUEUE_SIZE, concurrency))
+        tasks = [asyncio.create_task(_discover(client, next_url, frontier, checkpoint, seen, unfinished, concurrency))]
+        tasks += [asyncio.create_task(_book_worker(client, frontier, stats, books_writer, index, facets_writer,
+                                                   history_writer, checkpoint))
+                  for _ in range(concurrency)]
         try:
-            while next_url:
-                logger.info("Fetching page: %s", next_url)
-                page_html = await fetch(client, next_url)
-                soup = BeautifulSoup(page_html, "lxml")
-                
-                # extract all book links from page
-                for a in soup.select("article.product_pod h3 a"):
-                    rel = a["href"]
-                    book_url = urljoin(next_url, rel)
-                    if book_url not in completed_urls:  # Skip already processed books
-                        tasks.append(fetch_book_and_store(client, book_url, sem))
-                        completed_urls.append(book_url)
-                
-                # Save state after processing each page
-                await save_crawler_state(next_url, completed_urls)
-                
-                # find next page link
-                next_link = soup.select_one("li.next a")
-                if next_link:
-                    next_url = urljoin(next_url, next_link["href"])
-                else:
-                    next_url = None
-            
-            # Wait for all book processing tasks to complete
+            # Wait for discovery and every book worker to finish, then for their writes to land
             await asyncio.gather(*tasks)
+            await books_writer.flush()
+            await checkpoint.flush()
+            await facets_writer.flush()
+            await history_writer.flush()
             
             # Clear the state after successful completion
-            await save_crawler_state(None, [])
+            await save_crawler_state(None)
+            log_fetch_stats("Crawl", stats)
+            index.log_stats()
+            if stats["failed"]:
+                logger.warning("%d books failed; see crawl_urls with status 'failed'", stats["failed"])
             logger.info("Crawl completed successfully")
             
         except Exception as e:
             logger.error("Crawl interrupted: %s", str(e))
             # State is already saved, so we can resume from here next time
             raise
+        finally:
+            # a failed listing page stops the book workers rather than leaving them orphaned
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
 
 if __name__ == "__main__":
-    asyncio.run(crawl_all())
+    asyncio.run(dumps_metrics(crawl_all)())
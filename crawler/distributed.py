@@ -0,0 +1,243 @@
+"""Distributed crawl: a Mongo-backed lease queue shared by any number of worker processes.
+
+Discovery walks the listing pages and enqueues book URLs in `crawl_queue` (one
+document per URL, as in crawl_urls). Workers, on this host or others, claim
+URLs in batches with update_many, which stamps a lease owner and expiry. They run
+the usual fetch/parse/store path and mark each URL done or failed; failed URLs
+are claimed again until CRAWL_MAX_ATTEMPTS. A worker that dies leaves its leases
+to expire, and they are then claimed again by the others.
+
+    python -m crawler.distributed discover
+    python -m crawler.distributed work --concurrency 16     # as many as you like, anywhere
+    python -m crawler.distributed run --workers 4           # discovery plus 4 local workers
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+from collections import Counter, deque
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+import httpx
+from dotenv import load_dotenv
+from db.client import db
+from db.bulk import BulkWriter
+from db.facets import ensure_facets
+from db.generation import bump_generation
+from utils.logger import log_context, logger, new_id
+from utils.metrics import dumps_metrics
+from .checkpoint import CRAWL_MAX_ATTEMPTS, FAILED, LEASED, PENDING, CrawlCheckpoint
+from .crawler import BASE, fetch, fetch_book_and_store, log_fetch_stats, make_client
+from .index import FingerprintIndex
+from .parse_pool import PARSE_WORKERS, get_parse_pool, parse_pool_run, set_parse_workers
+from .throttle import CONCURRENCY, CRAWL_MAX_CONCURRENCY
+
+load_dotenv()
+
+CRAWL_LEASE_SECONDS = float(os.getenv("CRAWL_LEASE_SECONDS", "300"))
+CRAWL_CLAIM_BATCH = int(os.getenv("CRAWL_CLAIM_BATCH", str(CONCURRENCY)))
+CRAWL_QUEUE_POLL = float(os.getenv("CRAWL_QUEUE_POLL", "2.0"))  # seconds between claims on an empty queue
+
+STATE_ID = "distributed"
+
+class LeaseQueue:
+    """Claims on crawl_queue documents; statuses otherwise go through CrawlCheckpoint"""
+
+    def __init__(self, collection, lease_seconds: float = CRAWL_LEASE_SECONDS, max_leases: int = CRAWL_MAX_ATTEMPTS,
+                 max_attempts: int = CRAWL_MAX_ATTEMPTS):
+        self.collection = collection
+        self.lease_seconds = lease_seconds
+        self.max_leases = max_leases
+        self.max_attempts = max_attempts
+
+    def _retryable(self) -> dict:
+        # failed URLs go round again, as CrawlCheckpoint.load re-queues them, while attempts and leases are left
+        return {"status": FAILED, "attempts": {"$lt": self.max_attempts}, "leases": {"$lt": self.max_leases}}
+
+    async def claim(self, worker_id: str, n: int) -> List[str]:
+        """Lease up to `n` URLs: pending ones first, then expired leases, then failed ones worth retrying.
+
+        Each kind costs one find of candidates and one update_many that tags the
+        ones still claimable; a candidate another worker took meanwhile no longer
+        matches. A last find returns the URLs this claim's tag won.
+        """
+        now = datetime.now(timezone.utc)
+        await self.reap(now)
+        claim_id = new_id()
+        lease = {"$set": {"status": LEASED, "lease_owner": worker_id, "claim_id": claim_id,
+                          "lease_expires": now + timedelta(seconds=self.lease_seconds)},
+                 "$inc": {"leases": 1}}
+        won = 0
+        for query, sort in (({"status": PENDING}, [("discovered_at", 1)]),
+                            ({"status": LEASED, "lease_expires": {"$lt": now}}, [("lease_expires", 1)]),
+                            (self._retryable(), [("updated_at", 1)])):
+            if won >= n:
+                break
+            cursor = self.collection.find(query, {"_id": 1}).sort(sort).limit(n - won)
+            candidates = [doc["_id"] async for doc in cursor]
+            if candidates:
+                result = await self.collection.update_many({**query, "_id": {"$in": candidates}}, lease)
+                won += result.modified_count
+        if not won:
+            return []
+        return [doc["_id"] async for doc in self.collection.find({"claim_id": claim_id}, {"_id": 1})]
+
+    async def reap(self, now: datetime):
+        """Give up on URLs whose leases keep expiring: they take their worker down with them"""
+        await self.collection.update_many(
+            {"status": LEASED, "lease_expires": {"$lt": now}, "leases": {"$gte": self.max_leases}},
+            {"$set": {"status": FAILED, "error": f"lease expired {self.max_leases} times", "updated_at": now},
+             "$unset": {"lease_owner": "", "lease_expires": "", "claim_id": ""}})
+
+    async def active(self) -> int:
+        """URLs still pending, leased or due a retry"""
+        return await self.collection.count_documents({"$or": [{"status": {"$in": [PENDING, LEASED]}},
+                                                              self._retryable()]})
+
+    async def failed(self) -> int:
+        """URLs given up on"""
+        return await self.collection.count_documents({"status": FAILED})
+
+async def get_discovery_state() -> Optional[dict]:
+    return await db.crawler_state.find_one({"crawler_id": STATE_ID})
+
+async def save_discovery_state(**fields):
+    await db.crawler_state.update_one(
+        {"crawler_id": STATE_ID}, {"$set": {**fields, "updated_at": datetime.now(timezone.utc)}}, upsert=True)
+
+async def begin_discovery() -> str:
+    """The listing page to discover from: where an interrupted discovery stopped, else a fresh start"""
+    state = await get_discovery_state()
+    if state and not state.get("discovery_done") and state.get("last_page_url"):
+        logger.info("Resuming discovery from page: %s", state["last_page_url"])
+        return state["last_page_url"]
+    if not state or state.get("discovery_done"):
+        # a new crawl: forget the previous one's URLs, and keep workers waiting for the new ones
+        await db.crawl_queue.delete_many({})
+        await save_discovery_state(last_page_url=None, discovery_done=False)
+    return BASE
+
+async def discover(client: Optional[httpx.AsyncClient] = None):
+    """Enqueue every book of the catalogue; resumes an interrupted discovery"""
+    next_url = await begin_discovery()
+    owned = client is None
+    client = client or make_client()
+    try:
+        async with parse_pool_run(), CrawlCheckpoint(db.crawl_queue) as checkpoint:
+            while next_url:
+                page_html = await fetch(client, next_url)
+                book_urls, following_url = await get_parse_pool().parse_listing(page_html, next_url)
+                for book_url in book_urls:
+                    # an upsert on _id: a URL linked twice is queued once
+                    await checkpoint.discovered(book_url)
+                await checkpoint.flush()
+                await save_discovery_state(last_page_url=next_url)
+                next_url = following_url
+    finally:
+        if owned:
+            await client.aclose()
+    await save_discovery_state(last_page_url=None, discovery_done=True)
+    logger.info("Discovery completed")
+
+async def _finished(queue: LeaseQueue) -> bool:
+    state = await get_discovery_state()
+    return bool(state and state.get("discovery_done")) and await queue.active() == 0
+
+async def run_worker(worker_id: Optional[str] = None, concurrency: Optional[int] = None,
+                     client: Optional[httpx.AsyncClient] = None, poll: float = CRAWL_QUEUE_POLL) -> Counter:
+    """Claim and crawl books until discovery is done and nothing is pending or leased"""
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    # enough coroutines for the adaptive limit to grow into, as in crawl_all
+    concurrency = concurrency or CRAWL_MAX_CONCURRENCY
+    queue = LeaseQueue(db.crawl_queue)
+    stats = Counter()
+    claimed = deque()
+    claim_lock = asyncio.Lock()
+
+    async def next_url(checkpoint) -> Optional[str]:
+        async with claim_lock:
+            while not claimed:
+                urls = await queue.claim(worker_id, max(CRAWL_CLAIM_BATCH, 1))
+                if urls:
+                    claimed.extend(urls)
+                    continue
+                # our own buffered "done"s would otherwise keep the queue active forever
+                await checkpoint.flush()
+                if await _finished(queue):
+                    return None
+                await asyncio.sleep(poll)
+            return claimed.popleft()
+
+    async def work(books_writer, facets_writer, history_writer, checkpoint, index):
+        while (book_url := await next_url(checkpoint)) is not None:
+            try:
+                await fetch_book_and_store(client, book_url, stats, books_writer, index, facets_writer,
+                                           history_writer)
+            except Exception as e:
+                stats["failed"] += 1
+                await checkpoint.failed(book_url, e)
+            else:
+                stats["books"] += 1
+                await checkpoint.done(book_url)
+
+    await ensure_facets()
+    owned = client is None
+    client = client or make_client()
+    bump = lambda: bump_generation(db.meta)  # tell API caches the catalog moved on
+    try:
+        async with log_context(worker_id=worker_id), parse_pool_run(), \
+                BulkWriter(db.book_facets, on_flush=bump) as facets_writer, \
+                BulkWriter(db.price_history, on_flush=bump) as history_writer, \
+                BulkWriter(db.books, on_flush=bump) as books_writer, \
+                CrawlCheckpoint(db.crawl_queue, books_writer) as checkpoint:
+            index = await FingerprintIndex.load(db.books)
+            logger.info("Worker %s started", worker_id)
+            await asyncio.gather(*(work(books_writer, facets_writer, history_writer, checkpoint, index)
+                                   for _ in range(concurrency)))
+    finally:
+        if owned:
+            await client.aclose()
+    log_fetch_stats(f"Worker {worker_id}", stats)
+    logger.info("Worker %s done: %d books, %d failed", worker_id, stats["books"], stats["failed"])
+    given_up = await queue.failed()
+    if given_up:
+        logger.warning("%d books failed for good; see crawl_queue with status 'failed'", given_up)
+    return stats
+
+def _worker_process(worker_id: str, concurrency: Optional[int], parse_workers: int):
+    set_parse_workers(parse_workers)
+    asyncio.run(run_worker(worker_id, concurrency))
+
+async def run_local(workers: int, concurrency: Optional[int] = None):
+    """Discovery in this process, `workers` worker processes alongside it"""
+    # settle the crawl before the workers start, so none of them sees the last one's queue as finished
+    await begin_discovery()
+    ctx = multiprocessing.get_context("spawn")
+    host = socket.gethostname()
+    # the host's PARSE_WORKERS are shared out, rather than each worker starting a pool that size
+    parse_workers = max(PARSE_WORKERS // max(workers, 1), 1)
+    procs = [ctx.Process(target=_worker_process, args=(f"{host}:local-{n}", concurrency, parse_workers))
+             for n in range(workers)]
+    for proc in procs:
+        proc.start()
+    try:
+        await discover()
+    finally:
+        for proc in procs:
+            await asyncio.to_thread(proc.join)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Crawl with a Mongo-backed work queue")
+    parser.add_argument("mode", choices=["discover", "work", "run"])
+    parser.add_argument("--id", help="worker id (default host:pid)")
+    parser.add_argument("--concurrency", type=int, help="books in flight per worker")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="local workers for 'run'")
+    args = parser.parse_args()
+    if args.mode == "discover":
+        asyncio.run(dumps_metrics(discover)())
+    elif args.mode == "work":
+        asyncio.run(dumps_metrics(run_worker)(args.id, args.concurrency))
+    else:
+        # only this process dumps: the local workers would overwrite one METRICS_DUMP file
+        asyncio.run(dumps_metrics(run_local)(args.workers, args.concurrency))
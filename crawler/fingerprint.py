@@ -0,0 +1,81 @@
+import hashlib
+import os
+from typing import Dict, List, Optional, Tuple
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Any hashlib algorithm name; blake2b is the fastest pure-CPU choice here
+FINGERPRINT_HASH = os.getenv("FINGERPRINT_HASH", "blake2b")
+
+# Parsed fields that make up a book's fingerprint, in hashing order
+FINGERPRINT_FIELDS = (
+    "title",
+    "description",
+    "category",
+    "price_including_tax",
+    "price_excluding_tax",
+    "availability",
+    "num_reviews",
+    "image_url",
+    "rating",
+)
+
+def _new_hash(digest_size: int = 32):
+    if FINGERPRINT_HASH == "blake2b":
+        return hashlib.blake2b(digest_size=digest_size)
+    return hashlib.new(FINGERPRINT_HASH)
+
+# fail at import time rather than on the first book
+_new_hash()
+
+def normalize(value) -> str:
+    """Canonical text for a parsed value so markup-only noise hashes identically"""
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        return f"{value:.2f}"
+    return " ".join(str(value).split())
+
+def field_hashes(doc: dict) -> Dict[str, str]:
+    """Short per-field hashes used to work out which fields changed"""
+    hashes = {}
+    for field in FINGERPRINT_FIELDS:
+        h = _new_hash(8)
+        h.update(normalize(doc.get(field)).encode("utf-8"))
+        hashes[field] = h.hexdigest()[:16]
+    return hashes
+
+def fingerprint(doc: dict) -> str:
+    """Fingerprint of the normalized parsed fields (not of the raw HTML)"""
+    h = _new_hash()
+    for field in FINGERPRINT_FIELDS:
+        h.update(field.encode("utf-8"))
+        h.update(b"=")
+        h.update(normalize(doc.get(field)).encode("utf-8"))
+        h.update(b"\x1f")
+    return h.hexdigest()
+
+def changed_fields(old_doc: Optional[dict], new_hashes: Dict[str, str]) -> List[str]:
+    """Fields whose hash differs from the stored document.
+
+    Documents written before per-field hashes existed are hashed from their stored values.
+    """
+    if not old_doc:
+        return list(FINGERPRINT_FIELDS)
+    old_hashes = old_doc.get("field_hashes") or field_hashes(old_doc)
+    return [f for f in FINGERPRINT_FIELDS if old_hashes.get(f) != new_hashes[f]]
+
+def delta_update(old_doc: Optional[dict], parsed: dict) -> Tuple[List[str], dict]:
+    """Return the changed fields and the `$set` document that writes only those.
+
+    The fingerprint and field hashes are always part of the `$set`, so a legacy
+    document whose fingerprint format changed but whose fields did not is
+    migrated silently.
+    """
+    hashes = parsed.get("field_hashes") or field_hashes(parsed)
+    changed = changed_fields(old_doc, hashes)
+    update = {field: parsed.get(field) for field in changed}
+    update["fingerprint"] = parsed.get("fingerprint") or fingerprint(parsed)
+    update["field_hashes"] = hashes
+    return changed, update
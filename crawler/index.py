@@ -0,0 +1,102 @@
+import hashlib
+from typing import Dict, Optional
+from utils.logger import logger
+
+_SEP = b"\x1f"
+_DIGEST_BYTES = 32  # sha256 / blake2b-256 fingerprints
+# every entry starts with one of these: a raw digest may begin with any byte value
+_DIGEST = b"\x01"
+_VERBATIM = b"\x00"
+
+class FingerprintIndex:
+    """Compact in-memory `source_url -> (fingerprint, validators)` map.
+
+    Loaded with one projected cursor at the start of a crawl so the per-book
+    "did it change?" decision never has to ask Mongo. URLs are keyed by a
+    12-byte blake2b digest and each value is a single bytes object holding the
+    raw fingerprint digest plus the validators, about 200 bytes per book.
+    """
+
+    KEY_BYTES = 12
+
+    def __init__(self):
+        self._entries: Dict[bytes, bytes] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    async def load(cls, collection) -> "FingerprintIndex":
+        index = cls()
+        cursor = collection.find({}, {"_id": 0, "source_url": 1, "fingerprint": 1, "validators": 1})
+        async for doc in cursor:
+            index.put(doc["source_url"], doc.get("fingerprint"), doc.get("validators"))
+        logger.info("Loaded fingerprint index with %d entries", len(index))
+        return index
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, url: str) -> bool:
+        return self._key(url) in self._entries
+
+    @classmethod
+    def _key(cls, url: str) -> bytes:
+        return hashlib.blake2b(url.encode("utf-8"), digest_size=cls.KEY_BYTES).digest()
+
+    @staticmethod
+    def _pack(fp: Optional[str], validators: Optional[dict]) -> bytes:
+        # one bytes object per entry: fingerprint and validators joined by a unit separator
+        try:
+            packed_fp = bytes.fromhex(fp) if fp else b""
+        except ValueError:
+            packed_fp = b""
+        if len(packed_fp) == _DIGEST_BYTES:
+            packed_fp = _DIGEST + packed_fp
+        else:
+            # missing or not a 256-bit hex digest: keep it verbatim
+            packed_fp = _VERBATIM + (fp or "").encode("utf-8")
+        validators = validators or {}
+        parts = [
+            packed_fp,
+            (validators.get("etag") or "").encode("utf-8"),
+            (validators.get("last_modified") or "").encode("utf-8"),
+            str(validators.get("content_length") or "").encode("ascii"),
+        ]
+        return _SEP.join(parts) if any(parts[1:]) else packed_fp
+
+    @staticmethod
+    def _unpack(packed: bytes) -> dict:
+        # hex digests are fixed-length raw bytes and may contain the separator themselves
+        if packed[:1] == _VERBATIM:
+            packed_fp, _, rest = packed[1:].partition(_SEP)
+            fp = packed_fp.decode("utf-8") or None
+        else:
+            packed_fp, rest = packed[1:_DIGEST_BYTES + 1], packed[_DIGEST_BYTES + 2:]
+            fp = packed_fp.hex()
+        validators = None
+        if rest:
+            etag, last_modified, content_length = rest.decode("utf-8").split(_SEP.decode())
+            validators = {
+                "etag": etag or None,
+                "last_modified": last_modified or None,
+                "content_length": int(content_length) if content_length else None,
+            }
+        return {"fingerprint": fp, "validators": validators}
+
+    def put(self, url: str, fp: Optional[str], validators: Optional[dict] = None):
+        """Record the fingerprint and validators of a book that was just written"""
+        self._entries[self._key(url)] = self._pack(fp, validators)
+
+    def get(self, url: str) -> Optional[dict]:
+        """Return `{"fingerprint", "validators"}` for a known URL, counting hits and misses"""
+        packed = self._entries.get(self._key(url))
+        if packed is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self._unpack(packed)
+
+    def log_stats(self):
+        total = self.hits + self.misses
+        logger.info("Fingerprint index: %d entries, %d hits, %d misses (%.1f%% hit rate)",
+                    len(self), self.hits, self.misses, 100.0 * self.hits / total if total else 0.0)
@@ -18,7 +18,8 @@ class Book(BaseModel):
     crawl_timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     status: str = "fetched"
     fingerprint: Optional[str] = None
-    raw_html_snapshot: Optional[str] = None
+    snapshot_ref: Optional[str] = None  # key in the snapshot store (db.snapshots)
+    raw_html_snapshot: Optional[str] = None  # legacy embedded snapshot, see db.migrate_snapshots
 
 
     class Config:
@@ -0,0 +1,187 @@
+"""Parse stage shared by the crawler and the change detector.
+
+Parsing a page and hashing it is pure CPU work; run on the event loop it stalls
+every in-flight request. `ParsePool` hands pages to a process (or thread) pool
+instead. While every worker is busy, new pages queue up and go out together as
+one batch when a worker frees up, so under load each round trip to a worker
+process carries up to PARSE_BATCH_SIZE pages, and an idle pool adds no delay.
+Runs hold the pool through `parse_pool_run()`, which shuts it down after them.
+"""
+import asyncio
+import multiprocessing
+import os
+import time
+from collections import Counter
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import List, Optional, Tuple
+from dotenv import load_dotenv
+from .fingerprint import field_hashes, fingerprint
+from .parser import parse_book_page, parse_listing_page, parse_listing_summaries
+from utils.metrics import gauge, get_registry, histogram
+
+load_dotenv()
+
+# "process" (default), "thread" or "inline" (on the event loop, as before)
+PARSE_EXECUTOR = os.getenv("PARSE_EXECUTOR", "process")
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", str(os.cpu_count() or 1)))
+PARSE_BATCH_SIZE = int(os.getenv("PARSE_BATCH_SIZE", "16"))
+
+BOOK, LISTING, SUMMARIES = "book", "listing", "summaries"
+
+PARSE_SECONDS = histogram("crawler_parse_seconds", "CPU time to parse (and fingerprint) one page, by page kind",
+                          ("kind",))
+PARSE_PENDING = gauge("crawler_parse_pending", "Pages waiting for a free parse worker")
+PARSE_BUSY = gauge("crawler_parse_busy_workers", "Parse workers with a batch in flight")
+
+def parse_page(kind: str, html: str, url: str):
+    """The unit of work: a parsed and fingerprinted book, or a listing page's links (or book summaries)"""
+    if kind == LISTING:
+        return parse_listing_page(html, url)
+    if kind == SUMMARIES:
+        return parse_listing_summaries(html, url)
+    parsed = parse_book_page(html, url)
+    parsed["fingerprint"] = fingerprint(parsed)
+    parsed["field_hashes"] = field_hashes(parsed)
+    return parsed
+
+def parse_batch(items: List[Tuple[str, str, str]]) -> list:
+    """Runs in the worker: one (ok, result-or-exception, seconds) triple per item, so one bad page fails alone"""
+    results = []
+    for kind, html, url in items:
+        started = time.perf_counter()
+        try:
+            results.append((True, parse_page(kind, html, url), time.perf_counter() - started))
+        except Exception as e:
+            results.append((False, e, time.perf_counter() - started))
+    return results
+
+class ParsePool:
+    def __init__(self, executor: Optional[Executor] = None, workers: int = 1, batch_size: int = PARSE_BATCH_SIZE):
+        self.executor = executor
+        self.workers = workers
+        self.batch_size = batch_size
+        self._pending: list = []  # (item, future) waiting for a free worker
+        self._in_flight = 0
+        self.stats = Counter()
+
+    async def parse_book(self, html: str, url: str) -> dict:
+        """Parsed book fields plus its fingerprint and field_hashes"""
+        return await self._submit((BOOK, html, url))
+
+    async def parse_listing(self, html: str, url: str) -> Tuple[List[str], Optional[str]]:
+        """Book URLs of a catalogue page and the next page's URL"""
+        return await self._submit((LISTING, html, url))
+
+    async def parse_summaries(self, html: str, url: str) -> Tuple[List[dict], Optional[str]]:
+        """Each book's summary on a catalogue page and the next page's URL"""
+        return await self._submit((SUMMARIES, html, url))
+
+    async def _submit(self, item):
+        if self.executor is None:
+            ok, value, seconds = parse_batch([item])[0]
+            PARSE_SECONDS.observe(seconds, kind=item[0])
+            self.stats["pages"] += 1
+            if not ok:
+                raise value
+            return value
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((item, future))
+        self._dispatch()
+        return await future
+
+    def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while self._pending and self._in_flight < self.workers:
+            batch = [(item, f) for item, f in self._pending[:self.batch_size] if not f.cancelled()]
+            del self._pending[:self.batch_size]
+            if not batch:
+                continue
+            self._in_flight += 1
+            self.stats["batches"] += 1
+            self.stats["pages"] += len(batch)
+            done = loop.run_in_executor(self.executor, parse_batch, [item for item, _ in batch])
+            done.add_done_callback(partial(self._finish, batch))
+
+    def _finish(self, batch, done: asyncio.Future):
+        self._in_flight -= 1
+        try:
+            results = done.result()
+        except Exception as e:
+            # the worker itself failed (e.g. a BrokenProcessPool): every page of the batch fails with it
+            results = [(False, e, None)] * len(batch)
+        for (item, future), (ok, value, seconds) in zip(batch, results):
+            if seconds is not None:
+                PARSE_SECONDS.observe(seconds, kind=item[0])
+            if future.done():
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+        self._dispatch()
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+
+def make_parse_pool(kind: str = PARSE_EXECUTOR, workers: int = PARSE_WORKERS,
+                    batch_size: int = PARSE_BATCH_SIZE) -> ParsePool:
+    if kind == "inline":
+        return ParsePool(None, batch_size=batch_size)
+    if kind == "thread":
+        return ParsePool(ThreadPoolExecutor(workers, thread_name_prefix="parse"), workers, batch_size)
+    if kind == "process":
+        # spawned workers import only the parser, never a forked copy of the loop and the Mongo client threads
+        executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+        return ParsePool(executor, workers, batch_size)
+    raise ValueError(f"Unknown PARSE_EXECUTOR {kind!r}; choose process, thread or inline")
+
+_pool: Optional[ParsePool] = None
+_owned: Optional[ParsePool] = None  # the pool made by get_parse_pool(), which parse_pool_run() shuts down
+_workers = PARSE_WORKERS
+_runs = 0
+
+def set_parse_workers(workers: int):
+    """Size of the pools made from now on, e.g. a share of PARSE_WORKERS per local crawl worker"""
+    global _workers
+    _workers = max(workers, 1)
+
+def get_parse_pool() -> ParsePool:
+    """The process-wide pool, made on first use; its worker processes start on the first submitted batch"""
+    global _pool, _owned
+    if _pool is None:
+        _pool = _owned = make_parse_pool(workers=_workers)
+    return _pool
+
+class parse_pool_run:
+    """Scope of a crawl or detection run: when the last one ends, the pool's workers are shut down.
+
+    The next run makes a fresh pool, so a long-running scheduler holds no idle
+    worker processes between runs; a pool installed from outside is left alone.
+    Works with `with` and `async with`, so it can join a coroutine's other context managers.
+    """
+
+    def __enter__(self):
+        global _runs
+        _runs += 1
+        return get_parse_pool()
+
+    def __exit__(self, *exc):
+        global _pool, _owned, _runs
+        _runs -= 1
+        if not _runs and _owned is not None and _pool is _owned:
+            pool, _pool, _owned = _pool, None, None
+            pool.shutdown()
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, *exc):
+        self.__exit__(*exc)
+
+def _collect_occupancy():
+    PARSE_PENDING.set(len(_pool._pending) if _pool else 0)
+    PARSE_BUSY.set(_pool._in_flight if _pool else 0)
+
+get_registry().on_collect(_collect_occupancy)
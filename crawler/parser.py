@@ -1,11 +1,19 @@
-
 from bs4 import BeautifulSoup
-from typing import Optional, Dict
+from lxml import etree
+from typing import Optional, Dict, List, Tuple
+import os
 import re
 from urllib.parse import urljoin
+from dotenv import load_dotenv
+
+load_dotenv()
 
 BASE = "https://books.toscrape.com/"
 
+# "bs4" (BeautifulSoup + CSS selectors) or "lxml" (compiled XPath over an lxml tree, opt-in until proven on
+# the live site); both are meant to return identical dicts
+PARSER_BACKEND = os.getenv("PARSER_BACKEND", "bs4")
+
 rating_map = {"One":1,"Two":2,"Three":3,"Four":4,"Five":5}
 
 def _to_float(s: str) -> Optional[float]:
@@ -14,7 +22,36 @@ def _to_float(s: str) -> Optional[float]:
     if not m: return None
     return float(m.group(1).replace(",", ""))
 
-def parse_book_page(html: str, url: str) -> Dict:
+def _book(url: str, title, description, cat, table: Dict[str, str], availability_el_text, img_src, rating_classes) -> Dict:
+    """Turn the raw strings either backend extracted into the stored book dict"""
+    p_inc = _to_float(table.get("Price (incl. tax)", ""))
+    p_exc = _to_float(table.get("Price (excl. tax)", ""))
+    availability = table.get("Availability") or availability_el_text
+    num_reviews = int(table.get("Number of reviews", "0") or 0)
+
+    image_url = None
+    if img_src:
+        image_url = urljoin(BASE, img_src) if img_src.startswith("../") or img_src.startswith("./") else urljoin(url, img_src)
+
+    rating = None
+    for c in rating_classes:
+        if c in rating_map:
+            rating = rating_map[c]
+
+    return {
+        "source_url": url,
+        "title": title,
+        "description": description,
+        "category": cat,
+        "price_including_tax": p_inc,
+        "price_excluding_tax": p_exc,
+        "availability": availability,
+        "num_reviews": num_reviews,
+        "image_url": image_url,
+        "rating": rating,
+    }
+
+def parse_book_page_bs4(html: str, url: str) -> Dict:
     soup = BeautifulSoup(html, "lxml")
     title_el = soup.select_one("div.product_main h1")
     title = title_el.get_text(strip=True) if title_el else None
@@ -38,34 +75,211 @@ def parse_book_page(html: str, url: str) -> Dict:
         val = tr.td.get_text(strip=True)
         table[key] = val
 
-    p_inc = _to_float(table.get("Price (incl. tax)", ""))
-    p_exc = _to_float(table.get("Price (excl. tax)", ""))
-    availability = table.get("Availability") or (soup.select_one("p.availability").get_text(strip=True) if soup.select_one("p.availability") else None)
-    num_reviews = int(table.get("Number of reviews", "0") or 0)
-
-    # image url
+    availability_el = soup.select_one("p.availability")
     img_el = soup.select_one("div.carousel img") or soup.select_one("div.item.active img") or soup.select_one("img")
-    image_url = None
-    if img_el and img_el.get("src"):
-        src = img_el["src"]
-        image_url = urljoin(BASE, src) if src.startswith("../") or src.startswith("./") else urljoin(url, src)
-
-    rating = None
     rating_el = soup.select_one("p.star-rating")
-    if rating_el:
-        for c in rating_el.get("class", []):
-            if c in rating_map:
-                rating = rating_map[c]
+    return _book(
+        url, title, description, cat, table,
+        availability_el.get_text(strip=True) if availability_el else None,
+        img_el.get("src") if img_el else None,
+        rating_el.get("class", []) if rating_el else [],
+    )
+
+# --- lxml backend: the same selectors as above, compiled once ---
+
+def _cls(name: str) -> str:
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+_TITLE = etree.XPath(f"(//div[{_cls('product_main')}]//h1)[1]")
+_DESCRIPTION = etree.XPath("(//*[@id='product_description']/following-sibling::p)[1]")
+_CRUMBS = etree.XPath(f"//ul[{_cls('breadcrumb')}]//li//a")
+_TABLE_ROWS = etree.XPath(f"//table[{_cls('table')} and {_cls('table-striped')}]//tr")
+_ROW_TH = etree.XPath("(.//th)[1]")
+_ROW_TD = etree.XPath("(.//td)[1]")
+_AVAILABILITY = etree.XPath(f"(//p[{_cls('availability')}])[1]")
+_IMAGES = [
+    etree.XPath(f"(//div[{_cls('carousel')}]//img)[1]"),
+    etree.XPath(f"(//div[{_cls('item')} and {_cls('active')}]//img)[1]"),
+    etree.XPath("(//img)[1]"),
+]
+_STAR_RATING = etree.XPath(f"(//p[{_cls('star-rating')}])[1]")
+
+# bs4 leaves the contents of these out of get_text()
+_NON_TEXT_TAGS = frozenset(["script", "style", "template"])
+
+def _strings(el, out: List[str]):
+    if el.tag in _NON_TEXT_TAGS:
+        return
+    if el.text:
+        out.append(el.text)
+    for child in el:
+        # comments and processing instructions have a non-str tag; only their tail is text
+        if isinstance(child.tag, str):
+            _strings(child, out)
+        if child.tail:
+            out.append(child.tail)
+
+def _text(el) -> str:
+    """Equivalent of bs4's get_text(strip=True)"""
+    out: List[str] = []
+    _strings(el, out)
+    return "".join(s for s in (s.strip() for s in out) if s)
 
+def _first(xpath, node):
+    found = xpath(node)
+    return found[0] if found else None
+
+def _parse_tree(html):
+    parser = etree.HTMLParser()
+    try:
+        return etree.fromstring(html, parser)
+    except ValueError:
+        # str input carrying an <?xml encoding=...?> declaration
+        return etree.fromstring(html.encode("utf-8"), etree.HTMLParser(encoding="utf-8"))
+
+def parse_book_page_lxml(html: str, url: str) -> Dict:
+    root = _parse_tree(html)
+    if root is None:
+        return _book(url, None, None, None, {}, None, None, [])
+
+    title_el = _first(_TITLE, root)
+    desc_el = _first(_DESCRIPTION, root)
+    crumbs = _CRUMBS(root)
+    cat = _text(crumbs[-1]) if len(crumbs) >= 3 else None
+
+    table = {}
+    for tr in _TABLE_ROWS(root):
+        th, td = _first(_ROW_TH, tr), _first(_ROW_TD, tr)
+        if th is None or td is None:
+            # what tr.th.get_text() raises in the bs4 backend
+            raise AttributeError("'NoneType' object has no attribute 'get_text'")
+        table[_text(th)] = _text(td)
+
+    availability_el = _first(_AVAILABILITY, root)
+    img_el = None
+    for xpath in _IMAGES:
+        img_el = _first(xpath, root)
+        if img_el is not None:
+            break
+    rating_el = _first(_STAR_RATING, root)
+    return _book(
+        url,
+        _text(title_el) if title_el is not None else None,
+        _text(desc_el) if desc_el is not None else None,
+        cat, table,
+        _text(availability_el) if availability_el is not None else None,
+        img_el.get("src") if img_el is not None else None,
+        rating_el.get("class", "").split() if rating_el is not None else [],
+    )
+
+_BACKENDS = {"lxml": parse_book_page_lxml, "bs4": parse_book_page_bs4}
+
+def parse_book_page(html: str, url: str, backend: Optional[str] = None) -> Dict:
+    backend = backend or PARSER_BACKEND
+    try:
+        parse = _BACKENDS[backend]
+    except KeyError:
+        raise ValueError(f"Unknown parser backend {backend!r}; choose one of {sorted(_BACKENDS)}") from None
+    return parse(html, url)
+
+# --- listing (catalogue) pages: book links and the next page ---
+
+_LISTING_LINKS = etree.XPath(f"//article[{_cls('product_pod')}]//h3//a/@href")
+_NEXT_LINK = etree.XPath(f"(//li[{_cls('next')}]//a)[1]/@href")
+
+def parse_listing_page_bs4(html: str, url: str) -> Tuple[List[str], Optional[str]]:
+    soup = BeautifulSoup(html, "lxml")
+    books = [urljoin(url, a["href"]) for a in soup.select("article.product_pod h3 a")]
+    next_link = soup.select_one("li.next a")
+    return books, urljoin(url, next_link["href"]) if next_link else None
+
+def parse_listing_page_lxml(html: str, url: str) -> Tuple[List[str], Optional[str]]:
+    root = _parse_tree(html)
+    if root is None:
+        return [], None
+    next_href = _NEXT_LINK(root)
+    return [urljoin(url, href) for href in _LISTING_LINKS(root)], urljoin(url, next_href[0]) if next_href else None
+
+_LISTING_BACKENDS = {"lxml": parse_listing_page_lxml, "bs4": parse_listing_page_bs4}
+
+def parse_listing_page(html: str, url: str, backend: Optional[str] = None) -> Tuple[List[str], Optional[str]]:
+    """Absolute URLs of the books on a catalogue page, and of the next page (None on the last one)"""
+    backend = backend or PARSER_BACKEND
+    try:
+        parse = _LISTING_BACKENDS[backend]
+    except KeyError:
+        raise ValueError(f"Unknown parser backend {backend!r}; choose one of {sorted(_LISTING_BACKENDS)}") from None
+    return parse(html, url)
+
+# --- listing pages, with what each book's pod shows: cheap change detection compares these ---
+
+SUMMARY_FIELDS = ("title", "price_including_tax", "availability", "rating")
+
+def _summary(url: str, href: str, title, price_text, availability, rating_classes) -> Dict:
+    rating = None
+    for c in rating_classes:
+        if c in rating_map:
+            rating = rating_map[c]
     return {
-        "source_url": url,
+        "source_url": urljoin(url, href),
         "title": title,
-        "description": description,
-        "category": cat,
-        "price_including_tax": p_inc,
-        "price_excluding_tax": p_exc,
+        "price_including_tax": _to_float(price_text or ""),
         "availability": availability,
-        "num_reviews": num_reviews,
-        "image_url": image_url,
         "rating": rating,
     }
+
+def parse_listing_summaries_bs4(html: str, url: str) -> Tuple[List[Dict], Optional[str]]:
+    soup = BeautifulSoup(html, "lxml")
+    books = []
+    for pod in soup.select("article.product_pod"):
+        link = pod.select_one("h3 a")
+        if link is None or not link.has_attr("href"):
+            continue
+        price_el = pod.select_one("p.price_color")
+        availability_el = pod.select_one("p.availability")
+        rating_el = pod.select_one("p.star-rating")
+        books.append(_summary(
+            url, link["href"], link.get("title") or link.get_text(strip=True),
+            price_el.get_text(strip=True) if price_el else None,
+            availability_el.get_text(strip=True) if availability_el else None,
+            rating_el.get("class", []) if rating_el else [],
+        ))
+    next_link = soup.select_one("li.next a")
+    return books, urljoin(url, next_link["href"]) if next_link else None
+
+_PODS = etree.XPath(f"//article[{_cls('product_pod')}]")
+_POD_LINK = etree.XPath("(.//h3//a)[1]")
+_POD_PRICE = etree.XPath(f"(.//p[{_cls('price_color')}])[1]")
+_POD_AVAILABILITY = etree.XPath(f"(.//p[{_cls('availability')}])[1]")
+_POD_RATING = etree.XPath(f"(.//p[{_cls('star-rating')}])[1]")
+
+def parse_listing_summaries_lxml(html: str, url: str) -> Tuple[List[Dict], Optional[str]]:
+    root = _parse_tree(html)
+    if root is None:
+        return [], None
+    books = []
+    for pod in _PODS(root):
+        link = _first(_POD_LINK, pod)
+        if link is None or link.get("href") is None:
+            continue
+        price_el, availability_el = _first(_POD_PRICE, pod), _first(_POD_AVAILABILITY, pod)
+        rating_el = _first(_POD_RATING, pod)
+        books.append(_summary(
+            url, link.get("href"), link.get("title") or _text(link),
+            _text(price_el) if price_el is not None else None,
+            _text(availability_el) if availability_el is not None else None,
+            rating_el.get("class", "").split() if rating_el is not None else [],
+        ))
+    next_href = _NEXT_LINK(root)
+    return books, urljoin(url, next_href[0]) if next_href else None
+
+_SUMMARY_BACKENDS = {"lxml": parse_listing_summaries_lxml, "bs4": parse_listing_summaries_bs4}
+
+def parse_listing_summaries(html: str, url: str, backend: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+    """Each book's pod on a catalogue page (URL plus SUMMARY_FIELDS), and the next page's URL"""
+    backend = backend or PARSER_BACKEND
+    try:
+        parse = _SUMMARY_BACKENDS[backend]
+    except KeyError:
+        raise ValueError(f"Unknown parser backend {backend!r}; choose one of {sorted(_SUMMARY_BACKENDS)}") from None
+    return parse(html, url)
@@ -0,0 +1,174 @@
+"""Record books.toscrape pages into an on-disk fixture archive and replay them through httpx.
+
+    python -m crawler.replay record fixtures/site --pages 5
+
+An archive is a directory: `index.json` maps each URL to its status, the cache
+headers worth keeping and a body reference; bodies live next to it in a
+content-addressed, compressed snapshot store, so pages repeated across
+recordings are kept once. ReplayTransport serves an archive to an
+httpx.AsyncClient with simulated latency, jitter and injected failures, and
+answers conditional requests with 304 like the real site does.
+"""
+import argparse
+import asyncio
+import json
+import random
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Union
+import httpx
+from db.snapshots import DirectorySnapshotBackend, SnapshotStore
+from utils.logger import logger
+from .crawler import BASE, fetch, make_client, request
+from .parser import parse_listing_page
+from .throttle import CONCURRENCY
+
+# Response headers a replay needs: the body is stored decoded, so no content-encoding/length
+KEEP_HEADERS = ("content-type", "etag", "last-modified")
+
+class FixtureArchive:
+    """URL -> recorded response, backed by `<root>/index.json` and `<root>/bodies/`"""
+
+    def __init__(self, root: Union[str, Path]):
+        self.root = Path(root)
+        self.store = SnapshotStore(DirectorySnapshotBackend(self.root / "bodies"))
+        index = self.root / "index.json"
+        self.entries: Dict[str, dict] = json.loads(index.read_text()) if index.exists() else {}
+        self._bodies: Dict[str, str] = {}  # body ref -> html, read once per process
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, url: str) -> bool:
+        return url in self.entries
+
+    async def put(self, url: str, status: int, headers: dict, body: str):
+        ref = await self.store.put(body)
+        self.entries[url] = {"status": status, "headers": headers, "body": ref}
+
+    async def get(self, url: str):
+        """(status, headers, body) as recorded, or None"""
+        entry = self.entries.get(url)
+        if entry is None:
+            return None
+        ref = entry["body"]
+        if ref not in self._bodies:
+            self._bodies[ref] = await self.store.get(ref)
+        return entry["status"], entry["headers"], self._bodies[ref]
+
+    def save(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp = self.root / "index.json.tmp"
+        tmp.write_text(json.dumps(self.entries, indent=1, sort_keys=True))
+        tmp.replace(self.root / "index.json")
+
+class RecordingTransport(httpx.AsyncBaseTransport):
+    """Pass requests through to `transport` (the network by default) and keep every response in the archive"""
+
+    def __init__(self, archive: FixtureArchive, transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.archive = archive
+        self.transport = transport or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        response = await self.transport.handle_async_request(request)
+        await response.aread()  # decoded; the client reuses the read content
+        # a revalidation has nothing new to keep, and an overloaded answer is retried
+        if response.status_code not in (304, 429) and response.status_code < 500:
+            headers = {k: response.headers[k] for k in KEEP_HEADERS if k in response.headers}
+            await self.archive.put(str(request.url), response.status_code, headers, response.text)
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+class ReplayTransport(httpx.AsyncBaseTransport):
+    """Serve an archive: unknown URLs are 404s.
+
+    Each request waits `latency` plus up to `jitter` seconds; a share
+    `error_rate` of them fails with one of `errors`, either an HTTP status code
+    or "timeout" / "connect" for the matching transport error.
+    """
+
+    def __init__(self, archive: FixtureArchive, latency: float = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, errors: Iterable[Union[int, str]] = (503,), seed: Optional[int] = None):
+        self.archive = archive
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.errors = list(errors)
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.injected = 0
+
+    def _error(self, request: httpx.Request) -> Optional[httpx.Response]:
+        if not self.error_rate or self.rng.random() >= self.error_rate:
+            return None
+        self.injected += 1
+        error = self.rng.choice(self.errors)
+        if error == "timeout":
+            raise httpx.ReadTimeout("injected timeout", request=request)
+        if error == "connect":
+            raise httpx.ConnectError("injected connection error", request=request)
+        return httpx.Response(error, request=request)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        delay = self.latency + (self.rng.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay:
+            await asyncio.sleep(delay)
+        response = self._error(request)
+        if response is not None:
+            return response
+        recorded = await self.archive.get(str(request.url))
+        if recorded is None:
+            return httpx.Response(404, request=request)
+        status, headers, body = recorded
+        etag, modified = headers.get("etag"), headers.get("last-modified")
+        if (etag and request.headers.get("if-none-match") == etag) or \
+                (modified and not etag and request.headers.get("if-modified-since") == modified):
+            return httpx.Response(304, headers=headers, request=request)
+        return httpx.Response(status, headers=headers, text=body, request=request)
+
+async def record_site(client: httpx.AsyncClient, archive: FixtureArchive, start: str = BASE,
+                      max_pages: Optional[int] = None, concurrency: int = CONCURRENCY) -> int:
+    """Walk the listing pages from `start` through a recording client, fetching every book on them.
+
+    Returns the number of listing pages walked; the caller saves the archive.
+    """
+    slots = asyncio.Semaphore(concurrency)
+
+    async def fetch_book(url: str):
+        async with slots:
+            try:
+                await request(client, url)
+            except httpx.HTTPError as e:
+                logger.warning("Not recorded %s: %s", url, e)
+
+    pages, next_url = 0, start
+    while next_url and (max_pages is None or pages < max_pages):
+        html = await fetch(client, next_url)
+        book_urls, following_url = parse_listing_page(html, next_url)
+        await asyncio.gather(*(fetch_book(url) for url in book_urls if url not in archive))
+        pages += 1
+        logger.info("Recorded listing page %d (%s): %d books", pages, next_url, len(book_urls))
+        next_url = following_url
+    return pages
+
+async def record(root: str, max_pages: Optional[int], start: str):
+    archive = FixtureArchive(root)
+    async with make_client(transport=RecordingTransport(archive)) as client:
+        try:
+            pages = await record_site(client, archive, start, max_pages)
+        finally:
+            archive.save()
+    logger.info("Archive %s: %d listing pages walked, %d responses, %d distinct bodies",
+                root, pages, len(archive), archive.store.puts)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record books.toscrape pages into a fixture archive")
+    sub = parser.add_subparsers(dest="command", required=True)
+    rec = sub.add_parser("record", help="walk the live site and save what it serves")
+    rec.add_argument("root", help="archive directory; an existing archive is added to")
+    rec.add_argument("--pages", type=int, help="stop after this many listing pages")
+    rec.add_argument("--start", default=BASE)
+    args = parser.parse_args()
+    asyncio.run(record(args.root, args.pages, args.start))
@@ -0,0 +1,191 @@
+"""Adaptive per-host concurrency and the retry budget shared by every fetch.
+
+`AdaptiveLimiter` is an AIMD limit on in-flight requests to one host: each
+healthy response (latency under CRAWL_LATENCY_TARGET) adds about one slot per
+window of requests, while a 429, a 5xx or a timeout halves the limit (once per
+burst) and a Retry-After pauses the host altogether. `RetryBudget` caps retries
+per URL and, across all URLs, at a fraction of first attempts, so a failing
+site costs a bounded number of extra requests instead of multiplying them.
+"""
+import asyncio
+import os
+import random
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+from dotenv import load_dotenv
+from utils.metrics import gauge, get_registry
+
+load_dotenv()
+
+CONCURRENCY = int(os.getenv("CRAWL_CONCURRENCY", "8"))
+CRAWL_MIN_CONCURRENCY = int(os.getenv("CRAWL_MIN_CONCURRENCY", "1"))
+CRAWL_MAX_CONCURRENCY = int(os.getenv("CRAWL_MAX_CONCURRENCY", str(CONCURRENCY * 4)))
+# Responses slower than this (seconds) stop the limit from growing
+CRAWL_LATENCY_TARGET = float(os.getenv("CRAWL_LATENCY_TARGET", "1.0"))
+# Retries allowed per URL, and across all URLs as a fraction of first attempts (plus a reserve)
+CRAWL_RETRIES = int(os.getenv("CRAWL_RETRIES", "3"))
+CRAWL_RETRY_RATIO = float(os.getenv("CRAWL_RETRY_RATIO", "0.2"))
+CRAWL_RETRY_RESERVE = int(os.getenv("CRAWL_RETRY_RESERVE", "10"))
+CRAWL_RETRY_BACKOFF = float(os.getenv("CRAWL_RETRY_BACKOFF", "1.0"))  # seconds, doubled per retry
+CRAWL_RETRY_MAX_DELAY = float(os.getenv("CRAWL_RETRY_MAX_DELAY", "60"))  # also caps Retry-After
+
+DECREASE_FACTOR = 0.5
+
+HOST_IN_FLIGHT = gauge("crawler_host_in_flight", "Requests in flight to a host", ("host",))
+HOST_LIMIT = gauge("crawler_host_concurrency_limit", "Adaptive in-flight limit of a host", ("host",))
+HOST_OVERLOADS = gauge("crawler_host_overloads", "429/5xx/timeouts seen from a host by its current limiter", ("host",))
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header (delay-seconds or HTTP-date)"""
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0.0), CRAWL_RETRY_MAX_DELAY)
+
+def backoff_delay(retry: int) -> float:
+    """Exponential backoff with full jitter for the n-th retry (1-based)"""
+    return random.uniform(0, min(CRAWL_RETRY_MAX_DELAY, CRAWL_RETRY_BACKOFF * 2 ** (retry - 1)))
+
+class AdaptiveLimiter:
+    """AIMD concurrency limit for one host; use `async with limiter:` around a single request"""
+
+    def __init__(self, initial: int = CONCURRENCY, minimum: int = CRAWL_MIN_CONCURRENCY,
+                 maximum: int = CRAWL_MAX_CONCURRENCY, latency_target: float = CRAWL_LATENCY_TARGET):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self.paused_until = 0.0  # time.monotonic() deadline set by Retry-After
+        self.latency: Optional[float] = None  # moving average of healthy response times
+        self.stats = Counter()
+        self._last_decrease = float("-inf")
+        self._waiters: List[asyncio.Future] = []
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+    async def acquire(self):
+        while True:
+            pause = self.paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+
+    def release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.pop(0)
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    def on_success(self, latency: float):
+        """Additive increase: about one more slot per `limit` healthy responses"""
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        if latency <= self.latency_target:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._wake()
+        else:
+            self.stats["slow"] += 1
+
+    def on_overload(self, retry_after: Optional[float] = None):
+        """Multiplicative decrease on 429/5xx/timeouts, at most once per round trip"""
+        now = time.monotonic()
+        self.stats["overload"] += 1
+        # the errors of one burst arrive within about one round trip of each other: count them once
+        if now - self._last_decrease >= min(self.latency or self.latency_target, self.latency_target):
+            self.limit = max(self.minimum, self.limit * DECREASE_FACTOR)
+            self._last_decrease = now
+        if retry_after:
+            self.paused_until = max(self.paused_until, now + retry_after)
+
+class HostLimiters:
+    """One AdaptiveLimiter per host, created on first use"""
+
+    def __init__(self, **limiter_kwargs):
+        self._limiter_kwargs = limiter_kwargs
+        self._limiters: Dict[str, AdaptiveLimiter] = {}
+
+    def for_url(self, url: str) -> AdaptiveLimiter:
+        host = urlsplit(url).netloc
+        limiter = self._limiters.get(host)
+        if limiter is None:
+            limiter = self._limiters[host] = AdaptiveLimiter(**self._limiter_kwargs)
+        return limiter
+
+    def snapshot(self) -> Dict[str, dict]:
+        return {host: {"limit": round(l.limit, 2), "in_flight": l.in_flight, **l.stats}
+                for host, l in self._limiters.items()}
+
+class RetryBudget:
+    """Per-URL retry cap plus a global token bucket: every first attempt earns `ratio` of a retry"""
+
+    def __init__(self, per_url: int = CRAWL_RETRIES, ratio: float = CRAWL_RETRY_RATIO,
+                 reserve: int = CRAWL_RETRY_RESERVE):
+        self.per_url = per_url
+        self.ratio = ratio
+        self.reserve = reserve
+        self.capacity = reserve * 10
+        self.tokens = float(reserve)
+        self.stats = Counter()
+
+    def record_attempt(self):
+        self.tokens = min(self.capacity, self.tokens + self.ratio)
+
+    def try_spend(self, retries_so_far: int) -> bool:
+        """Whether a URL that has been retried `retries_so_far` times may be retried once more"""
+        if retries_so_far >= self.per_url:
+            self.stats["url_exhausted"] += 1
+            return False
+        if self.tokens < 1:
+            self.stats["budget_exhausted"] += 1
+            return False
+        self.tokens -= 1
+        self.stats["retries"] += 1
+        return True
+
+_limiters = HostLimiters()
+_budget = RetryBudget()
+
+def get_host_limiters() -> HostLimiters:
+    return _limiters
+
+def get_retry_budget() -> RetryBudget:
+    return _budget
+
+def _collect_limits():
+    for host, limiter in _limiters._limiters.items():
+        HOST_IN_FLIGHT.set(limiter.in_flight, host=host)
+        HOST_LIMIT.set(round(limiter.limit, 2), host=host)
+        HOST_OVERLOADS.set(limiter.stats["overload"], host=host)
+
+get_registry().on_collect(_collect_limits)
@@ -0,0 +1,134 @@
+import asyncio
+import inspect
+import os
+import time
+from contextlib import suppress
+from typing import Callable, Hashable, List, Optional, Set
+from pymongo.errors import BulkWriteError
+from dotenv import load_dotenv
+from utils.logger import logger
+from utils.metrics import SIZE_BUCKETS, counter, histogram
+
+load_dotenv()
+
+BULK_MAX_OPS = int(os.getenv("BULK_MAX_OPS", "500"))
+BULK_MAX_DELAY = float(os.getenv("BULK_MAX_DELAY", "1.0"))  # seconds
+
+WRITE_SECONDS = histogram("db_bulk_write_seconds", "Latency of one bulk_write, by collection", ("collection",))
+WRITE_OPS = histogram("db_bulk_write_ops", "Operations per bulk_write, by collection", ("collection",), SIZE_BUCKETS)
+WRITE_FAILED = counter("db_bulk_write_failed_ops_total", "Buffered operations that were not applied, by collection",
+                       ("collection",))
+
+class BulkWriter:
+    """Write-behind buffer for a collection.
+
+    Queued `UpdateOne`/`InsertOne` operations are sent as one unordered
+    `bulk_write` once `max_ops` are waiting or `max_delay` seconds have passed.
+    An `on_insert` callback (plain or async) attached to an upsert is called
+    with the new `_id` when that upsert turned out to be an insert, and
+    `on_flush` (no arguments) after every batch that reached the server. Use as an
+    async context manager so the periodic flush runs and the tail of the buffer
+    is written on exit.
+
+    Operations that were not applied are returned by the `flush()` that sent
+    them; the `key` given with such an operation is also kept in `failed` until
+    `take_failed()`, so callers learn about failures in ticker flushes too.
+    """
+
+    def __init__(self, collection, max_ops: Optional[int] = None, max_delay: Optional[float] = None,
+                 on_flush: Optional[Callable] = None):
+        self.collection = collection
+        self.on_flush = on_flush
+        self.max_ops = max_ops or BULK_MAX_OPS
+        self.max_delay = max_delay or BULK_MAX_DELAY
+        self.flushes = 0
+        self.ops_written = 0
+        self._ops: List = []
+        self._callbacks: List[Optional[Callable]] = []
+        self._keys: List[Optional[Hashable]] = []
+        self.failed: Set[Hashable] = set()
+        self._lock = asyncio.Lock()
+        self._ticker = None
+
+    async def __aenter__(self):
+        self._ticker = asyncio.create_task(self._tick())
+        return self
+
+    async def __aexit__(self, *exc):
+        self._ticker.cancel()
+        with suppress(asyncio.CancelledError):
+            await self._ticker
+        await self.flush()
+
+    def __len__(self):
+        return len(self._ops)
+
+    async def add(self, op, on_insert: Optional[Callable] = None, key: Optional[Hashable] = None):
+        """Queue one operation, flushing when the size threshold is reached"""
+        self._ops.append(op)
+        self._callbacks.append(on_insert)
+        self._keys.append(key)
+        if len(self._ops) >= self.max_ops:
+            await self.flush()
+
+    async def _tick(self):
+        while True:
+            await asyncio.sleep(self.max_delay)
+            await self.flush()
+
+    def take_failed(self) -> Set[Hashable]:
+        """Keys of the operations that were not applied since the last call"""
+        failed, self.failed = self.failed, set()
+        return failed
+
+    async def flush(self) -> List:
+        """Write everything queued so far; failures are logged and the operations not applied returned"""
+        async with self._lock:
+            if not self._ops:
+                return []
+            ops, callbacks, keys = self._ops, self._callbacks, self._keys
+            self._ops, self._callbacks, self._keys = [], [], []
+            name = getattr(self.collection, "name", "?")
+            WRITE_OPS.observe(len(ops), collection=name)
+            started = time.perf_counter()
+            try:
+                result = await self.collection.bulk_write(ops, ordered=False)
+                upserted = result.upserted_ids or {}
+                lost = []
+            except BulkWriteError as e:
+                # unordered: everything except the failed operations was applied
+                errors = e.details.get("writeErrors", [])
+                WRITE_FAILED.inc(len(errors), collection=name)
+                logger.error("Bulk write to %s failed for %d of %d operations: %s",
+                             self.collection.name, len(errors), len(ops),
+                             errors[0].get("errmsg") if errors else e)
+                upserted = {u["index"]: u["_id"] for u in e.details.get("upserted", [])}
+                lost = sorted({error["index"] for error in errors})
+            except Exception as e:
+                WRITE_FAILED.inc(len(ops), collection=name)
+                logger.error("Bulk write to %s failed, %d operations not applied: %s",
+                             self.collection.name, len(ops), e)
+                self.failed.update(key for key in keys if key is not None)
+                return ops
+            finally:
+                WRITE_SECONDS.observe(time.perf_counter() - started, collection=name)
+            self.failed.update(keys[index] for index in lost if keys[index] is not None)
+            self.flushes += 1
+            self.ops_written += len(ops)
+            for index, _id in upserted.items():
+                if callbacks[index]:
+                    try:
+                        result = callbacks[index](_id)
+                        if inspect.isawaitable(result):
+                            await result
+                    except Exception as e:
+                        # the rest of the batch's callbacks still run, and a ticker flush keeps ticking
+                        logger.error("on_insert callback for %s failed: %s", self.collection.name, e)
+            if self.on_flush:
+                try:
+                    result = self.on_flush()
+                    if inspect.isawaitable(result):
+                        await result
+                except Exception as e:
+                    logger.error("on_flush hook for %s failed: %s", self.collection.name, e)
+            return [ops[index] for index in lost]
@@ -1,5 +1,6 @@
 
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import CollectionInvalid, OperationFailure
 import os
 from dotenv import load_dotenv
 
@@ -11,11 +12,60 @@ DB_NAME = os.getenv("DB_NAME", "bookscrape")
 client = AsyncIOMotorClient(MONGO_URI)
 db = client[DB_NAME]
 
+# Query shapes served by GET /books: optional equality filters, an optional
+# price range, and one of these sorts (always tie-broken on _id for keyset paging)
+BOOK_EQUALITY_FILTERS = ("category", "rating")
+BOOK_RANGE_FILTER = "price_including_tax"
+BOOK_SORTS = {
+    "rating": ("rating", -1),
+    "price": ("price_including_tax", 1),
+    "reviews": ("num_reviews", -1),
+}
+
+def book_index_specs():
+    """Compound indexes covering every filter+sort shape, laid out equality, sort, range"""
+    equality_sets = [()]
+    for field in BOOK_EQUALITY_FILTERS:
+        equality_sets += [subset + (field,) for subset in equality_sets]
+    specs = []
+    for sort in list(BOOK_SORTS.values()) + [None]:
+        sort_field, direction = sort or ("_id", 1)
+        for equality in equality_sets:
+            keys = [(field, 1) for field in equality if field != sort_field]
+            if not keys and sort is None:
+                continue  # plain _id order is served by the default _id index
+            keys.append((sort_field, direction))
+            if sort_field != "_id":
+                keys.append(("_id", direction))
+            if sort_field != BOOK_RANGE_FILTER:
+                keys.append((BOOK_RANGE_FILTER, 1))
+            if keys not in specs:
+                specs.append(keys)
+    return specs
+
 async def ensure_indexes():
     # Book collection indexes
     await db.books.create_index("source_url", unique=True)
     await db.books.create_index("fingerprint")
+    for keys in book_index_specs():
+        await db.books.create_index(keys)
     await db.changes.create_index([("changed_at", -1)])
+    await db.book_facets.create_index([("category", 1), ("rating", 1), ("price_bucket", 1)], unique=True)
+    # Price/availability points (db.history): a time-series collection where the server has them
+    try:
+        await db.create_collection("price_history", timeseries={
+            "timeField": "ts", "metaField": "source_url", "granularity": "hours"})
+    except CollectionInvalid:
+        pass  # already there
+    except OperationFailure:
+        pass  # before MongoDB 5.0: the index below creates a plain collection
+    await db.price_history.create_index([("source_url", 1), ("ts", 1)])
     
     # Crawler state collection indexes
     await db.crawler_state.create_index("crawler_id", unique=True)
+    # Distributed crawl queue: claims take the oldest pending URL or the stalest expired lease
+    await db.crawl_queue.create_index([("status", 1), ("discovered_at", 1)])
+    await db.crawl_queue.create_index([("status", 1), ("lease_expires", 1)])
+    await db.crawl_queue.create_index("claim_id", sparse=True)
+    # Shared rate-limit windows expire on their own
+    await db.rate_limits.create_index("expires_at", expireAfterSeconds=0)
@@ -0,0 +1,212 @@
+"""Materialized catalog statistics behind GET /books/facets.
+
+`book_facets` holds one counter document per (category, rating, price_bucket)
+cell, where price_bucket is price_including_tax rounded down to
+FACET_PRICE_STEP. A facets request sums a few small cells instead of grouping
+the whole catalog; a price range that cuts through a bucket is answered
+exactly by grouping just the books inside that partial slice. The crawler and
+change detector keep the counters current with $inc deltas whenever they write
+a book.
+
+    python -m db.facets --rebuild
+"""
+import argparse
+import asyncio
+import math
+import os
+from collections import Counter
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+from dotenv import load_dotenv
+from pymongo import UpdateOne
+from db.client import db
+
+load_dotenv()
+
+FACET_PRICE_STEP = float(os.getenv("FACET_PRICE_STEP", "5"))
+DEFAULT_BUCKET_WIDTH = 10.0
+PRICE_FIELD = "price_including_tax"
+# a `meta` document set once the cells have been built from books; deltas before that only make partial cells
+BUILT_ID = "book_facets_built"
+# rebuild_facets() fills this one and swaps it in
+REBUILD_COLLECTION = "book_facets_rebuild"
+
+def price_bucket(price: Optional[float]) -> Optional[float]:
+    if price is None:
+        return None
+    return math.floor(price / FACET_PRICE_STEP) * FACET_PRICE_STEP
+
+def facet_cell(doc: Optional[dict]) -> Optional[Tuple]:
+    if not doc:
+        return None
+    return (doc.get("category"), doc.get("rating"), price_bucket(doc.get(PRICE_FIELD)))
+
+def _cell_filter(cell: Tuple) -> dict:
+    return dict(zip(("category", "rating", "price_bucket"), cell))
+
+def facet_delta_ops(old_doc: Optional[dict], new_doc: Optional[dict]) -> List[UpdateOne]:
+    """$inc operations moving one book from its old cell to its new one"""
+    old_cell, new_cell = facet_cell(old_doc), facet_cell(new_doc)
+    if old_cell == new_cell:
+        return []
+    ops = []
+    if old_cell is not None:
+        ops.append(UpdateOne(_cell_filter(old_cell), {"$inc": {"count": -1}}))
+    if new_cell is not None:
+        ops.append(UpdateOne(_cell_filter(new_cell), {"$inc": {"count": 1}}, upsert=True))
+    return ops
+
+async def update_facets(writer, old_doc: Optional[dict], new_doc: Optional[dict]):
+    """Queue the counter deltas for one book write on a BulkWriter over book_facets"""
+    if writer is None:
+        return
+    for op in facet_delta_ops(old_doc, new_doc):
+        await writer.add(op)
+
+def split_query(query: dict):
+    """Split a GET /books filter into a cells filter and the partial price slices.
+
+    Returns (cells_query or None, [books_query, ...]): whole buckets inside the
+    price range are read from the cells, the uneven ends from books.
+    """
+    price = query.get(PRICE_FIELD)
+    base = {k: v for k, v in query.items() if k != PRICE_FIELD}
+    if not price:
+        return base, []
+    low, high = price.get("$gte"), price.get("$lte")
+    # first and last bucket lying entirely inside [low, high]
+    first = math.ceil(low / FACET_PRICE_STEP) * FACET_PRICE_STEP if low is not None else None
+    end = math.floor(high / FACET_PRICE_STEP) * FACET_PRICE_STEP if high is not None else None
+    if first is not None and end is not None and first >= end:
+        return None, [query]
+    cells = dict(base)
+    bucket_range = {}
+    if first is not None:
+        bucket_range["$gte"] = first
+    if end is not None:
+        bucket_range["$lt"] = end
+    cells["price_bucket"] = bucket_range
+    slices = []
+    if first is not None and low < first:
+        slices.append({**base, PRICE_FIELD: {"$gte": low, "$lt": first}})
+    if end is not None:
+        slices.append({**base, PRICE_FIELD: {"$gte": end, "$lte": high}})
+    return cells, slices
+
+def summarize(cells, bucket_width: float = DEFAULT_BUCKET_WIDTH) -> dict:
+    """Fold (cell, count) pairs into per-category, per-rating and per-price-bucket counts"""
+    categories, ratings, buckets = Counter(), Counter(), Counter()
+    total = 0
+    for cell in cells:
+        count = cell["count"]
+        if count <= 0:
+            continue
+        total += count
+        categories[cell.get("category")] += count
+        ratings[cell.get("rating")] += count
+        price = cell.get("price_bucket")
+        buckets[math.floor(price / bucket_width) * bucket_width if price is not None else None] += count
+    return {
+        "total": total,
+        "categories": [{"value": k, "count": v} for k, v in sorted(categories.items(), key=lambda kv: (-kv[1], str(kv[0])))],
+        "ratings": [{"value": k, "count": v} for k, v in sorted(ratings.items(), key=lambda kv: (kv[0] is None, kv[0] or 0))],
+        "price_buckets": [
+            {"min": k, "max": k + bucket_width if k is not None else None, "count": v}
+            for k, v in sorted(buckets.items(), key=lambda kv: (kv[0] is None, kv[0] or 0))
+        ],
+    }
+
+def facet_group_pipeline(query: dict) -> list:
+    """Group books into facet cells: the on-demand aggregation book_facets replaces"""
+    return [
+        {"$match": query},
+        {"$group": {
+            "_id": {
+                "category": "$category",
+                "rating": "$rating",
+                "price_bucket": {"$cond": [
+                    {"$isNumber": f"${PRICE_FIELD}"},
+                    {"$multiply": [{"$floor": {"$divide": [f"${PRICE_FIELD}", FACET_PRICE_STEP]}}, FACET_PRICE_STEP]},
+                    None,
+                ]},
+            },
+            "count": {"$sum": 1},
+        }},
+        {"$replaceRoot": {"newRoot": {"$mergeObjects": ["$_id", {"count": "$count"}]}}},
+    ]
+
+async def query_facets(query: dict, bucket_width: float = DEFAULT_BUCKET_WIDTH) -> dict:
+    """Facet counts for a GET /books filter, read from the materialized cells"""
+    cells_query, slices = split_query(query)
+    cells = []
+    if cells_query is not None:
+        cursor = db.book_facets.find({**cells_query, "count": {"$gt": 0}},
+                                     {"_id": 0, "category": 1, "rating": 1, "price_bucket": 1, "count": 1})
+        cells += await cursor.to_list(length=None)
+    for books_query in slices:
+        cells += await db.books.aggregate(facet_group_pipeline(books_query)).to_list(length=None)
+    return summarize(cells, bucket_width)
+
+async def aggregate_facets(query: dict, bucket_width: float = DEFAULT_BUCKET_WIDTH) -> dict:
+    """The same counts computed from books on demand (benchmarks, consistency checks)"""
+    cells = await db.books.aggregate(facet_group_pipeline(query)).to_list(length=None)
+    return summarize(cells, bucket_width)
+
+async def facets_built(meta) -> bool:
+    return await meta.find_one({"_id": BUILT_ID}) is not None
+
+def _cell_books_query(cell: Tuple) -> dict:
+    """The books counted in one cell"""
+    category, rating, bucket = cell
+    if bucket is None:
+        price = {"$not": {"$type": "number"}}
+    else:
+        price = {"$gte": bucket, "$lt": bucket + FACET_PRICE_STEP}
+    return {"category": category, "rating": rating, PRICE_FIELD: price}
+
+async def cells_touched_since(since: datetime) -> set:
+    """Cells that books written since `since` are in now, or were in before (from their change records)"""
+    projection = {"_id": 0, "source_url": 1, "category": 1, "rating": 1, PRICE_FIELD: 1}
+    current = {doc["source_url"]: doc async for doc in db.books.find({"crawl_timestamp": {"$gte": since}}, projection)}
+    cells = {facet_cell(doc) for doc in current.values()}
+    async for change in db.changes.find({"changed_at": {"$gte": since}}, {"source_url": 1, "old": 1}):
+        doc = current.get(change["source_url"])
+        if doc is not None:
+            cells.add(facet_cell({**doc, **(change.get("old") or {})}))
+    return cells
+
+async def recount_cells(cells):
+    """Set the counters of just these cells from books"""
+    ops = [UpdateOne(_cell_filter(cell), {"$set": {"count": await db.books.count_documents(_cell_books_query(cell))}},
+                     upsert=True)
+           for cell in cells]
+    if ops:
+        await db.book_facets.bulk_write(ops, ordered=False)
+
+async def rebuild_facets():
+    """Recompute every cell from books (bootstrap, or repair after drift).
+
+    The cells are built in a scratch collection and swapped in by one rename,
+    so readers never see a half-built table. Deltas written to the old cells
+    meanwhile go with it: the cells of books written since the rebuild began
+    are counted again afterwards.
+    """
+    started = datetime.now(timezone.utc)
+    scratch = db[REBUILD_COLLECTION]
+    await db.books.aggregate(facet_group_pipeline({}) + [{"$out": REBUILD_COLLECTION}]).to_list(length=None)
+    await scratch.create_index([("category", 1), ("rating", 1), ("price_bucket", 1)], unique=True)
+    await scratch.rename("book_facets", dropTarget=True)
+    await recount_cells(await cells_touched_since(started))
+    await db.meta.update_one({"_id": BUILT_ID}, {"$set": {"built_at": datetime.now(timezone.utc)}}, upsert=True)
+
+async def ensure_facets():
+    """Build the cells once, replacing any partial cells written before then"""
+    if not await facets_built(db.meta):
+        await rebuild_facets()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the book_facets statistics collection")
+    parser.add_argument("--rebuild", action="store_true", help="recompute all cells from books")
+    args = parser.parse_args()
+    if args.rebuild:
+        asyncio.run(rebuild_facets())
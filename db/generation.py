@@ -0,0 +1,15 @@
+"""Catalog generation counter.
+
+The crawler and the change detector bump it after every batch of writes to
+books, changes or book_facets. API workers poll this one small document to
+tell whether their cached responses are stale, so several workers stay
+coherent without a shared cache server.
+"""
+GENERATION_ID = "catalog_generation"
+
+async def bump_generation(meta):
+    await meta.update_one({"_id": GENERATION_ID}, {"$inc": {"value": 1}}, upsert=True)
+
+async def read_generation(meta) -> int:
+    doc = await meta.find_one({"_id": GENERATION_ID})
+    return doc["value"] if doc else 0
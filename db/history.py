@@ -0,0 +1,55 @@
+"""Price and availability history per book, in the `price_history` time-series collection.
+
+A point {ts, source_url, price_including_tax, availability} is written when a
+book is first stored and whenever either value changes, so a book's history is
+a handful of tiny documents instead of a chain of whole-book change records.
+GET /books/{book_id}/history reads it back. The `changes` records written
+alongside keep only the changed fields' old and new values (`change_record`).
+"""
+from datetime import datetime, timezone
+from typing import Iterable, List, Optional
+from pymongo import InsertOne
+from db.client import db
+
+HISTORY_FIELDS = ("price_including_tax", "availability")
+
+def history_point(doc: dict, ts: Optional[datetime] = None) -> dict:
+    point = {"ts": ts or datetime.now(timezone.utc), "source_url": doc["source_url"]}
+    point.update({field: doc.get(field) for field in HISTORY_FIELDS})
+    return point
+
+def touches_history(changed: Iterable[str]) -> bool:
+    return any(field in HISTORY_FIELDS for field in changed)
+
+def change_record(old_doc: dict, new_doc: dict, changed: List[str], changed_at: datetime) -> dict:
+    """A change as old/new values of just the changed fields, with the title and category for reports"""
+    record = {
+        "source_url": new_doc.get("source_url") or old_doc["source_url"],
+        "changed_at": changed_at,
+        "old_fingerprint": old_doc.get("fingerprint"),
+        "new_fingerprint": new_doc.get("fingerprint"),
+        "changes": changed,
+        "title": new_doc.get("title") or old_doc.get("title"),
+        "category": new_doc.get("category") or old_doc.get("category"),
+        "old": {field: old_doc.get(field) for field in changed},
+        "new": {field: new_doc.get(field) for field in changed},
+    }
+    # the raw pages stay reachable through the snapshot store
+    for side, doc in (("old", old_doc), ("new", new_doc)):
+        if doc.get("snapshot_ref"):
+            record[f"{side}_snapshot_ref"] = doc["snapshot_ref"]
+    return record
+
+async def record_history(writer, doc: dict, ts: Optional[datetime] = None):
+    """Queue one history point on a BulkWriter over price_history"""
+    if writer is None:
+        return
+    await writer.add(InsertOne(history_point(doc, ts)))
+
+async def read_history(source_url: str, since: Optional[datetime] = None, limit: int = 1000) -> List[dict]:
+    """A book's points, oldest first"""
+    query = {"source_url": source_url}
+    if since is not None:
+        query["ts"] = {"$gte": since}
+    cursor = db.price_history.find(query, {"_id": 0, "source_url": 0}).sort("ts", 1).limit(limit)
+    return await cursor.to_list(length=limit)
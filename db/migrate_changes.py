@@ -0,0 +1,86 @@
+"""Rewrite change records that embed both whole book documents into compact diffs, and seed price_history.
+
+    python -m db.migrate_changes [--batch-size 200]
+
+Each legacy record becomes the old/new values of its changed fields only (see
+db.history.change_record), worked out again from the two documents. HTML still
+embedded in either document is moved into the snapshot store first and kept as
+`old_snapshot_ref`/`new_snapshot_ref`, so running db.migrate_snapshots
+beforehand is not required. Records are walked oldest first: the
+first one of a book adds its old price and availability as a baseline point,
+and every record touching either value adds its new values. Books that still
+have no history then get one point from their current values.
+
+Safe to re-run: compact records are skipped, and so are books that already
+have history.
+"""
+import argparse
+import asyncio
+from pymongo import ReplaceOne
+from db.client import db
+from db.bulk import BulkWriter
+from db.history import change_record, record_history, touches_history
+from db.snapshots import get_snapshot_store
+from crawler.fingerprint import changed_fields, field_hashes
+from utils.logger import logger
+
+# only records written before compaction carry whole documents
+LEGACY_QUERY = {"old.source_url": {"$exists": True}}
+
+async def _move_snapshot(store, doc: dict):
+    """Replace an embedded raw_html_snapshot with its snapshot_ref"""
+    html = doc.pop("raw_html_snapshot", None)
+    if html:
+        doc["snapshot_ref"] = await store.put(html)
+
+async def compact_changes(batch_size: int) -> int:
+    store = get_snapshot_store()
+    migrated = 0
+    seen = set()
+    async with BulkWriter(db.changes) as changes_writer, BulkWriter(db.price_history) as history_writer:
+        cursor = db.changes.find(LEGACY_QUERY).sort("changed_at", 1).batch_size(batch_size)
+        async for doc in cursor:
+            old, new = doc["old"], doc.get("new") or {}
+            # the compact record keeps only references: land any embedded page in the store first
+            await _move_snapshot(store, old)
+            await _move_snapshot(store, new)
+            # the stored labels are not field names ("price", "availability") and miss untracked fields
+            changed = changed_fields(old, field_hashes(new))
+            record = change_record(old, new, changed, doc["changed_at"])
+            # keep the stored fingerprints rather than whatever the documents carry
+            record.update(old_fingerprint=doc.get("old_fingerprint"), new_fingerprint=doc.get("new_fingerprint"))
+            await changes_writer.add(ReplaceOne({"_id": doc["_id"]}, record))
+            url = record["source_url"]
+            if url not in seen:
+                seen.add(url)
+                await record_history(history_writer, {**old, "source_url": url},
+                                     old.get("crawl_timestamp") or doc["changed_at"])
+            if touches_history(changed):
+                await record_history(history_writer, {**new, "source_url": url}, doc["changed_at"])
+            migrated += 1
+    return migrated
+
+async def backfill_history(batch_size: int) -> int:
+    known = set(await db.price_history.distinct("source_url"))
+    added = 0
+    async with BulkWriter(db.price_history) as writer:
+        cursor = db.books.find({}, {"_id": 0, "source_url": 1, "crawl_timestamp": 1,
+                                    "price_including_tax": 1, "availability": 1}).batch_size(batch_size)
+        async for doc in cursor:
+            if doc["source_url"] in known:
+                continue
+            await record_history(writer, doc, doc.get("crawl_timestamp"))
+            added += 1
+    return added
+
+async def main(batch_size: int):
+    changes = await compact_changes(batch_size)
+    books = await backfill_history(batch_size)
+    logger.info("Change migration done: %d change records compacted, %d books given a first history point",
+                changes, books)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compact change records and seed the price history")
+    parser.add_argument("--batch-size", type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(main(args.batch_size))
@@ -0,0 +1,61 @@
+"""Move embedded raw HTML snapshots out of `books` and `changes` into the snapshot store.
+
+    python -m db.migrate_snapshots [--batch-size 200]
+
+Safe to re-run: snapshots are content-addressed, so a document processed twice
+just points at the same reference again.
+"""
+import argparse
+import asyncio
+from pymongo import UpdateOne
+from db.client import db
+from db.bulk import BulkWriter
+from db.snapshots import get_snapshot_store
+from utils.logger import logger
+
+async def migrate_books(store, batch_size: int) -> int:
+    migrated = 0
+    async with BulkWriter(db.books) as writer:
+        cursor = db.books.find({"raw_html_snapshot": {"$exists": True}},
+                               {"raw_html_snapshot": 1}).batch_size(batch_size)
+        async for doc in cursor:
+            update = {"$unset": {"raw_html_snapshot": ""}}
+            if doc.get("raw_html_snapshot"):
+                update["$set"] = {"snapshot_ref": await store.put(doc["raw_html_snapshot"])}
+            await writer.add(UpdateOne({"_id": doc["_id"]}, update))
+            migrated += 1
+    return migrated
+
+async def migrate_changes(store, batch_size: int) -> int:
+    migrated = 0
+    query = {"$or": [{"old.raw_html_snapshot": {"$exists": True}},
+                     {"new.raw_html_snapshot": {"$exists": True}}]}
+    async with BulkWriter(db.changes) as writer:
+        cursor = db.changes.find(query, {"old.raw_html_snapshot": 1, "new.raw_html_snapshot": 1}).batch_size(batch_size)
+        async for doc in cursor:
+            update = {"$set": {}, "$unset": {}}
+            for side in ("old", "new"):
+                html = (doc.get(side) or {}).get("raw_html_snapshot")
+                if html is None:
+                    continue
+                update["$unset"][f"{side}.raw_html_snapshot"] = ""
+                if html:
+                    update["$set"][f"{side}.snapshot_ref"] = await store.put(html)
+            if not update["$set"]:
+                del update["$set"]
+            await writer.add(UpdateOne({"_id": doc["_id"]}, update))
+            migrated += 1
+    return migrated
+
+async def main(batch_size: int):
+    store = get_snapshot_store()
+    books = await migrate_books(store, batch_size)
+    changes = await migrate_changes(store, batch_size)
+    logger.info("Snapshot migration done: %d books, %d change records, %d snapshots stored, %d duplicates",
+                books, changes, store.puts, store.duplicates)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move embedded HTML snapshots into the snapshot store")
+    parser.add_argument("--batch-size", type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(main(args.batch_size))
@@ -0,0 +1,161 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+import zlib
+from collections import OrderedDict
+from contextlib import suppress
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Optional, Tuple
+from dotenv import load_dotenv
+
+try:
+    import zstandard
+except ImportError:  # optional, only needed for SNAPSHOT_COMPRESSION=zstd
+    zstandard = None
+
+load_dotenv()
+
+SNAPSHOT_BACKEND = os.getenv("SNAPSHOT_BACKEND", "mongo")  # mongo | directory
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "snapshots")
+SNAPSHOT_COMPRESSION = os.getenv("SNAPSHOT_COMPRESSION", "zlib")  # zlib | zstd | none
+# most recently written keys remembered per process, to skip re-writing duplicates
+SNAPSHOT_KNOWN_KEYS = int(os.getenv("SNAPSHOT_KNOWN_KEYS", "100000"))
+
+def snapshot_key(html: str) -> str:
+    """Content address of a page: identical HTML is stored once"""
+    return hashlib.blake2b(html.encode("utf-8"), digest_size=20).hexdigest()
+
+def compress(html: str, codec: str) -> bytes:
+    raw = html.encode("utf-8")
+    if codec == "zlib":
+        return zlib.compress(raw, 6)
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("SNAPSHOT_COMPRESSION=zstd requires the 'zstandard' package")
+        return zstandard.ZstdCompressor(level=3).compress(raw)
+    if codec == "none":
+        return raw
+    raise ValueError(f"Unknown snapshot compression: {codec}")
+
+def decompress(data: bytes, codec: str) -> str:
+    if codec == "zlib":
+        raw = zlib.decompress(data)
+    elif codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Reading zstd snapshots requires the 'zstandard' package")
+        raw = zstandard.ZstdDecompressor().decompress(data)
+    elif codec == "none":
+        raw = data
+    else:
+        raise ValueError(f"Unknown snapshot compression: {codec}")
+    return raw.decode("utf-8")
+
+class MongoSnapshotBackend:
+    """GridFS-style collection: one small document per snapshot, `_id` is the content key"""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def put(self, key: str, codec: str, data: bytes, size: int):
+        # $setOnInsert makes the write idempotent, so duplicates cost one no-op upsert
+        await self.collection.update_one(
+            {"_id": key},
+            {"$setOnInsert": {"codec": codec, "data": data, "size": size,
+                              "created_at": datetime.now(timezone.utc)}},
+            upsert=True,
+        )
+
+    async def get(self, key: str) -> Optional[Tuple[str, bytes]]:
+        doc = await self.collection.find_one({"_id": key})
+        return (doc["codec"], bytes(doc["data"])) if doc else None
+
+class DirectorySnapshotBackend:
+    """Local directory backend: `<root>/<key[:2]>/<key>.<codec>`"""
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def _path(self, key: str, codec: str) -> Path:
+        return self.root / key[:2] / f"{key}.{codec}"
+
+    def _put(self, key: str, codec: str, data: bytes):
+        path = self._path(key, codec)
+        if path.exists():
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # a temp name of its own: two writers of the same page must not share one half-written file
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f"{key}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            with suppress(FileNotFoundError):
+                os.unlink(tmp)
+            raise
+
+    def _get(self, key: str) -> Optional[Tuple[str, bytes]]:
+        for path in (self.root / key[:2]).glob(f"{key}.*"):
+            if path.suffix != ".tmp":
+                return path.suffix[1:], path.read_bytes()
+        return None
+
+    async def put(self, key: str, codec: str, data: bytes, size: int):
+        await asyncio.to_thread(self._put, key, codec, data)
+
+    async def get(self, key: str) -> Optional[Tuple[str, bytes]]:
+        return await asyncio.to_thread(self._get, key)
+
+class SnapshotStore:
+    """Compressed, content-addressed store for raw HTML snapshots.
+
+    Book and change documents keep only the returned `snapshot_ref`.
+    """
+
+    def __init__(self, backend, compression: str = SNAPSHOT_COMPRESSION, known_keys: int = SNAPSHOT_KNOWN_KEYS):
+        compress("", compression)  # validate the codec up front
+        self.backend = backend
+        self.compression = compression
+        self.known_keys = known_keys
+        self._known: OrderedDict = OrderedDict()  # keys recently written by this process, oldest first
+        self.puts = 0
+        self.duplicates = 0
+
+    async def put(self, html: str) -> str:
+        key = snapshot_key(html)
+        if key in self._known:
+            self._known.move_to_end(key)
+            self.duplicates += 1
+            return key
+        await self.backend.put(key, self.compression, compress(html, self.compression), len(html))
+        self._known[key] = None
+        if len(self._known) > self.known_keys:
+            # a forgotten key only costs an idempotent re-write
+            self._known.popitem(last=False)
+        self.puts += 1
+        return key
+
+    async def get(self, ref: str) -> Optional[str]:
+        found = await self.backend.get(ref)
+        if found is None:
+            return None
+        codec, data = found
+        return decompress(data, codec)
+
+_store = None
+
+def get_snapshot_store() -> SnapshotStore:
+    """The process-wide store configured by SNAPSHOT_BACKEND / SNAPSHOT_COMPRESSION"""
+    global _store
+    if _store is None:
+        if SNAPSHOT_BACKEND == "directory":
+            backend = DirectorySnapshotBackend(SNAPSHOT_DIR)
+        elif SNAPSHOT_BACKEND == "mongo":
+            from db.client import db
+            backend = MongoSnapshotBackend(db.snapshots)
+        else:
+            raise ValueError(f"Unknown SNAPSHOT_BACKEND: {SNAPSHOT_BACKEND}")
+        _store = SnapshotStore(backend)
+    return _store
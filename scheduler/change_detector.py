@@ -1,83 +1,348 @@
-
 import asyncio
-import hashlib
+import logging
+import os
+import random
+import re
+from collections import Counter
 from datetime import datetime, timezone
+from typing import List, Optional
+import httpx
+from pymongo import InsertOne, UpdateOne
 from db.client import db
-from utils.logger import logger, AlertLogger
-
-alert_logger = AlertLogger("ChangeDetector")
-
-def fingerprint(text: str) -> str:
-    return hashlib.sha256(text.encode("utf-8")).hexdigest()
-
-async def detect_changes_for_all_books():
-    # For each book in DB, re-fetch the page and compare fingerprints
-    from crawler.crawler import fetch, BASE  # reuse fetch and BASE
-    import httpx
-    async with httpx.AsyncClient() as client:
-        cursor = db.books.find({}, {"source_url": 1, "fingerprint": 1})
-        async for doc in cursor:
-            url = doc["source_url"]
-            old_fp = doc.get("fingerprint")
+from db.bulk import BulkWriter
+from db.snapshots import get_snapshot_store
+from db.facets import facets_built, update_facets
+from db.generation import bump_generation
+from scheduler.rollups import days_between, write_rollups
+from crawler.crawler import BASE, QUEUE_DEPTH, fetch, fetch_conditional, log_fetch_stats, make_client, \
+    update_book, CONCURRENCY as CRAWL_CONCURRENCY
+from crawler.parse_pool import get_parse_pool, parse_pool_run
+from crawler.fingerprint import delta_update
+from db.history import change_record, record_history, touches_history
+from crawler.parser import SUMMARY_FIELDS
+from utils.logger import AlertLogger, log_context, logger, new_id
+from utils.metrics import counter, dumps_metrics
+
+alert_logger = AlertLogger(logging.getLogger("books_crawler.change_detector"))
+
+# Number of concurrent fetch workers; defaults to the crawler's CRAWL_CONCURRENCY
+DETECT_CONCURRENCY = int(os.getenv("DETECT_CONCURRENCY", str(CRAWL_CONCURRENCY)))
+# How many cursor documents may wait for a free fetch worker
+DETECT_QUEUE_SIZE = int(os.getenv("DETECT_QUEUE_SIZE", str(DETECT_CONCURRENCY * 4)))
+# "full" re-fetches every book page; "listing" reads the catalogue pages and re-fetches only what they show moved
+DETECT_MODE = os.getenv("DETECT_MODE", "full")
+# Listing mode: share of unchanged-looking books re-fetched anyway, to catch drift in fields listings don't show
+DETECT_SAMPLE_RATE = float(os.getenv("DETECT_SAMPLE_RATE", "0.05"))
+
+DETECT_BOOKS = counter("change_detector_books_total", "Books re-checked by the change detector, by outcome",
+                       ("outcome",))
+DETECT_CHANGES = counter("change_detector_changes_total", "Fingerprint changes written, by significance", ("kind",))
+
+_DONE = object()  # queue sentinel
+
+async def _produce(queue: asyncio.Queue, query: Optional[dict] = None):
+    """Feed the books cursor into the bounded fetch queue"""
+    # the whole document minus the snapshot, so the writer needs no extra find_one
+    cursor = db.books.find(query or {}, {"raw_html_snapshot": 0})
+    async for doc in cursor:
+        await queue.put(doc)
+
+def _availability_label(availability: Optional[str]) -> Optional[str]:
+    """Drop the count, which listing pods do not show: "In stock (20 available)" -> "In stock"""
+    return re.sub(r"\s*\(.*\)$", "", availability) if availability else availability
+
+def summary_changes(doc: dict, summary: dict) -> List[str]:
+    """Fields of a listing-page summary that disagree with the stored book"""
+    changed = []
+    for field in SUMMARY_FIELDS:
+        old, new = doc.get(field), summary.get(field)
+        if field == "availability":
+            old, new = _availability_label(old), _availability_label(new)
+        if old != new:
+            changed.append(field)
+    return changed
+
+async def _produce_from_listings(client: httpx.AsyncClient, queue: asyncio.Queue, stats: Counter,
+                                 sample_rate: float, rng: random.Random):
+    """Walk the catalogue pages and queue only the books whose detail page is worth fetching"""
+    seen = set()
+    next_url = BASE
+    while next_url:
+        page_html = await fetch(client, next_url)
+        stats["listing_pages"] += 1
+        summaries, next_url = await get_parse_pool().parse_summaries(page_html, next_url)
+        fresh = []
+        for summary in summaries:
+            # a book linked from two pages is looked at once
+            if summary["source_url"] not in seen:
+                seen.add(summary["source_url"])
+                fresh.append(summary)
+        # one query per page of ~20 books
+        cursor = db.books.find({"source_url": {"$in": [summary["source_url"] for summary in fresh]}},
+                               {"raw_html_snapshot": 0})
+        known = {doc["source_url"]: doc async for doc in cursor}
+        for summary in fresh:
+            url = summary["source_url"]
+            stats["listed"] += 1
+            doc = known.get(url)
+            if doc is None:
+                stats["new"] += 1
+                await queue.put(url)
+            elif summary_changes(doc, summary):
+                stats["summary_changed"] += 1
+                await queue.put(doc)
+            elif rng.random() < sample_rate:
+                stats["sampled"] += 1
+                await queue.put(doc)
+            else:
+                stats["avoided"] += 1
+                DETECT_BOOKS.inc(outcome="skipped")
+
+async def _fetch_worker(client: httpx.AsyncClient, queue: asyncio.Queue, results: asyncio.Queue, stats: Counter):
+    """Re-fetch queued books and hand anything that needs a write to the writer"""
+    while True:
+        doc = await queue.get()
+        QUEUE_DEPTH.set(queue.qsize(), queue="detect_fetch")
+        if doc is _DONE:
+            return
+        if isinstance(doc, str):
+            # a book the listing pages show but the database lacks: the writer stores it as the crawler would
             try:
-                html = await fetch(client, url)
+                html, validators = await fetch_conditional(client, doc, None, stats)
+                parsed = await get_parse_pool().parse_book(html, doc)
             except Exception as e:
-                alert_logger.error("Failed to fetch for change detection %s, %s", url, e)
+                DETECT_BOOKS.inc(outcome="new_failed")
+                alert_logger.error("Failed to fetch new book found by change detection %s, %s", doc, e)
                 continue
-            new_fp = fingerprint(html)
-            if new_fp != old_fp:
-                # parse new data
-                from crawler.parser import parse_book_page
-                parsed = parse_book_page(html, url)
-                parsed["fingerprint"] = new_fp
-                parsed["raw_html_snapshot"] = html
-                parsed["crawl_timestamp"] = datetime.now(timezone.utc)
-                # update main doc and write change record
-                old_doc = await db.books.find_one({"source_url": url})
-                await db.books.update_one({"source_url": url}, {"$set": parsed})
-                # Record change and analyze significance
-                old_price = old_doc.get("price_including_tax", 0)
-                new_price = parsed.get("price_including_tax", 0)
-                price_change_pct = ((new_price - old_price) / old_price * 100) if old_price else 0
-                
-                old_availability = old_doc.get("availability", "")
-                new_availability = parsed.get("availability", "")
-                
-                # Record the change
-                change = {
-                    "source_url": url,
-                    "changed_at": datetime.now(timezone.utc),
-                    "old_fingerprint": old_fp,
-                    "new_fingerprint": new_fp,
-                    "old": old_doc,
-                    "new": parsed,
-                    "changes": []
-                }
-                
-                # Track specific changes
-                if old_price != new_price:
-                    change["changes"].append("price")
-                if old_availability != new_availability:
-                    change["changes"].append("availability")
-                
-                await db.changes.insert_one(change)
-                
-                # Log and alert based on significance
-                msg = f"Change detected for book: {parsed.get('title', 'Unknown Title')} ({url})\n"
-                alert_needed = False
-                
-                if abs(price_change_pct) >= 10:  # Price changed by 10% or more
-                    price_msg = f"Price changed significantly: £{old_price:.2f} → £{new_price:.2f} ({price_change_pct:+.1f}%)"
-                    msg += price_msg + "\n"
-                    alert_needed = True
-                
-                if old_availability != new_availability:
-                    availability_msg = f"Availability changed: {old_availability} → {new_availability}"
-                    msg += availability_msg + "\n"
-                    if "In stock" not in old_availability and "In stock" in new_availability:
-                        alert_needed = True  # Alert when book becomes available
-                
-                if alert_needed:
-                    alert_logger.alert("Significant Book Changes Detected", msg, level="info")
+            DETECT_BOOKS.inc(outcome="new")
+            parsed["validators"] = validators
+            parsed["raw_html_snapshot"] = html
+            await results.put((None, parsed, True))
+            continue
+        url = doc["source_url"]
+        old_fp = doc.get("fingerprint")
+        old_validators = doc.get("validators")
+        try:
+            html, validators = await fetch_conditional(client, url, old_validators, stats)
+        except Exception as e:
+            DETECT_BOOKS.inc(outcome="fetch_failed")
+            alert_logger.error("Failed to fetch for change detection %s, %s", url, e)
+            continue
+        if html is None:
+            # 304 Not Modified
+            DETECT_BOOKS.inc(outcome="not_modified")
+            continue
+        try:
+            # parsed and fingerprinted off the event loop
+            parsed = await get_parse_pool().parse_book(html, url)
+        except Exception as e:
+            DETECT_BOOKS.inc(outcome="parse_failed")
+            alert_logger.error("Failed to parse for change detection %s, %s", url, e)
+            continue
+        new_fp = parsed["fingerprint"]
+        DETECT_BOOKS.inc(outcome="unchanged" if new_fp == old_fp else "changed")
+        if new_fp == old_fp:
+            if validators != old_validators:
+                # same content, but keep the validators current for the next revisit
+                await results.put((doc, {"validators": validators}, False))
+            continue
+        parsed["validators"] = validators
+        parsed["raw_html_snapshot"] = html
+        await results.put((doc, parsed, True))
+
+async def _write_results(results: asyncio.Queue):
+    """Single writer stage: buffers book updates, change records and history points into bulk writes"""
+    bump = lambda: bump_generation(db.meta)  # tell API caches the catalog moved on
+    # until the cells are first built from books, deltas would only leave partial cells behind
+    count_facets = await facets_built(db.meta)
+    # books_writer exits (and flushes) first: insert callbacks of new books still feed facets and history
+    async with BulkWriter(db.changes, on_flush=bump) as changes_writer, \
+            BulkWriter(db.book_facets, on_flush=bump) as facets_writer, \
+            BulkWriter(db.price_history, on_flush=bump) as history_writer, \
+            BulkWriter(db.books, on_flush=bump) as books_writer:
+        facets = facets_writer if count_facets else None
+        while True:
+            item = await results.get()
+            QUEUE_DEPTH.set(results.qsize(), queue="detect_write")
+            if item is _DONE:
+                return
+            old_doc, update, changed = item
+            url = None
+            try:
+                url = update.get("source_url") or old_doc["source_url"]
+                if old_doc is None:
+                    # a crawl may have stored it since the listing query: update_book looks before it inserts,
+                    # and an insert's callback counts it in the facets and starts its price history
+                    await update_book(update, books_writer, facets, history_writer)
+                elif changed:
+                    await record_change(old_doc, update, books_writer, changes_writer, facets, history_writer)
                 else:
-                    alert_logger.info("Minor change detected: %s", url)
+                    await books_writer.add(UpdateOne({"source_url": url}, {"$set": update}))
+            except Exception as e:
+                alert_logger.error("Failed to store change for %s, %s", url, e)
+
+async def record_change(old_doc: dict, parsed: dict, books_writer: BulkWriter, changes_writer: BulkWriter,
+                        facets_writer: Optional[BulkWriter] = None, history_writer: Optional[BulkWriter] = None):
+    """Queue the book update and change record, and alert on significant changes"""
+    url = old_doc["source_url"]
+    html = parsed.pop("raw_html_snapshot", None)
+    parsed["crawl_timestamp"] = datetime.now(timezone.utc)
+    changed, fields = delta_update(old_doc, parsed)
+    fields["validators"] = parsed.get("validators")
+    fields["crawl_timestamp"] = parsed["crawl_timestamp"]
+    if not changed:
+        # only the fingerprint format differs (e.g. a legacy raw-HTML hash): no change to record
+        DETECT_CHANGES.inc(kind="format_only")
+        await books_writer.add(UpdateOne({"source_url": url}, {"$set": fields}))
+        return
+    if html:
+        parsed["snapshot_ref"] = fields["snapshot_ref"] = await get_snapshot_store().put(html)
+    # update only the changed fields of the main doc and write change record
+    await books_writer.add(UpdateOne({"source_url": url}, {"$set": fields, "$unset": {"raw_html_snapshot": ""}}))
+    await update_facets(facets_writer, old_doc, parsed)
+    # Record change and analyze significance
+    old_price = old_doc.get("price_including_tax", 0)
+    new_price = parsed.get("price_including_tax", 0)
+    price_change_pct = ((new_price - old_price) / old_price * 100) if old_price else 0
+
+    old_availability = old_doc.get("availability", "")
+    new_availability = parsed.get("availability", "")
+
+    # Record the change: only the fields that moved, not both whole documents
+    change = change_record(old_doc, parsed, changed, parsed["crawl_timestamp"])
+    await changes_writer.add(InsertOne(change))
+    if touches_history(changed):
+        await record_history(history_writer, parsed, change["changed_at"])
+
+    # Log and alert based on significance
+    msg = f"Change detected for book: {parsed.get('title', 'Unknown Title')} ({url})\n"
+    alert_needed = False
+
+    if abs(price_change_pct) >= 10:  # Price changed by 10% or more
+        price_msg = f"Price changed significantly: £{old_price:.2f} → £{new_price:.2f} ({price_change_pct:+.1f}%)"
+        msg += price_msg + "\n"
+        alert_needed = True
+
+    if old_availability != new_availability:
+        availability_msg = f"Availability changed: {old_availability} → {new_availability}"
+        msg += availability_msg + "\n"
+        if "In stock" not in old_availability and "In stock" in new_availability:
+            alert_needed = True  # Alert when book becomes available
+
+    DETECT_CHANGES.inc(kind="significant" if alert_needed else "minor")
+    if alert_needed:
+        alert_logger.alert("Significant Book Changes Detected", msg, level="info",
+                           extra={"url": url, "changes": changed})
+    else:
+        alert_logger.info("Minor change detected: %s", url, extra={"url": url, "changes": changed,
+                                                                  "summarize": "minor_change"})
+
+async def _detect(run: str, produce, client: Optional[httpx.AsyncClient], concurrency: int, stats: Counter):
+    """Run `produce(client, queue)` through the fetch workers and the writer, then refresh rollups"""
+    with log_context(detection_id=new_id()), parse_pool_run():
+        started_at = datetime.now(timezone.utc)
+        queue = asyncio.Queue(maxsize=max(DETECT_QUEUE_SIZE, concurrency))
+        results = asyncio.Queue(maxsize=max(DETECT_QUEUE_SIZE, concurrency))
+
+        async def run_pipeline(client):
+            writer = asyncio.create_task(_write_results(results))
+            producer = asyncio.create_task(produce(client, queue))
+            workers = [asyncio.create_task(_fetch_worker(client, queue, results, stats)) for _ in range(concurrency)]
+
+            async def watched(aw):
+                # if the writer stops, nothing drains `results`: the workers, and so all the rest, would block
+                task = asyncio.ensure_future(aw)
+                await asyncio.wait([task, writer], return_when=asyncio.FIRST_COMPLETED)
+                if not task.done():
+                    task.cancel()
+                    writer.result()
+                    raise RuntimeError("change writer stopped before the run ended")
+                return task.result()
+
+            try:
+                try:
+                    await watched(producer)
+                finally:
+                    # even after a failed walk, the workers finish what was queued
+                    for _ in workers:
+                        await watched(queue.put(_DONE))
+                await watched(asyncio.gather(*workers))
+            finally:
+                for task in [producer, *workers]:
+                    task.cancel()
+                await asyncio.gather(producer, *workers, return_exceptions=True)
+                if not writer.done():
+                    await results.put(_DONE)
+                await writer
+
+        try:
+            if client is not None:
+                await run_pipeline(client)
+            else:
+                async with make_client() as client:
+                    await run_pipeline(client)
+            log_fetch_stats(run, stats)
+        finally:
+            try:
+                # every change record of this run is written by now, even if it failed partway:
+                # refresh the rollups of the days it covered
+                await write_rollups(days_between(started_at.date(), datetime.now(timezone.utc).date()))
+            except Exception as e:
+                alert_logger.error("Failed to write change rollups, %s", e)
+    return stats
+
+async def detect_changes_for_all_books(client: Optional[httpx.AsyncClient] = None,
+                                       concurrency: Optional[int] = None) -> Counter:
+    """Re-fetch every book and compare fingerprints.
+
+    Runs as a pipeline: the books cursor feeds a bounded queue, `concurrency`
+    fetch workers share one pooled client, and a single writer persists results.
+    """
+    concurrency = concurrency or DETECT_CONCURRENCY
+    return await _detect("Change detection", lambda client, queue: _produce(queue),
+                         client, concurrency, Counter())
+
+async def revisit_books(urls: List[str], client: Optional[httpx.AsyncClient] = None,
+                        concurrency: Optional[int] = None) -> Counter:
+    """Re-fetch just these books (the revisit planner's picks) and compare fingerprints"""
+    concurrency = concurrency or DETECT_CONCURRENCY
+    query = {"source_url": {"$in": urls}}
+    return await _detect("Revisit", lambda client, queue: _produce(queue, query),
+                         client, concurrency, Counter())
+
+async def detect_changes_from_listings(client: Optional[httpx.AsyncClient] = None,
+                                       concurrency: Optional[int] = None, sample_rate: Optional[float] = None,
+                                       rng: Optional[random.Random] = None) -> Counter:
+    """Compare listing-page summaries with the database; fetch detail pages only where needed.
+
+    A catalogue page shows title, price, availability and rating for 20 books, so
+    one request covers what 20 detail fetches would. Books whose summary differs,
+    books not yet in the database and a random `sample_rate` share of the rest go
+    through the same fetch workers and writer as the full run.
+    """
+    concurrency = concurrency or DETECT_CONCURRENCY
+    sample_rate = DETECT_SAMPLE_RATE if sample_rate is None else sample_rate
+    rng = rng or random.Random()
+    stats = Counter()
+    await _detect("Listing change detection",
+                  lambda client, queue: _produce_from_listings(client, queue, stats, sample_rate, rng),
+                  client, concurrency, stats)
+    fetched = stats["summary_changed"] + stats["new"] + stats["sampled"]
+    logger.info("Listing change detection: %d books on %d listing pages; %d detail fetches (%d changed summaries, "
+                "%d new, %d sampled), %d avoided (%.0f%%)", stats["listed"], stats["listing_pages"], fetched,
+                stats["summary_changed"], stats["new"], stats["sampled"], stats["avoided"],
+                100 * stats["avoided"] / max(stats["listed"], 1))
+    return stats
+
+async def detect_changes(mode: Optional[str] = None) -> Counter:
+    """The scheduled job: a full or a listing-driven run, as DETECT_MODE says"""
+    mode = mode or DETECT_MODE
+    if mode == "full":
+        return await detect_changes_for_all_books()
+    if mode == "listing":
+        return await detect_changes_from_listings()
+    raise ValueError(f"Unknown DETECT_MODE {mode!r}; choose 'full' or 'listing'")
+
+if __name__ == "__main__":
+    # one-off run outside the planner: DETECT_MODE picks full or listing-driven
+    asyncio.run(dumps_metrics(detect_changes)())
@@ -2,21 +2,25 @@
 import asyncio
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from db.client import ensure_indexes
-from scheduler.change_detector import detect_changes_for_all_books
-from crawler.crawler import crawl_all
+from db.facets import ensure_facets
+from scheduler.planner import REVISIT_TICK_MINUTES, discover_new_books, get_planner, revisit_due_books
 from utils.logger import logger
-import asyncio
+from utils.metrics import dumps_metrics
 
 scheduler = AsyncIOScheduler()
 
 async def startup():
     await ensure_indexes()
+    # a scheduler-only deployment never runs crawl_all, which would otherwise build the facet cells
+    await ensure_facets()
+    await get_planner().load()
 
 def schedule_jobs():
-    # daily crawl at 02:00 local time
-    scheduler.add_job(crawl_all, "cron", hour=2, minute=56)
-    # daily change detection at 02:00 local time
-    scheduler.add_job(detect_changes_for_all_books, "cron", hour=2, minute=0)
+    # revisit the most overdue books, each about as often as it changes, within REVISIT_BUDGET fetches a tick
+    # with METRICS_DUMP set, every job ends with a dump of the process's metrics so far
+    scheduler.add_job(dumps_metrics(revisit_due_books), "interval", minutes=REVISIT_TICK_MINUTES)
+    # daily sweep of the listing pages at 02:00 local time picks up new books
+    scheduler.add_job(dumps_metrics(discover_new_books), "cron", hour=2, minute=0)
     scheduler.start()
 
 async def main():
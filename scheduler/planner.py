@@ -0,0 +1,165 @@
+"""Change-rate-driven revisit planning, replacing the daily full crawl and detection runs.
+
+Each book's change rate is estimated from its history in `changes` (a Poisson
+rate with a weak prior, so a book never seen to change is still revisited, just
+rarely). The book is due again once its stored copy is REVISIT_STALENESS likely
+to be out of date, within [REVISIT_MIN_INTERVAL_HOURS, REVISIT_MAX_INTERVAL_HOURS].
+A heap of due times is kept in memory; every tick revisits the most overdue
+books, at most REVISIT_BUDGET of them, through the change detector's pipeline.
+New books come from a daily listing-page sweep.
+"""
+import heapq
+import math
+import os
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+from dotenv import load_dotenv
+from db.client import db
+from scheduler.change_detector import detect_changes_from_listings, revisit_books
+from utils.logger import logger
+
+load_dotenv()
+
+REVISIT_BUDGET = int(os.getenv("REVISIT_BUDGET", "100"))  # book fetches per tick
+REVISIT_TICK_MINUTES = float(os.getenv("REVISIT_TICK_MINUTES", "60"))
+REVISIT_MIN_INTERVAL_HOURS = float(os.getenv("REVISIT_MIN_INTERVAL_HOURS", "6"))
+REVISIT_MAX_INTERVAL_HOURS = float(os.getenv("REVISIT_MAX_INTERVAL_HOURS", "168"))
+# Revisit once the stored copy is this likely to be stale
+REVISIT_STALENESS = float(os.getenv("REVISIT_STALENESS", "0.2"))
+# How far back the changes collection is read when estimating rates
+REVISIT_HISTORY_DAYS = float(os.getenv("REVISIT_HISTORY_DAYS", "90"))
+# The prior: every book counts as having changed once in this many days
+REVISIT_PRIOR_DAYS = float(os.getenv("REVISIT_PRIOR_DAYS", "30"))
+
+DAY = 86400.0
+
+class RevisitPlanner:
+    """Due times of every known book; times are epoch seconds"""
+
+    def __init__(self, budget: int = REVISIT_BUDGET, min_interval: float = REVISIT_MIN_INTERVAL_HOURS * 3600,
+                 max_interval: float = REVISIT_MAX_INTERVAL_HOURS * 3600, staleness: float = REVISIT_STALENESS,
+                 prior: float = REVISIT_PRIOR_DAYS * DAY):
+        self.budget = budget
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.staleness = staleness
+        self.prior = prior
+        # url -> [changes seen, observed since, last visit, due]
+        self._books: Dict[str, list] = {}
+        self._heap: List[Tuple[float, str]] = []  # (due, url); entries whose due moved on are skipped
+        self.stats = Counter()
+
+    def __len__(self):
+        return len(self._books)
+
+    def __contains__(self, url: str) -> bool:
+        return url in self._books
+
+    def change_rate(self, url: str, now: float) -> float:
+        """Changes per second"""
+        changes, since, _, _ = self._books[url]
+        return (changes + 1) / (max(now - since, 0.0) + self.prior)
+
+    def interval(self, rate: float) -> float:
+        """Seconds until a copy is `staleness` likely to be out of date, for a Poisson rate"""
+        return min(self.max_interval, max(self.min_interval, -math.log(1 - self.staleness) / rate))
+
+    def _schedule(self, url: str, now: float):
+        book = self._books[url]
+        book[3] = book[2] + self.interval(self.change_rate(url, now))
+        heapq.heappush(self._heap, (book[3], url))
+
+    def add(self, url: str, changes: int, since: float, last_visit: float, now: Optional[float] = None):
+        self._books[url] = [changes, since, last_visit, 0.0]
+        self._schedule(url, time.time() if now is None else now)
+
+    def due(self, now: float, limit: Optional[int] = None) -> List[str]:
+        """Take the most overdue books, at most `limit` (the budget); they are rescheduled by `visited`"""
+        limit = self.budget if limit is None else limit
+        urls = []
+        while self._heap and len(urls) < limit and self._heap[0][0] <= now:
+            due, url = heapq.heappop(self._heap)
+            book = self._books.get(url)
+            if book is not None and book[3] == due:
+                urls.append(url)
+        self.stats["overdue"] = sum(1 for due, url in self._heap if due <= now and self._books[url][3] == due)
+        return urls
+
+    def requeue(self, urls: List[str]):
+        """Put books taken by `due` back at their old due times, when their revisit did not happen"""
+        for url in urls:
+            book = self._books.get(url)
+            if book is not None:
+                heapq.heappush(self._heap, (book[3], url))
+
+    def visited(self, url: str, now: float, changed: bool):
+        book = self._books[url]
+        book[0] += int(changed)
+        book[2] = now
+        self._schedule(url, now)
+
+    def next_due(self) -> Optional[float]:
+        while self._heap and self._books[self._heap[0][1]][3] != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    async def load(self, now: Optional[float] = None) -> int:
+        """Plan every stored book not planned yet from its change history; returns how many were added"""
+        now = time.time() if now is None else now
+        start = now - REVISIT_HISTORY_DAYS * DAY
+        counts = Counter()
+        pipeline = [{"$match": {"changed_at": {"$gte": datetime.fromtimestamp(start, timezone.utc)}}},
+                    {"$group": {"_id": "$source_url", "n": {"$sum": 1}}}]
+        async for row in db.changes.aggregate(pipeline):
+            counts[row["_id"]] = row["n"]
+        added = 0
+        async for doc in db.books.find({}, {"_id": 0, "source_url": 1, "created_at": 1, "crawl_timestamp": 1}):
+            url = doc["source_url"]
+            if url in self._books:
+                continue
+            created, crawled = doc.get("created_at"), doc.get("crawl_timestamp")
+            since = max(start, _epoch(created) if created else start)
+            self.add(url, counts[url], since, _epoch(crawled) if crawled else now, now)
+            added += 1
+        logger.info("Revisit planner: %d books planned (%d new)", len(self), added)
+        return added
+
+def _epoch(value: datetime) -> float:
+    # Mongo hands back naive UTC datetimes
+    return (value if value.tzinfo else value.replace(tzinfo=timezone.utc)).timestamp()
+
+_planner = RevisitPlanner()
+
+def get_planner() -> RevisitPlanner:
+    return _planner
+
+async def revisit_due_books(planner: Optional[RevisitPlanner] = None, client=None) -> Counter:
+    """One tick: revisit the most overdue books within the budget and reschedule them"""
+    # an empty planner is falsy
+    planner = get_planner() if planner is None else planner
+    now = time.time()
+    urls = planner.due(now)
+    if not urls:
+        return Counter()
+    started = datetime.now(timezone.utc)
+    try:
+        stats = await revisit_books(urls, client=client)
+        changed = set(await db.changes.distinct("source_url", {"source_url": {"$in": urls},
+                                                              "changed_at": {"$gte": started}}))
+    except Exception:
+        # still the most overdue: the next tick takes them again
+        planner.requeue(urls)
+        raise
+    for url in urls:
+        planner.visited(url, now, url in changed)
+    logger.info("Revisit tick: %d books revisited, %d changed, %d still overdue", len(urls), len(changed),
+                planner.stats["overdue"])
+    return stats
+
+async def discover_new_books(planner: Optional[RevisitPlanner] = None) -> Counter:
+    """Daily: read the listing pages for new books (no random sample: revisits are planned) and plan them"""
+    stats = await detect_changes_from_listings(sample_rate=0)
+    await (get_planner() if planner is None else planner).load()
+    return stats
@@ -1,21 +1,84 @@
 import asyncio
+import json
+import os
 from datetime import datetime, timedelta, timezone
 from db.client import db
-from typing import List, Dict, Any
+from typing import AsyncIterator, List, Dict, Any
+from dotenv import load_dotenv
 import csv
 import io
 
+load_dotenv()
+
+REPORT_BATCH_SIZE = int(os.getenv("REPORT_BATCH_SIZE", "500"))
+
+# Fixed schema of the streamed report: top-level fields, then old./new. values of these book fields
+# (compact change records hold old/new values only for the fields in `changes`)
+REPORT_BOOK_FIELDS = ["title", "category", "price_including_tax", "price_excluding_tax",
+                      "availability", "num_reviews", "rating"]
+REPORT_COLUMNS = ["changed_at", "source_url", "title", "category", "old_fingerprint", "new_fingerprint", "changes"] + \
+    [f"{side}.{field}" for side in ("old", "new") for field in REPORT_BOOK_FIELDS]
+# Only the report columns leave Mongo: no snapshots, descriptions or internal hashes
+REPORT_PROJECTION = {"_id": 0, **{column: 1 for column in REPORT_COLUMNS}}
+
+def daily_window(day=None):
+    day = day or datetime.now(timezone.utc).date()
+    start_of_day = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+    return {"$gte": start_of_day, "$lt": start_of_day + timedelta(days=1)}
+
+def report_row(change: dict) -> list:
+    row = []
+    for column in REPORT_COLUMNS:
+        if "." in column:
+            parent, child = column.split(".")
+            value = (change.get(parent) or {}).get(child)
+        else:
+            value = change.get(column)
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        elif isinstance(value, list):
+            value = ";".join(map(str, value))
+        row.append(value)
+    return row
+
+def _ndjson_default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    return str(obj)
+
+async def stream_daily_change_report(format: str = "csv", batch_size: int = None) -> AsyncIterator[bytes]:
+    """Today's changes as CSV or NDJSON chunks, one chunk per cursor batch.
+
+    Memory stays at one batch of projected rows however many changes the day had.
+    """
+    if format not in ("csv", "ndjson"):
+        raise ValueError("Unsupported format. Choose 'csv' or 'ndjson'.")
+    batch_size = batch_size or REPORT_BATCH_SIZE
+    cursor = db.changes.find({"changed_at": daily_window()}, REPORT_PROJECTION) \
+        .sort("changed_at", -1).batch_size(batch_size)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if format == "csv":
+        writer.writerow(REPORT_COLUMNS)
+    pending = 0
+    async for change in cursor:
+        if format == "csv":
+            writer.writerow(report_row(change))
+        else:
+            buffer.write(json.dumps(change, default=_ndjson_default, separators=(",", ":")))
+            buffer.write("\n")
+        pending += 1
+        if pending >= batch_size:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
 async def generate_daily_change_report(format: str = "json") -> str:
-    today = datetime.now(timezone.utc).date()
-    start_of_day = datetime(today.year, today.month, today.day, tzinfo=timezone.utc)
-    end_of_day = start_of_day + timedelta(days=1)
-
-    changes_cursor = db.changes.find({
-        "changed_at": {
-            "$gte": start_of_day,
-            "$lt": end_of_day
-        }
-    }).sort("changed_at", -1)
+    """The whole day's report in memory; prefer stream_daily_change_report for exports"""
+    changes_cursor = db.changes.find({"changed_at": daily_window()}).sort("changed_at", -1)
 
     changes = await changes_cursor.to_list(length=None)
 
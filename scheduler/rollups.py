@@ -0,0 +1,154 @@
+"""Per-day rollups of the changes collection behind GET /report/changes.
+
+One small document per UTC day in `change_rollups` (_id "YYYY-MM-DD") holds
+counts by changed field and by category, the largest price moves and the
+availability flips of that day. The change detector rewrites the rollups of
+the days its run touched; a report over any date range then reads those
+documents by _id, and only the still-open current day is aggregated from raw
+change records.
+
+    python -m scheduler.rollups --backfill 90
+"""
+import argparse
+import asyncio
+import os
+from collections import Counter
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, Iterable, List
+from dotenv import load_dotenv
+from db.client import db
+
+load_dotenv()
+
+ROLLUP_TOP_MOVES = int(os.getenv("ROLLUP_TOP_MOVES", "10"))
+
+def day_key(day: date) -> str:
+    return day.isoformat()
+
+def day_bounds(day: date):
+    start = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+    return start, start + timedelta(days=1)
+
+def days_between(first: date, last: date) -> List[date]:
+    return [first + timedelta(days=n) for n in range((last - first).days + 1)]
+
+def _in_stock(field: str) -> dict:
+    return {"$regexMatch": {"input": {"$ifNull": [field, ""]}, "regex": "In stock"}}
+
+def rollup_pipeline(day: date) -> list:
+    """Aggregate one day of change records; old/new documents are cut down before $facet"""
+    start, end = day_bounds(day)
+    return [
+        {"$match": {"changed_at": {"$gte": start, "$lt": end}}},
+        {"$project": {
+            "_id": 0, "source_url": 1, "changes": 1,
+            # compact records carry these at the top level; older ones only in old/new
+            "title": {"$ifNull": ["$title", "$new.title", "$old.title"]},
+            "category": {"$ifNull": ["$category", "$new.category", "$old.category"]},
+            "old_price": "$old.price_including_tax", "new_price": "$new.price_including_tax",
+            "old_availability": "$old.availability", "new_availability": "$new.availability",
+        }},
+        {"$facet": {
+            "total": [{"$count": "n"}],
+            "by_field": [{"$unwind": "$changes"}, {"$group": {"_id": "$changes", "count": {"$sum": 1}}}],
+            "by_category": [{"$group": {"_id": "$category", "count": {"$sum": 1}}}],
+            "price_moves": [
+                {"$match": {"$expr": {"$and": [
+                    {"$isNumber": "$old_price"}, {"$isNumber": "$new_price"}, {"$ne": ["$old_price", "$new_price"]},
+                ]}}},
+                {"$addFields": {"delta": {"$subtract": ["$new_price", "$old_price"]}}},
+                {"$addFields": {"abs_delta": {"$abs": "$delta"}}},
+                {"$sort": {"abs_delta": -1}},
+                {"$limit": ROLLUP_TOP_MOVES},
+                {"$project": {"source_url": 1, "title": 1, "old_price": 1, "new_price": 1, "delta": 1}},
+            ],
+            "availability": [
+                {"$match": {"$expr": {"$ne": ["$old_availability", "$new_availability"]}}},
+                {"$group": {"_id": {"was": _in_stock("$old_availability"), "now": _in_stock("$new_availability")},
+                            "count": {"$sum": 1}}},
+            ],
+        }},
+    ]
+
+def _counts(groups: Iterable[dict]) -> List[dict]:
+    # lists rather than sub-documents: category names may contain "." or "$"
+    return sorted(({"value": g["_id"], "count": g["count"]} for g in groups), key=lambda c: -c["count"])
+
+def _price_move(move: dict) -> dict:
+    old = move["old_price"]
+    pct = round((move["new_price"] - old) / old * 100, 1) if old else None
+    return {**move, "delta": round(move["delta"], 2), "pct": pct}
+
+def rollup_from_facets(day: date, facets: dict) -> dict:
+    flips = {"back_in_stock": 0, "out_of_stock": 0, "other": 0}
+    for group in facets["availability"]:
+        was, now = group["_id"]["was"], group["_id"]["now"]
+        key = "back_in_stock" if now and not was else "out_of_stock" if was and not now else "other"
+        flips[key] += group["count"]
+    return {
+        "_id": day_key(day),
+        "total": facets["total"][0]["n"] if facets["total"] else 0,
+        "by_field": _counts(facets["by_field"]),
+        "by_category": _counts(facets["by_category"]),
+        "top_price_moves": [_price_move(m) for m in facets["price_moves"]],
+        "availability_flips": flips,
+        "computed_at": datetime.now(timezone.utc),
+    }
+
+async def compute_rollup(day: date) -> dict:
+    facets = await db.changes.aggregate(rollup_pipeline(day)).to_list(length=1)
+    return rollup_from_facets(day, facets[0])
+
+async def write_rollups(days: Iterable[date]) -> List[dict]:
+    """(Re)compute and store the rollups of the given days"""
+    rollups = []
+    for day in days:
+        rollup = await compute_rollup(day)
+        await db.change_rollups.replace_one({"_id": rollup["_id"]}, rollup, upsert=True)
+        rollups.append(rollup)
+    return rollups
+
+def merge_rollups(rollups: List[dict]) -> dict:
+    by_field, by_category = Counter(), Counter()
+    flips = Counter({"back_in_stock": 0, "out_of_stock": 0, "other": 0})
+    moves = []
+    for rollup in rollups:
+        by_field.update({c["value"]: c["count"] for c in rollup["by_field"]})
+        by_category.update({c["value"]: c["count"] for c in rollup["by_category"]})
+        flips.update(rollup["availability_flips"])
+        moves.extend(rollup["top_price_moves"])
+    moves.sort(key=lambda m: -abs(m["delta"]))
+    return {
+        "total": sum(r["total"] for r in rollups),
+        "by_field": [{"value": k, "count": v} for k, v in by_field.most_common()],
+        "by_category": [{"value": k, "count": v} for k, v in by_category.most_common()],
+        "top_price_moves": moves[:ROLLUP_TOP_MOVES],
+        "availability_flips": dict(flips),
+        "days": [{"day": r["_id"], "total": r["total"]} for r in rollups],
+    }
+
+async def change_report(first: date, last: date) -> dict:
+    """Merged rollups for [first, last]: closed days from change_rollups, today aggregated live"""
+    today = datetime.now(timezone.utc).date()
+    cursor = db.change_rollups.find({"_id": {"$gte": day_key(first), "$lte": day_key(last)}})
+    stored: Dict[str, dict] = {r["_id"]: r async for r in cursor}
+    rollups = []
+    for day in days_between(first, last):
+        if day > today:
+            break
+        rollup = stored.get(day_key(day))
+        if day == today:
+            rollup = await compute_rollup(day)  # still open: never served from a stored rollup
+        elif rollup is None:
+            # a closed day no detector run wrote a rollup for (e.g. before rollups existed)
+            rollup = (await write_rollups([day]))[0]
+        rollups.append(rollup)
+    return {"from": day_key(first), "to": day_key(last), **merge_rollups(rollups)}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the change_rollups collection")
+    parser.add_argument("--backfill", type=int, metavar="DAYS", help="recompute the rollups of the last DAYS days")
+    args = parser.parse_args()
+    if args.backfill:
+        today = datetime.now(timezone.utc).date()
+        asyncio.run(write_rollups(days_between(today - timedelta(days=args.backfill), today)))
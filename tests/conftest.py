@@ -0,0 +1,58 @@
+import os
+import tempfile
+
+# set before utils.logger is imported: log synchronously, so pytest captures each test's lines with it,
+# and to a scratch file rather than the working tree's books_crawler.log
+os.environ.setdefault("LOG_QUEUE", "false")
+os.environ.setdefault("LOG_FILE", os.path.join(tempfile.mkdtemp(prefix="books_crawler-tests-"), "books_crawler.log"))
+
+import pytest
+
+from api import cache as api_cache
+from api import ratelimit
+from crawler import parse_pool, throttle
+from db import snapshots
+
+
+@pytest.fixture(autouse=True)
+def snapshot_store(tmp_path, monkeypatch):
+    """Keep raw HTML snapshots on local disk so tests never reach for MongoDB"""
+    store = snapshots.SnapshotStore(snapshots.DirectorySnapshotBackend(tmp_path / "snapshots"))
+    monkeypatch.setattr(snapshots, "_store", store)
+    return store
+
+
+@pytest.fixture(autouse=True)
+def response_cache(monkeypatch):
+    """A fresh API response cache per test, on a fixed catalog generation"""
+    async def generation():
+        return 0
+
+    cache = api_cache.ResponseCache(generation=generation)
+    monkeypatch.setattr(api_cache, "_cache", cache)
+    return cache
+
+
+@pytest.fixture(autouse=True)
+def rate_limiter(monkeypatch):
+    """Fresh in-memory rate-limit counters per test"""
+    limiter = ratelimit.RateLimiter(ratelimit.MemoryRateLimitBackend())
+    monkeypatch.setattr(ratelimit, "_limiter", limiter)
+    return limiter
+
+
+@pytest.fixture(autouse=True)
+def inline_parse_pool(monkeypatch):
+    """Parse on the event loop: no worker processes per test"""
+    pool = parse_pool.ParsePool()
+    monkeypatch.setattr(parse_pool, "_pool", pool)
+    return pool
+
+
+@pytest.fixture(autouse=True)
+def fetch_throttle(monkeypatch):
+    """Fresh per-host limits and retry budget per test"""
+    limiters, budget = throttle.HostLimiters(), throttle.RetryBudget()
+    monkeypatch.setattr(throttle, "_limiters", limiters)
+    monkeypatch.setattr(throttle, "_budget", budget)
+    return limiters, budget
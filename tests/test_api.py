@@ -33,3 +33,88 @@ def test_books_with_key(monkeypatch):
     r = client.get("/books", headers={"x-api-key": API_KEY})
     assert r.status_code == 200
     assert "data" in r.json()
+
+def test_books_projects_public_fields_and_encodes_directly(monkeypatch):
+    from bson import ObjectId
+    from datetime import datetime
+    oid = ObjectId()
+    seen = {}
+
+    class FakeCursor:
+        def sort(self, *args, **kwargs):
+            return self
+        def skip(self, n):
+            return self
+        def limit(self, n):
+            return self
+        async def to_list(self, length=None):
+            return [{"_id": oid, "source_url": "https://books.toscrape.com/b1", "title": "B1",
+                     "crawl_timestamp": datetime(2025, 11, 10, 12, 0, 0)}]
+
+    def find(query, projection=None):
+        seen["projection"] = projection
+        return FakeCursor()
+
+    monkeypatch.setattr(db, "books", type("B", (), {"find": staticmethod(find)}))
+
+    r = client.get("/books", headers={"x-api-key": API_KEY})
+    assert r.status_code == 200
+    assert "raw_html_snapshot" not in seen["projection"]
+    book = r.json()["data"][0]
+    assert book["_id"] == str(oid)
+    assert book["crawl_timestamp"] == "2025-11-10T12:00:00"
+    # model defaults are filled in without per-row validation
+    assert book["status"] == "fetched" and book["num_reviews"] == 0
+
+def test_books_rejects_malformed_cursor():
+    r = client.get("/books?cursor=garbage", headers={"x-api-key": API_KEY})
+    assert r.status_code == 400
+
+BOOK_ID = "6550a1b2c3d4e5f601234567"
+
+def install_history(monkeypatch, points):
+    from bson import ObjectId
+    from datetime import datetime
+    book = {"_id": ObjectId(BOOK_ID), "source_url": "https://books.toscrape.com/b1", "price_including_tax": 12.0,
+            "availability": "In stock (3 available)", "crawl_timestamp": datetime(2025, 11, 10)}
+    seen = {}
+
+    async def find_one(query, projection=None):
+        return dict(book) if query.get("_id") == book["_id"] else None
+
+    class FakeCursor:
+        def sort(self, *args, **kwargs):
+            return self
+        def limit(self, n):
+            return self
+        async def to_list(self, length=None):
+            return [dict(p) for p in points]
+
+    def find(query, projection=None):
+        seen["query"] = query
+        return FakeCursor()
+
+    monkeypatch.setattr(db, "books", type("B", (), {"find_one": staticmethod(find_one)}))
+    monkeypatch.setattr(db, "price_history", type("H", (), {"find": staticmethod(find)}))
+    return seen
+
+def test_book_history_returns_points_oldest_first(monkeypatch):
+    from datetime import datetime
+    seen = install_history(monkeypatch, [
+        {"ts": datetime(2025, 11, 1), "price_including_tax": 10.0, "availability": "In stock (5 available)"},
+        {"ts": datetime(2025, 11, 10), "price_including_tax": 12.0, "availability": "In stock (3 available)"},
+    ])
+    r = client.get(f"/books/{BOOK_ID}/history?since=2025-10-01T00:00:00",
+                   headers={"x-api-key": API_KEY})
+    assert r.status_code == 200
+    body = r.json()
+    assert body["source_url"] == "https://books.toscrape.com/b1"
+    assert [p["price_including_tax"] for p in body["points"]] == [10.0, 12.0]
+    assert seen["query"] == {"source_url": "https://books.toscrape.com/b1", "ts": {"$gte": datetime(2025, 10, 1)}}
+
+def test_book_history_falls_back_to_current_values(monkeypatch):
+    install_history(monkeypatch, [])
+    r = client.get(f"/books/{BOOK_ID}/history", headers={"x-api-key": API_KEY})
+    assert r.json()["points"] == [{"ts": "2025-11-10T00:00:00", "price_including_tax": 12.0,
+                                   "availability": "In stock (3 available)"}]
+    assert client.get("/books/missing/history", headers={"x-api-key": API_KEY}).status_code == 404
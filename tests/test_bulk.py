@@ -0,0 +1,124 @@
+import asyncio
+
+import pytest
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from db.bulk import BulkWriter
+
+
+class FakeCollection:
+    name = "books"
+
+    def __init__(self, fail=None):
+        self.batches = []
+        self.fail = fail
+
+    async def bulk_write(self, ops, ordered=True):
+        assert ordered is False
+        self.batches.append(list(ops))
+        if self.fail:
+            raise self.fail
+        # pretend every upsert whose filter url ends in "new" was an insert
+        upserted = {i: f"id{i}" for i, op in enumerate(ops)
+                    if isinstance(op, UpdateOne) and op._filter["source_url"].endswith("new")}
+        return type("R", (), {"upserted_ids": upserted})()
+
+
+def upsert(url):
+    return UpdateOne({"source_url": url}, {"$set": {"title": url}}, upsert=True)
+
+
+@pytest.mark.asyncio
+async def test_flushes_by_size_and_reports_inserts():
+    coll = FakeCollection()
+    inserted = []
+    writer = BulkWriter(coll, max_ops=3, max_delay=60)
+    await writer.add(upsert("a"), on_insert=lambda _id: inserted.append(("a", _id)))
+    await writer.add(upsert("b-new"), on_insert=lambda _id: inserted.append(("b-new", _id)))
+    assert coll.batches == []
+    await writer.add(InsertOne({"x": 1}))
+    assert len(coll.batches) == 1 and len(coll.batches[0]) == 3
+    assert inserted == [("b-new", "id1")]
+    assert writer.ops_written == 3
+
+
+@pytest.mark.asyncio
+async def test_flushes_by_time_and_on_exit():
+    coll = FakeCollection()
+    async with BulkWriter(coll, max_ops=100, max_delay=0.01) as writer:
+        await writer.add(upsert("a"))
+        await asyncio.sleep(0.05)
+        assert len(coll.batches) == 1
+        await writer.add(upsert("b"))
+    assert [len(b) for b in coll.batches] == [1, 1]
+
+
+@pytest.mark.asyncio
+async def test_partial_failure_still_reports_inserts():
+    error = BulkWriteError({
+        "writeErrors": [{"index": 0, "code": 11000, "errmsg": "duplicate key"}],
+        "upserted": [{"index": 1, "_id": "id1"}],
+    })
+    coll = FakeCollection(fail=error)
+    inserted = []
+    writer = BulkWriter(coll, max_ops=100, max_delay=60)
+    await writer.add(upsert("a"))
+    await writer.add(upsert("b-new"), on_insert=inserted.append)
+    await writer.flush()
+    assert inserted == ["id1"]
+    assert len(writer) == 0
+
+
+@pytest.mark.asyncio
+async def test_on_flush_runs_after_each_written_batch():
+    coll = FakeCollection()
+    flushed = []
+
+    async def on_flush():
+        flushed.append(len(coll.batches))
+
+    writer = BulkWriter(coll, max_ops=2, max_delay=60, on_flush=on_flush)
+    await writer.flush()  # nothing queued: no hook
+    await writer.add(upsert("a"))
+    await writer.add(upsert("b"))
+    await writer.add(upsert("c"))
+    await writer.flush()
+    assert flushed == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_flush_reports_the_operations_not_applied():
+    error = BulkWriteError({"writeErrors": [{"index": 1, "code": 11000, "errmsg": "duplicate key"}]})
+    writer = BulkWriter(FakeCollection(fail=error), max_ops=100, max_delay=60)
+    await writer.add(upsert("a"), key="a")
+    await writer.add(upsert("b"), key="b")
+    assert await writer.flush() == [upsert("b")]
+    assert writer.take_failed() == {"b"}
+    assert writer.take_failed() == set()
+
+    writer = BulkWriter(FakeCollection(fail=ConnectionError("down")), max_ops=100, max_delay=60)
+    await writer.add(upsert("a"), key="a")
+    await writer.add(InsertOne({"x": 1}))
+    assert await writer.flush() == [upsert("a"), InsertOne({"x": 1})]
+    assert writer.failed == {"a"}
+    assert writer.ops_written == 0
+
+
+@pytest.mark.asyncio
+async def test_failing_insert_callback_does_not_stop_the_batch_or_the_ticker():
+    coll = FakeCollection()
+    inserted = []
+
+    def boom(_id):
+        raise RuntimeError("boom")
+
+    async with BulkWriter(coll, max_ops=100, max_delay=0.01) as writer:
+        await writer.add(upsert("a-new"), on_insert=boom)
+        await writer.add(upsert("b-new"), on_insert=inserted.append)
+        await asyncio.sleep(0.05)
+        assert inserted == ["id1"]
+        await writer.add(upsert("c"))
+        await asyncio.sleep(0.05)
+        # still flushed by the ticker
+        assert len(coll.batches) == 2
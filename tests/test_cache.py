@@ -0,0 +1,88 @@
+import pytest
+from fastapi.responses import Response
+from fastapi.testclient import TestClient
+
+from api import cache as api_cache
+from api.cache import ResponseCache, cache_key
+from api.main import API_KEY, app
+from db.client import db
+
+client = TestClient(app)
+
+
+def response(body: bytes) -> Response:
+    return Response(content=body, media_type="application/json")
+
+
+@pytest.mark.asyncio
+async def test_lru_eviction_by_entries_and_bytes():
+    async def generation():
+        return 0
+
+    cache = ResponseCache(generation, max_entries=2, max_bytes=10, poll=60)
+    await cache.refresh()
+    cache.put("a", response(b"1234"), 0)
+    cache.put("b", response(b"1234"), 0)
+    assert cache.get("a") is not None  # a is now the most recently used
+    cache.put("c", response(b"1234"), 0)
+    assert cache.get("b") is None and cache.get("a") is not None
+    cache.put("d", response(b"12345678"), 0)  # over max_bytes: the rest makes room
+    assert len(cache) == 1 and cache.bytes == 8
+    assert cache.stats()["evictions"] == 3
+
+
+@pytest.mark.asyncio
+async def test_generation_bump_and_ttl_invalidate():
+    current = {"value": 1}
+
+    async def generation():
+        return current["value"]
+
+    cache = ResponseCache(generation, poll=0, ttl=60)
+    await cache.refresh()
+    cache.put("a", response(b"x"), 1)
+    assert (await cache.refresh()) and cache.get("a") is not None
+    current["value"] = 2
+    await cache.refresh()
+    assert cache.get("a") is None and cache.stats()["invalidations"] == 1
+    # a response built under the previous generation is not stored
+    cache.put("a", response(b"x"), 1)
+    assert len(cache) == 0
+
+    cache.ttl = -1
+    cache.put("b", response(b"x"), 2)
+    assert cache.get("b") is None and cache.stats()["expirations"] == 1
+
+
+def test_cache_key_normalizes_parsed_params():
+    assert cache_key("books", {"min_price": 10, "category": None}) == cache_key("books", {"min_price": 10.0})
+
+
+def test_books_served_from_cache_until_disabled(monkeypatch):
+    calls = []
+
+    class FakeCursor:
+        def sort(self, *args):
+            return self
+        def skip(self, n):
+            return self
+        def limit(self, n):
+            return self
+        async def to_list(self, length=None):
+            return []
+
+    def find(query, projection=None):
+        calls.append(query)
+        return FakeCursor()
+
+    monkeypatch.setattr(db, "books", type("B", (), {"find": staticmethod(find)}))
+    headers = {"x-api-key": API_KEY}
+    first = client.get("/books?min_price=10", headers=headers)
+    second = client.get("/books?min_price=10.0", headers=headers)
+    assert first.headers["x-cache"] == "MISS" and second.headers["x-cache"] == "HIT"
+    assert first.content == second.content and len(calls) == 1
+    assert client.get("/cache/stats", headers=headers).json()["hits"] == 1
+
+    monkeypatch.setattr(api_cache, "API_CACHE_ENDPOINTS", {"book", "changes"})
+    client.get("/books?min_price=10", headers=headers)
+    assert len(calls) == 2
@@ -0,0 +1,325 @@
+import asyncio
+import random
+from datetime import datetime, timezone
+
+import httpx
+import pytest
+
+from crawler import crawler
+from crawler.fingerprint import fingerprint
+from crawler.parser import parse_book_page
+from scheduler import change_detector
+
+BOOK_HTML = """
+<html><body>
+  <div class="product_main"><h1>Book {n}</h1></div>
+  <table class="table table-striped">
+    <tr><th>Price (incl. tax)</th><td>£{price}</td></tr>
+    <tr><th>Availability</th><td>In stock (20 available)</td></tr>
+  </table>
+</body></html>
+"""
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self._docs = docs
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self._docs:
+            yield dict(doc)
+
+
+class FakeBulkResult:
+    def __init__(self, upserted_ids=None):
+        self.upserted_ids = upserted_ids or {}
+
+
+class FakeBooks:
+    name = "books"
+
+    def __init__(self, docs):
+        self.docs = {d["source_url"]: d for d in docs}
+        self.updates = []
+        self.bulk_writes = 0
+
+    def find(self, query=None, projection=None):
+        urls = (query or {}).get("source_url", {}).get("$in")
+        return FakeCursor([d for d in self.docs.values() if urls is None or d["source_url"] in urls])
+
+    async def find_one(self, query, projection=None):
+        doc = self.docs.get(query["source_url"])
+        return dict(doc) if doc else None
+
+    async def bulk_write(self, ops, ordered=True):
+        self.bulk_writes += 1
+        self.updates.extend((op._filter["source_url"], op._doc) for op in ops)
+        # upserts of unknown books are inserts
+        return FakeBulkResult({i: op._filter["source_url"] for i, op in enumerate(ops)
+                               if op._upsert and op._filter["source_url"] not in self.docs})
+
+
+class FakeChanges:
+    name = "changes"
+
+    def __init__(self):
+        self.inserted = []
+
+    async def bulk_write(self, ops, ordered=True):
+        self.inserted.extend(op._doc for op in ops)
+        return FakeBulkResult()
+
+
+class FakeFacets:
+    name = "book_facets"
+
+    def __init__(self):
+        self.incs = []
+
+    async def bulk_write(self, ops, ordered=True):
+        self.incs.extend((op._filter["price_bucket"], op._doc["$inc"]["count"]) for op in ops)
+        return FakeBulkResult()
+
+
+class FakeMeta:
+    def __init__(self, facets_built=True):
+        self.bumps = 0
+        self.facets_built = facets_built
+
+    async def find_one(self, query):
+        return {"_id": query["_id"]} if self.facets_built else None
+
+    async def update_one(self, query, update, upsert=False):
+        self.bumps += update["$inc"]["value"]
+
+
+class FakeHistory(FakeChanges):
+    name = "price_history"
+
+
+class FakeDB:
+    def __init__(self, docs):
+        self.books = FakeBooks(docs)
+        self.changes = FakeChanges()
+        self.price_history = FakeHistory()
+        self.book_facets = FakeFacets()
+        self.meta = FakeMeta()
+
+
+@pytest.mark.asyncio
+async def test_detect_changes_runs_fetches_concurrently(monkeypatch):
+    n_books = 12
+    pages = {f"https://books.toscrape.com/b{i}": BOOK_HTML.format(n=i, price="10.00") for i in range(n_books)}
+    docs = []
+    for url, html in pages.items():
+        doc = parse_book_page(html, url)
+        doc["fingerprint"] = fingerprint(doc)
+        docs.append(doc)
+    # one book changed its price since the last crawl
+    changed_url = "https://books.toscrape.com/b3"
+    pages[changed_url] = BOOK_HTML.format(n=3, price="17.50")
+    fake_db = FakeDB(docs)
+    monkeypatch.setattr(change_detector, "db", fake_db)
+    monkeypatch.setattr(crawler, "db", fake_db)
+    rolled_up = []
+
+    async def write_rollups(days):
+        rolled_up.extend(days)
+
+    monkeypatch.setattr(change_detector, "write_rollups", write_rollups)
+
+    in_flight, peak = 0, 0
+
+    async def handler(request):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return httpx.Response(200, text=pages[str(request.url)])
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        await change_detector.detect_changes_for_all_books(client=client, concurrency=4)
+
+    assert peak == 4
+    assert [c["source_url"] for c in fake_db.changes.inserted] == [changed_url]
+    change = fake_db.changes.inserted[0]
+    assert change["changes"] == ["price_including_tax"]
+    # the record keeps only the changed field's old and new values
+    assert change["old"] == {"price_including_tax": 10.0}
+    assert change["new"] == {"price_including_tax": 17.5}
+    assert change["title"] == "Book 3"
+    # and the new price joined the book's history
+    [point] = fake_db.price_history.inserted
+    assert (point["source_url"], point["price_including_tax"]) == (changed_url, 17.5)
+    updated = dict(fake_db.books.updates)
+    # only the changed field (plus bookkeeping) is written
+    assert updated[changed_url]["$set"]["price_including_tax"] == 17.5
+    assert "title" not in updated[changed_url]["$set"]
+    # the book moved from the 10-15 to the 15-20 facet cell
+    assert sorted(fake_db.book_facets.incs) == [(10.0, -1), (15.0, 1)]
+    # API caches were told the catalog moved on
+    assert fake_db.meta.bumps > 0
+    # and today's rollup was refreshed once the run finished
+    assert rolled_up[-1] == datetime.now(timezone.utc).date()
+    # all book writes of the run went out in a single bulk write
+    assert fake_db.books.bulk_writes == 1
+
+
+@pytest.mark.asyncio
+async def test_failed_run_still_rolls_up_the_changes_it_wrote(monkeypatch):
+    url = "https://books.toscrape.com/b0"
+    doc = parse_book_page(BOOK_HTML.format(n=0, price="10.00"), url)
+    doc["fingerprint"] = fingerprint(doc)
+    fake_db = FakeDB([doc])
+    monkeypatch.setattr(change_detector, "db", fake_db)
+    monkeypatch.setattr(crawler, "db", fake_db)
+
+    class BrokenCursor(FakeCursor):
+        async def _iterate(self):
+            async for doc in super()._iterate():
+                yield doc
+            raise RuntimeError("cursor lost")
+
+    fake_db.books.find = lambda query, projection=None: BrokenCursor([doc])
+    rolled_up = []
+
+    async def write_rollups(days):
+        rolled_up.extend(days)
+
+    monkeypatch.setattr(change_detector, "write_rollups", write_rollups)
+
+    def handler(request):
+        return httpx.Response(200, text=BOOK_HTML.format(n=0, price="12.00"))
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        with pytest.raises(RuntimeError, match="cursor lost"):
+            await change_detector.detect_changes_for_all_books(client=client, concurrency=2)
+
+    assert [c["source_url"] for c in fake_db.changes.inserted] == [url]
+    assert rolled_up[-1] == datetime.now(timezone.utc).date()
+
+
+@pytest.mark.asyncio
+async def test_run_fails_instead_of_hanging_when_the_writer_stops(monkeypatch):
+    pages = {f"https://books.toscrape.com/b{i}": BOOK_HTML.format(n=i, price="12.00") for i in range(20)}
+    docs = []
+    for url in pages:
+        doc = parse_book_page(BOOK_HTML.format(n=url[-1], price="10.00"), url)
+        doc["fingerprint"] = fingerprint(doc)
+        docs.append(doc)
+    fake_db = FakeDB(docs)
+    monkeypatch.setattr(change_detector, "db", fake_db)
+    monkeypatch.setattr(crawler, "db", fake_db)
+    monkeypatch.setattr(change_detector, "DETECT_QUEUE_SIZE", 1)
+
+    async def facets_built(meta):
+        raise ConnectionError("mongo down")
+
+    monkeypatch.setattr(change_detector, "facets_built", facets_built)
+
+    async def write_rollups(days):
+        pass
+
+    monkeypatch.setattr(change_detector, "write_rollups", write_rollups)
+
+    def handler(request):
+        return httpx.Response(200, text=pages[str(request.url)])
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        with pytest.raises(ConnectionError):
+            await asyncio.wait_for(change_detector.detect_changes_for_all_books(client=client, concurrency=2), 5)
+
+
+def listing(books, next_href=None):
+    """A catalogue page showing (n, price) pods for BOOK_HTML books"""
+    pods = "".join(f'<article class="product_pod"><h3><a href="/b{n}" title="Book {n}">Book {n}</a></h3>'
+                   f'<p class="price_color">£{price}</p><p class="instock availability">In stock</p></article>'
+                   for n, price in books)
+    pager = f'<ul class="pager"><li class="next"><a href="{next_href}">next</a></li></ul>' if next_href else ""
+    return f"<html><body>{pods}{pager}</body></html>"
+
+
+def detail_pages(urls):
+    return [url for url in urls if url.rsplit("/", 1)[-1].startswith("b")]
+
+
+async def run_listing_detection(monkeypatch, sample_rate, facets_built=True):
+    """Six stored books; on the site book 2 changed price, and book 6 is new"""
+    pages = {f"https://books.toscrape.com/b{i}": BOOK_HTML.format(n=i, price="10.00") for i in range(7)}
+    docs = []
+    for i in range(6):
+        url = f"https://books.toscrape.com/b{i}"
+        doc = parse_book_page(pages[url], url)
+        doc["fingerprint"] = fingerprint(doc)
+        docs.append(doc)
+    pages["https://books.toscrape.com/b2"] = BOOK_HTML.format(n=2, price="12.00")
+    pages["https://books.toscrape.com/"] = listing([(0, "10.00"), (1, "10.00"), (2, "12.00")], "page-2.html")
+    # book 1 is linked from both pages
+    pages["https://books.toscrape.com/page-2.html"] = listing([(1, "10.00"), (3, "10.00"), (4, "10.00"),
+                                                              (5, "10.00"), (6, "10.00")])
+    fake_db = FakeDB(docs)
+    fake_db.meta.facets_built = facets_built
+    monkeypatch.setattr(change_detector, "db", fake_db)
+    monkeypatch.setattr(crawler, "db", fake_db)
+
+    async def write_rollups(days):
+        pass
+
+    monkeypatch.setattr(change_detector, "write_rollups", write_rollups)
+    requested = []
+
+    def handler(request):
+        requested.append(str(request.url))
+        return httpx.Response(200, text=pages[str(request.url)])
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        stats = await change_detector.detect_changes_from_listings(
+            client=client, concurrency=2, sample_rate=sample_rate, rng=random.Random(1))
+    stored = [url for url, update in fake_db.books.updates if "$setOnInsert" in update]
+    return fake_db, stats, requested, stored
+
+
+@pytest.mark.asyncio
+async def test_listing_detection_fetches_only_changed_and_new_books(monkeypatch):
+    fake_db, stats, requested, stored = await run_listing_detection(monkeypatch, sample_rate=0)
+
+    assert detail_pages(requested) == ["https://books.toscrape.com/b2", "https://books.toscrape.com/b6"]
+    assert stored == ["https://books.toscrape.com/b6"]
+    assert [c["source_url"] for c in fake_db.changes.inserted] == ["https://books.toscrape.com/b2"]
+    # the new book is counted in the facets and gets its first history point, like a crawled one
+    assert (10.0, 1) in [(bucket, n) for bucket, n in fake_db.book_facets.incs if n > 0]
+    assert sorted(p["source_url"] for p in fake_db.price_history.inserted) == \
+        ["https://books.toscrape.com/b2", "https://books.toscrape.com/b6"]
+    assert fake_db.meta.bumps > 0
+    assert (stats["listing_pages"], stats["listed"], stats["summary_changed"], stats["new"], stats["avoided"]) == \
+        (2, 7, 1, 1, 5)
+
+
+@pytest.mark.asyncio
+async def test_listing_detection_samples_unchanged_books(monkeypatch):
+    fake_db, stats, requested, stored = await run_listing_detection(monkeypatch, sample_rate=1.0)
+
+    assert sorted(detail_pages(requested)) == [f"https://books.toscrape.com/b{i}" for i in range(7)]
+    assert (stats["sampled"], stats["avoided"]) == (5, 0)
+    # the sampled books are unchanged: still only one change record
+    assert [c["source_url"] for c in fake_db.changes.inserted] == ["https://books.toscrape.com/b2"]
+
+
+@pytest.mark.asyncio
+async def test_no_facet_deltas_before_the_cells_are_built(monkeypatch):
+    fake_db, stats, requested, stored = await run_listing_detection(monkeypatch, sample_rate=0, facets_built=False)
+
+    assert stored == ["https://books.toscrape.com/b6"]
+    assert fake_db.book_facets.incs == []
+
+
+def test_summary_changes_ignores_stock_count():
+    doc = {"title": "T", "price_including_tax": 10.0, "availability": "In stock (3 available)", "rating": 4}
+    summary = {"title": "T", "price_including_tax": 10.0, "availability": "In stock", "rating": 4}
+    assert change_detector.summary_changes(doc, summary) == []
+    summary.update(availability="Out of stock", rating=5)
+    assert change_detector.summary_changes(doc, summary) == ["availability", "rating"]
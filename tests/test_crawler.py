@@ -0,0 +1,393 @@
+import asyncio
+from collections import Counter
+
+import httpx
+import pytest
+from pymongo.errors import BulkWriteError
+
+from crawler import crawler
+from crawler import parse_pool
+from crawler.fingerprint import fingerprint
+from crawler.index import FingerprintIndex
+from crawler.parser import parse_book_page
+from db import snapshots
+
+BOOK_URL = "https://books.toscrape.com/catalogue/test_1/index.html"
+BOOK_HTML = """
+<html><body>
+  <div class="product_main"><h1>Test Book</h1><p class="star-rating Three"></p></div>
+  <table class="table table-striped">
+    <tr><th>Price (incl. tax)</th><td>£10.00</td></tr>
+    <tr><th>Availability</th><td>In stock (20 available)</td></tr>
+  </table>
+</body></html>
+"""
+
+
+def make_client(handler):
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def etag_handler(etag='"v1"'):
+    """Serve BOOK_HTML with an ETag and honour If-None-Match"""
+    def handler(request):
+        if request.headers.get("if-none-match") == etag:
+            return httpx.Response(304, headers={"etag": etag})
+        return httpx.Response(200, text=BOOK_HTML, headers={
+            "etag": etag,
+            "last-modified": "Wed, 21 Oct 2015 07:28:00 GMT",
+        })
+    return handler
+
+
+class FakeBooks:
+    def __init__(self, existing=None):
+        self.existing = existing
+        self.updates = []
+
+    async def find_one(self, query, projection=None):
+        return self.existing
+
+    async def update_one(self, query, update, upsert=False):
+        self.updates.append(update)
+        return type("R", (), {"upserted_id": None if self.existing else "new"})()
+
+
+class FakeDB:
+    def __init__(self, existing=None):
+        self.books = FakeBooks(existing)
+
+
+@pytest.mark.asyncio
+async def test_fetch_conditional_returns_body_and_validators():
+    stats = Counter()
+    async with make_client(etag_handler()) as client:
+        html, validators = await crawler.fetch_conditional(client, BOOK_URL, None, stats)
+    assert "Test Book" in html
+    assert validators["etag"] == '"v1"'
+    assert validators["last_modified"] == "Wed, 21 Oct 2015 07:28:00 GMT"
+    assert stats == Counter({200: 1})
+
+
+@pytest.mark.asyncio
+async def test_fetch_conditional_not_modified():
+    seen = []
+
+    def handler(request):
+        seen.append(dict(request.headers))
+        return etag_handler()(request)
+
+    stats = Counter()
+    validators = {"etag": '"v1"', "last_modified": "Wed, 21 Oct 2015 07:28:00 GMT"}
+    async with make_client(handler) as client:
+        html, returned = await crawler.fetch_conditional(client, BOOK_URL, validators, stats)
+    assert html is None
+    assert returned == validators
+    assert seen[0]["if-none-match"] == '"v1"'
+    assert seen[0]["if-modified-since"] == "Wed, 21 Oct 2015 07:28:00 GMT"
+    assert stats == Counter({304: 1})
+
+
+@pytest.mark.asyncio
+async def test_fetch_book_and_store_skips_parse_on_304(monkeypatch):
+    fake_db = FakeDB({"fingerprint": "fp", "validators": {"etag": '"v1"'}})
+    monkeypatch.setattr(crawler, "db", fake_db)
+
+    def fail_parse(*args, **kwargs):
+        raise AssertionError("parse_book_page should not run on 304")
+
+    monkeypatch.setattr(parse_pool, "parse_book_page", fail_parse)
+
+    stats = Counter()
+    async with make_client(etag_handler()) as client:
+        await crawler.fetch_book_and_store(client, BOOK_URL, stats)
+    assert stats == Counter({304: 1})
+    # only the crawl timestamp is touched
+    assert list(fake_db.books.updates[0]["$set"]) == ["crawl_timestamp"]
+
+
+@pytest.mark.asyncio
+async def test_fetch_book_and_store_persists_validators(monkeypatch):
+    fake_db = FakeDB()
+    monkeypatch.setattr(crawler, "db", fake_db)
+
+    stats = Counter()
+    async with make_client(etag_handler()) as client:
+        await crawler.fetch_book_and_store(client, BOOK_URL, stats)
+    assert stats == Counter({200: 1})
+    stored = fake_db.books.updates[0]["$set"]
+    assert stored["title"] == "Test Book"
+    assert stored["validators"]["etag"] == '"v1"'
+    # the page itself goes to the snapshot store, the document keeps only the reference
+    assert "raw_html_snapshot" not in stored
+    assert await snapshots.get_snapshot_store().get(stored["snapshot_ref"]) == BOOK_HTML
+
+
+@pytest.mark.asyncio
+async def test_fetch_book_and_store_uses_index_instead_of_db(monkeypatch):
+    fake_db = FakeDB()
+
+    async def no_find_one(*args, **kwargs):
+        raise AssertionError("find_one should not be used when an index is given")
+
+    fake_db.books.find_one = no_find_one
+    monkeypatch.setattr(crawler, "db", fake_db)
+
+    index = FingerprintIndex()
+    index.put(BOOK_URL, fingerprint(parse_book_page(BOOK_HTML, BOOK_URL)))
+    async with make_client(etag_handler()) as client:
+        await crawler.fetch_book_and_store(client, BOOK_URL, index=index)
+    # unchanged page: only bookkeeping fields are written, and the index learns the validators
+    assert set(fake_db.books.updates[0]["$set"]) == {"crawl_timestamp", "validators"}
+    assert index.get(BOOK_URL)["validators"]["etag"] == '"v1"'
+    assert index.hits == 2
+
+
+@pytest.mark.asyncio
+async def test_index_miss_on_a_stored_book_moves_its_facet_cell(monkeypatch):
+    stored = parse_book_page(BOOK_HTML.replace("£10.00", "£22.00"), BOOK_URL)
+    fake_db = FakeDB(stored)
+    monkeypatch.setattr(crawler, "db", fake_db)
+    incs = []
+
+    class Facets:
+        async def add(self, op, on_insert=None, key=None):
+            incs.append((op._filter["price_bucket"], op._doc["$inc"]["count"]))
+
+    async with make_client(etag_handler()) as client:
+        await crawler.fetch_book_and_store(client, BOOK_URL, index=FingerprintIndex(), facets=Facets())
+    # updated in place rather than upserted, and counted out of its old cell
+    assert "$setOnInsert" not in fake_db.books.updates[0]
+    assert incs == [(20.0, -1), (10.0, 1)]
+
+
+def listing(book_ids, next_href=None):
+    pods = "".join(f'<article class="product_pod"><h3><a href="/catalogue/book-{i}_{i}/index.html">{i}</a></h3></article>'
+                   for i in book_ids)
+    pager = f'<ul class="pager"><li class="next"><a href="{next_href}">next</a></li></ul>' if next_href else ""
+    return f"<html><body>{pods}{pager}</body></html>"
+
+
+class FakeCrawlUrls:
+    """Enough of a collection for CrawlCheckpoint: _id-keyed upserts, find and delete_many"""
+
+    def __init__(self, docs=None):
+        self.docs = {doc["_id"]: dict(doc) for doc in docs or []}
+        self.name = "crawl_urls"
+        self.batches = []
+
+    async def bulk_write(self, ops, ordered=True):
+        self.batches.append(len(ops))
+        for op in ops:
+            doc = self.docs.get(op._filter["_id"])
+            if doc is None:
+                if not op._upsert:
+                    continue
+                doc = self.docs[op._filter["_id"]] = {"_id": op._filter["_id"], **op._doc.get("$setOnInsert", {})}
+            doc.update(op._doc.get("$set", {}))
+            for key, n in op._doc.get("$inc", {}).items():
+                doc[key] = doc.get(key, 0) + n
+            for key in op._doc.get("$unset", {}):
+                doc.pop(key, None)
+        return type("R", (), {"upserted_ids": {}})()
+
+    async def delete_many(self, query):
+        self.docs.clear()
+
+    async def _iterate(self):
+        for doc in list(self.docs.values()):
+            yield dict(doc)
+
+    def find(self, query=None, projection=None):
+        return self._iterate()
+
+
+class FakeCrawlBooks:
+    name = "books"
+
+    async def bulk_write(self, ops, ordered=True):
+        return type("R", (), {"upserted_ids": {}})()
+
+
+def install_crawl_fakes(monkeypatch, pages, events, fetch_book=None, state=None, crawl_urls=None):
+    """Stub everything crawl_all touches besides discovery, the frontier and the checkpoints"""
+    def handler(request):
+        events.append(("listing", str(request.url)))
+        return httpx.Response(200, text=pages[str(request.url)])
+
+    async def record_book(client, book_url, *args):
+        events.append(("book", book_url))
+
+    async def get_state():
+        return state
+
+    saved = []
+
+    async def save_state(next_url):
+        saved.append(next_url)
+
+    async def empty_index(collection):
+        return FingerprintIndex()
+
+    async def noop():
+        pass
+
+    crawl_urls = crawl_urls or FakeCrawlUrls()
+    monkeypatch.setattr(crawler, "db", type("D", (), {"books": FakeCrawlBooks(), "book_facets": None, "meta": None,
+                                                      "price_history": None, "crawl_urls": crawl_urls})())
+    monkeypatch.setattr(crawler, "make_client", lambda: make_client(handler))
+    monkeypatch.setattr(crawler, "fetch_book_and_store", fetch_book or record_book)
+    monkeypatch.setattr(crawler, "get_crawler_state", get_state)
+    monkeypatch.setattr(crawler, "save_crawler_state", save_state)
+    monkeypatch.setattr(crawler, "ensure_facets", noop)
+    monkeypatch.setattr(FingerprintIndex, "load", empty_index)
+    monkeypatch.setattr(crawler, "CRAWL_QUEUE_SIZE", 1)
+    return saved, crawl_urls
+
+
+def book(i):
+    return f"{crawler.BASE}catalogue/book-{i}_{i}/index.html"
+
+
+SITE = {
+    crawler.BASE: listing(range(0, 5), "catalogue/page-2.html"),
+    crawler.BASE + "catalogue/page-2.html": listing(range(3, 8)),  # books 3 and 4 are linked twice
+}
+
+
+@pytest.mark.asyncio
+async def test_crawl_all_fetches_books_while_still_discovering(monkeypatch):
+    events = []
+    saved, crawl_urls = install_crawl_fakes(monkeypatch, SITE, events)
+
+    await crawler.crawl_all(concurrency=1)
+
+    books = [url for kind, url in events if kind == "book"]
+    assert books == [book(i) for i in range(8)]
+    # the bounded frontier lets the worker start before the second listing page is even requested
+    second_listing = events.index(("listing", crawler.BASE + "catalogue/page-2.html"))
+    assert ("book", books[0]) in events[:second_listing]
+    assert saved == [crawler.BASE, crawler.BASE + "catalogue/page-2.html", None]
+    assert {url: (doc["status"], doc["attempts"]) for url, doc in crawl_urls.docs.items()} == \
+        {book(i): ("done", 1) for i in range(8)}
+
+
+@pytest.mark.asyncio
+async def test_crawl_all_records_a_failed_book_and_carries_on(monkeypatch):
+    events = []
+
+    async def fail_book_2(client, book_url, *args):
+        if book_url == book(2):
+            raise RuntimeError("boom")
+
+    saved, crawl_urls = install_crawl_fakes(monkeypatch, SITE, events, fetch_book=fail_book_2)
+    await crawler.crawl_all(concurrency=2)
+    assert crawl_urls.docs[book(2)]["status"] == "failed"
+    assert crawl_urls.docs[book(2)]["error"] == "boom"
+    assert sum(doc["status"] == "done" for doc in crawl_urls.docs.values()) == 7
+    assert saved[-1] is None
+
+
+@pytest.mark.asyncio
+async def test_crawl_all_resumes_only_unfinished_books(monkeypatch):
+    events = []
+    crawl_urls = FakeCrawlUrls([
+        {"_id": book(0), "status": "done", "attempts": 1},
+        {"_id": book(1), "status": "pending", "attempts": 0},
+        {"_id": book(2), "status": "failed", "attempts": 1},
+        {"_id": book(3), "status": "failed", "attempts": 3},  # out of attempts
+    ])
+    state = {"crawler_id": "main", "last_page_url": crawler.BASE + "catalogue/page-2.html"}
+    install_crawl_fakes(monkeypatch, SITE, events, state=state, crawl_urls=crawl_urls)
+
+    await crawler.crawl_all(concurrency=1)
+
+    assert [url for kind, url in events if kind == "book"] == [book(i) for i in (1, 2, 4, 5, 6, 7)]
+    assert ("listing", crawler.BASE) not in events
+    assert crawl_urls.docs[book(2)] == {"_id": book(2), "status": "done", "attempts": 2,
+                                        "updated_at": crawl_urls.docs[book(2)]["updated_at"]}
+    assert crawl_urls.docs[book(3)]["status"] == "failed"
+
+
+@pytest.mark.asyncio
+async def test_checkpoint_lands_book_writes_before_marking_done():
+    order = []
+
+    class Recording:
+        def __init__(self, name):
+            self.name = name
+
+        async def bulk_write(self, ops, ordered=True):
+            order.append((self.name, len(ops)))
+            return type("R", (), {"upserted_ids": {}})()
+
+    books_writer = crawler.BulkWriter(Recording("books"))
+    checkpoint = crawler.CrawlCheckpoint(Recording("crawl_urls"), books_writer)
+    await books_writer.add(crawler.UpdateOne({"source_url": book(0)}, {"$set": {"title": "x"}}))
+    await checkpoint.done(book(0))
+    assert order == []  # nothing is durable yet, so nothing is marked
+    await checkpoint.flush()
+    assert order == [("books", 1), ("crawl_urls", 1)]
+
+
+@pytest.mark.asyncio
+async def test_checkpoint_keeps_books_whose_write_failed_pending():
+    written = []
+
+    class Books:
+        name = "books"
+
+        async def bulk_write(self, ops, ordered=True):
+            raise BulkWriteError({"writeErrors": [{"index": 1, "code": 2, "errmsg": "bad"}]})
+
+    class CrawlUrls:
+        name = "crawl_urls"
+
+        async def bulk_write(self, ops, ordered=True):
+            written.extend(ops)
+            return type("R", (), {"upserted_ids": {}})()
+
+    books_writer = crawler.BulkWriter(Books())
+    checkpoint = crawler.CrawlCheckpoint(CrawlUrls(), books_writer)
+    for i in range(2):
+        await crawler.store_book({"source_url": book(i), "title": "x"}, books_writer)
+        await checkpoint.done(book(i))
+    await checkpoint.flush()
+    statuses = {op._filter["_id"]: op._doc["$set"]["status"] for op in written}
+    assert statuses == {book(0): "done", book(1): "pending"}
+    assert books_writer.failed == set()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_checkpoint_flushes_keep_a_failed_write_pending():
+    written, release = [], asyncio.Event()
+
+    class Books:
+        name = "books"
+
+        async def bulk_write(self, ops, ordered=True):
+            await release.wait()
+            failed = [{"index": i, "code": 2, "errmsg": "bad"} for i, op in enumerate(ops)
+                      if op._filter["source_url"] == book(1)]
+            raise BulkWriteError({"writeErrors": failed})
+
+    class CrawlUrls:
+        name = "crawl_urls"
+
+        async def bulk_write(self, ops, ordered=True):
+            written.extend(ops)
+            return type("R", (), {"upserted_ids": {}})()
+
+    books_writer = crawler.BulkWriter(Books())
+    checkpoint = crawler.CrawlCheckpoint(CrawlUrls(), books_writer)
+    await crawler.store_book({"source_url": book(0), "title": "x"}, books_writer)
+    await checkpoint.done(book(0))
+    await crawler.store_book({"source_url": book(1), "title": "x"}, books_writer)
+    first = asyncio.create_task(checkpoint.flush())  # lands both writes, but only marks book 0
+    await asyncio.sleep(0)
+    await checkpoint.done(book(1))
+    second = asyncio.create_task(checkpoint.flush())
+    release.set()
+    await asyncio.gather(first, second)
+    statuses = {op._filter["_id"]: op._doc["$set"]["status"] for op in written}
+    assert statuses == {book(0): "done", book(1): "pending"}
@@ -0,0 +1,320 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import httpx
+import pytest
+
+from crawler import distributed
+from crawler.checkpoint import DONE, FAILED, LEASED, PENDING, CrawlCheckpoint
+from crawler.index import FingerprintIndex
+
+T0 = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def book(i):
+    return f"{distributed.BASE}catalogue/book-{i}_{i}/index.html"
+
+
+def _matches(doc, query):
+    for key, cond in query.items():
+        if key == "$or":
+            if not any(_matches(doc, q) for q in cond):
+                return False
+            continue
+        value = doc.get(key)
+        if isinstance(cond, dict):
+            if "$lt" in cond and not (value is not None and value < cond["$lt"]):
+                return False
+            if "$gte" in cond and not (value is not None and value >= cond["$gte"]):
+                return False
+            if "$in" in cond and value not in cond["$in"]:
+                return False
+        elif value != cond:
+            return False
+    return True
+
+
+def _apply(doc, update):
+    doc.update(update.get("$set", {}))
+    for key, n in update.get("$inc", {}).items():
+        doc[key] = doc.get(key, 0) + n
+    for key in update.get("$unset", {}):
+        doc.pop(key, None)
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, keys):
+        for field, order in reversed(keys):
+            self.docs.sort(key=lambda d: d.get(field), reverse=order < 0)
+        return self
+
+    def limit(self, n):
+        self.docs = self.docs[:n]
+        return self
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self.docs:
+            yield {"_id": doc["_id"]}
+
+
+class FakeQueue:
+    """Enough of crawl_queue for LeaseQueue and CrawlCheckpoint"""
+
+    def __init__(self, docs=None):
+        self.docs = {doc["_id"]: dict(doc) for doc in docs or []}
+        self.name = "crawl_queue"
+
+    def find(self, query, projection=None):
+        return FakeCursor([d for d in self.docs.values() if _matches(d, query)])
+
+    async def update_many(self, query, update):
+        matched = [doc for doc in self.docs.values() if _matches(doc, query)]
+        for doc in matched:
+            _apply(doc, update)
+        return type("R", (), {"modified_count": len(matched)})()
+
+    async def count_documents(self, query):
+        return sum(_matches(d, query) for d in self.docs.values())
+
+    async def bulk_write(self, ops, ordered=True):
+        for op in ops:
+            doc = self.docs.get(op._filter["_id"])
+            if doc is None:
+                if not op._upsert:
+                    continue
+                doc = self.docs[op._filter["_id"]] = {"_id": op._filter["_id"], **op._doc.get("$setOnInsert", {})}
+            _apply(doc, op._doc)
+        return type("R", (), {"upserted_ids": {}})()
+
+    async def delete_many(self, query):
+        self.docs.clear()
+
+    def status(self, url):
+        return self.docs[url]["status"]
+
+
+class FakeState:
+    def __init__(self, doc=None):
+        self.doc = doc
+
+    async def find_one(self, query):
+        return self.doc
+
+    async def update_one(self, query, update, upsert=False):
+        self.doc = {**(self.doc or query), **update["$set"]}
+
+
+class FakeBooks:
+    name = "books"
+
+    async def bulk_write(self, ops, ordered=True):
+        return type("R", (), {"upserted_ids": {}})()
+
+
+def pending(urls, start=T0):
+    return [{"_id": url, "status": PENDING, "attempts": 0, "discovered_at": start + timedelta(seconds=i)}
+            for i, url in enumerate(urls)]
+
+
+def install_fakes(monkeypatch, queue, state=None):
+    fake_db = type("D", (), {"crawl_queue": queue, "crawler_state": FakeState(state), "books": FakeBooks(),
+                             "book_facets": None, "price_history": None, "meta": None})()
+
+    async def empty_index(collection):
+        return FingerprintIndex()
+
+    async def noop():
+        pass
+
+    monkeypatch.setattr(distributed, "db", fake_db)
+    monkeypatch.setattr(distributed, "ensure_facets", noop)
+    monkeypatch.setattr(FingerprintIndex, "load", empty_index)
+    return fake_db
+
+
+@pytest.mark.asyncio
+async def test_claim_leases_oldest_pending_urls_once():
+    queue = FakeQueue(pending([book(i) for i in range(5)]))
+    leases = distributed.LeaseQueue(queue, lease_seconds=60)
+
+    first = await leases.claim("a", 3)
+    second = await leases.claim("b", 3)
+    assert first == [book(0), book(1), book(2)]
+    assert second == [book(3), book(4)]
+    assert await leases.claim("c", 3) == []
+    doc = queue.docs[book(0)]
+    assert (doc["status"], doc["lease_owner"], doc["leases"]) == (LEASED, "a", 1)
+    assert doc["lease_expires"] > datetime.now(timezone.utc)
+
+
+@pytest.mark.asyncio
+async def test_expired_leases_are_reclaimed():
+    now = datetime.now(timezone.utc)
+    queue = FakeQueue([
+        {"_id": book(0), "status": LEASED, "lease_owner": "dead", "lease_expires": now - timedelta(seconds=5), "leases": 1},
+        {"_id": book(1), "status": LEASED, "lease_owner": "alive", "lease_expires": now + timedelta(seconds=60), "leases": 1},
+    ])
+    leases = distributed.LeaseQueue(queue, lease_seconds=60)
+
+    assert await leases.claim("b", 5) == [book(0)]
+    assert queue.docs[book(0)]["lease_owner"] == "b"
+    assert queue.docs[book(0)]["leases"] == 2
+    assert queue.docs[book(1)]["lease_owner"] == "alive"
+
+
+@pytest.mark.asyncio
+async def test_claim_takes_a_batch_in_a_few_round_trips_and_retries_failed_urls():
+    queue = FakeQueue(pending([book(i) for i in range(4)]) + [
+        {"_id": book(8), "status": FAILED, "attempts": 1, "leases": 1, "updated_at": T0},
+        {"_id": book(9), "status": FAILED, "attempts": 3, "leases": 3, "updated_at": T0},
+    ])
+    calls = []
+    for name in ("find", "update_many"):
+        method = getattr(queue, name)
+        setattr(queue, name, lambda *args, _name=name, _method=method: calls.append(_name) or _method(*args))
+    leases = distributed.LeaseQueue(queue, lease_seconds=60)
+
+    assert sorted(await leases.claim("a", 10)) == sorted([book(i) for i in range(4)] + [book(8)])
+    # the reap, a find per kind of claimable URL and an update_many per kind that had any, then the tagged find
+    assert calls.count("find") == 4 and calls.count("update_many") == 3
+    assert await leases.active() == 5
+    assert queue.status(book(9)) == FAILED and await leases.failed() == 1
+
+
+@pytest.mark.asyncio
+async def test_url_that_keeps_losing_its_lease_is_failed():
+    expired = datetime.now(timezone.utc) - timedelta(seconds=5)
+    queue = FakeQueue([{"_id": book(0), "status": LEASED, "lease_owner": "dead", "lease_expires": expired,
+                        "leases": 3}])
+    leases = distributed.LeaseQueue(queue, lease_seconds=60, max_leases=3)
+
+    assert await leases.claim("b", 5) == []
+    doc = queue.docs[book(0)]
+    assert doc["status"] == FAILED
+    assert "lease_owner" not in doc and "lease_expires" not in doc
+    assert await leases.active() == 0
+
+
+@pytest.mark.asyncio
+async def test_checkpoint_statuses_release_the_lease():
+    queue = FakeQueue(pending([book(0), book(1)]))
+    await distributed.LeaseQueue(queue).claim("a", 2)
+    async with CrawlCheckpoint(queue) as checkpoint:
+        await checkpoint.done(book(0))
+        await checkpoint.failed(book(1), RuntimeError("boom"))
+    assert queue.docs[book(0)]["status"] == DONE
+    assert queue.docs[book(1)]["status"] == FAILED
+    for doc in queue.docs.values():
+        assert "lease_owner" not in doc and "lease_expires" not in doc
+
+
+@pytest.mark.asyncio
+async def test_checkpoint_flushes_done_markers_while_the_queue_is_busy():
+    queue = FakeQueue(pending([book(0)]))
+    await distributed.LeaseQueue(queue).claim("a", 1)
+    async with CrawlCheckpoint(queue, max_delay=0.01) as checkpoint:
+        await checkpoint.done(book(0))
+        await asyncio.sleep(0.05)
+        # well before the batch fills or the context exits
+        assert queue.status(book(0)) == DONE
+
+
+@pytest.mark.asyncio
+async def test_workers_share_the_queue_and_stop_when_it_is_drained(monkeypatch):
+    urls = [book(i) for i in range(20)]
+    queue = FakeQueue(pending(urls))
+    install_fakes(monkeypatch, queue, {"crawler_id": distributed.STATE_ID, "discovery_done": True})
+    monkeypatch.setattr(distributed, "CRAWL_CLAIM_BATCH", 3)
+    fetched = []
+
+    async def fetch_book(client, book_url, *args):
+        await asyncio.sleep(0)
+        fetched.append(book_url)
+        if book_url == book(7):
+            raise RuntimeError("boom")
+
+    monkeypatch.setattr(distributed, "fetch_book_and_store", fetch_book)
+    async with httpx.AsyncClient() as client:
+        a, b = await asyncio.wait_for(asyncio.gather(
+            distributed.run_worker("a", 2, client, poll=0.01),
+            distributed.run_worker("b", 2, client, poll=0.01)), timeout=5)
+
+    assert sorted(set(fetched)) == sorted(urls)
+    assert a["books"] > 0 and b["books"] > 0
+    # the failing book is retried until it runs out of attempts
+    assert fetched.count(book(7)) == distributed.CRAWL_MAX_ATTEMPTS
+    assert a["books"] + b["books"] == 19 and a["failed"] + b["failed"] == distributed.CRAWL_MAX_ATTEMPTS
+    assert queue.status(book(7)) == FAILED
+    assert all(queue.status(url) == DONE for url in urls if url != book(7))
+
+
+@pytest.mark.asyncio
+async def test_worker_waits_for_discovery(monkeypatch):
+    queue = FakeQueue()
+    fake_db = install_fakes(monkeypatch, queue)
+    fetched = []
+
+    async def fetch_book(client, book_url, *args):
+        fetched.append(book_url)
+
+    monkeypatch.setattr(distributed, "fetch_book_and_store", fetch_book)
+
+    async def discovery():
+        await asyncio.sleep(0.05)
+        queue.docs.update({doc["_id"]: doc for doc in pending([book(0), book(1)])})
+        await asyncio.sleep(0.05)
+        fake_db.crawler_state.doc = {"crawler_id": distributed.STATE_ID, "discovery_done": True}
+
+    async with httpx.AsyncClient() as client:
+        stats, _ = await asyncio.wait_for(asyncio.gather(
+            distributed.run_worker("a", 2, client, poll=0.01), discovery()), timeout=5)
+    assert sorted(fetched) == [book(0), book(1)]
+    assert stats["books"] == 2
+
+
+def listing(book_ids, next_href=None):
+    pods = "".join(f'<article class="product_pod"><h3><a href="/catalogue/book-{i}_{i}/index.html">{i}</a></h3></article>'
+                   for i in book_ids)
+    pager = f'<ul class="pager"><li class="next"><a href="{next_href}">next</a></li></ul>' if next_href else ""
+    return f"<html><body>{pods}{pager}</body></html>"
+
+
+SITE = {
+    distributed.BASE: listing(range(0, 5), "catalogue/page-2.html"),
+    distributed.BASE + "catalogue/page-2.html": listing(range(3, 8)),  # books 3 and 4 are linked twice
+}
+
+
+def site_client():
+    return httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(200, text=SITE[str(request.url)])))
+
+
+@pytest.mark.asyncio
+async def test_discover_enqueues_each_book_once(monkeypatch):
+    queue = FakeQueue(pending(["https://books.toscrape.com/old-crawl"]))
+    fake_db = install_fakes(monkeypatch, queue, {"crawler_id": distributed.STATE_ID, "discovery_done": True})
+
+    async with site_client() as client:
+        await distributed.discover(client)
+    assert sorted(queue.docs) == sorted(book(i) for i in range(8))
+    assert {doc["status"] for doc in queue.docs.values()} == {PENDING}
+    assert fake_db.crawler_state.doc["discovery_done"] is True
+
+
+@pytest.mark.asyncio
+async def test_discover_resumes_from_last_page(monkeypatch):
+    queue = FakeQueue([{"_id": book(0), "status": DONE, "attempts": 1, "discovered_at": T0}])
+    install_fakes(monkeypatch, queue, {"crawler_id": distributed.STATE_ID, "discovery_done": False,
+                                       "last_page_url": distributed.BASE + "catalogue/page-2.html"})
+
+    async with site_client() as client:
+        await distributed.discover(client)
+    # the finished book stays finished; only page 2 was walked again
+    assert queue.status(book(0)) == DONE
+    assert sorted(queue.docs) == sorted([book(0)] + [book(i) for i in range(3, 8)])
@@ -0,0 +1,182 @@
+from datetime import datetime, timezone
+
+import pytest
+from fastapi.testclient import TestClient
+
+from api.main import API_KEY, app
+from db import facets
+from db.facets import facet_delta_ops, split_query, summarize
+
+client = TestClient(app)
+
+
+def test_delta_moves_book_between_cells():
+    old = {"category": "Poetry", "rating": 3, "price_including_tax": 10.0, "title": "x"}
+    new = dict(old, price_including_tax=17.5)
+    ops = facet_delta_ops(old, new)
+    assert [(op._filter["price_bucket"], op._doc["$inc"]["count"], op._upsert) for op in ops] == [
+        (10.0, -1, False), (15.0, 1, True),
+    ]
+    # a price change within the same bucket, or a title-only change, leaves the counters alone
+    assert facet_delta_ops(old, dict(old, price_including_tax=12.5)) == []
+    assert facet_delta_ops(old, dict(old, title="y")) == []
+    # a new book only increments
+    assert len(facet_delta_ops(None, new)) == 1
+
+
+def test_summarize_buckets_and_skips_empty_cells():
+    cells = [
+        {"category": "Poetry", "rating": 3, "price_bucket": 10.0, "count": 2},
+        {"category": "Travel", "rating": 5, "price_bucket": 15.0, "count": 1},
+        {"category": "Travel", "rating": 5, "price_bucket": 25.0, "count": 0},
+    ]
+    result = summarize(cells, bucket_width=10)
+    assert result["total"] == 3
+    assert result["categories"] == [{"value": "Poetry", "count": 2}, {"value": "Travel", "count": 1}]
+    assert result["ratings"] == [{"value": 3, "count": 2}, {"value": 5, "count": 1}]
+    assert result["price_buckets"] == [{"min": 10, "max": 20, "count": 3}]
+
+
+def test_split_query_reads_whole_buckets_from_cells_and_edges_from_books():
+    cells, slices = split_query({"category": "Poetry", "price_including_tax": {"$gte": 12.5, "$lte": 31.0}})
+    assert cells == {"category": "Poetry", "price_bucket": {"$gte": 15.0, "$lt": 30.0}}
+    assert slices == [
+        {"category": "Poetry", "price_including_tax": {"$gte": 12.5, "$lt": 15.0}},
+        {"category": "Poetry", "price_including_tax": {"$gte": 30.0, "$lte": 31.0}},
+    ]
+    # a range inside a single bucket goes entirely to books
+    narrow = {"price_including_tax": {"$gte": 11.0, "$lte": 13.0}}
+    assert split_query(narrow) == (None, [narrow])
+    assert split_query({"rating": 4}) == ({"rating": 4}, [])
+
+
+def test_facets_endpoint_reads_cells_with_the_books_filter(monkeypatch):
+    seen = {}
+
+    class FakeCursor:
+        async def to_list(self, length=None):
+            return [{"category": "Poetry", "rating": 4, "price_bucket": 15.0, "count": 7}]
+
+    def find(query, projection=None):
+        seen["query"] = query
+        return FakeCursor()
+
+    monkeypatch.setattr(facets, "db", type("D", (), {"book_facets": type("C", (), {"find": staticmethod(find)})}))
+
+    r = client.get("/books/facets?category=Poetry&min_price=10&rating=4", headers={"x-api-key": API_KEY})
+    assert r.status_code == 200
+    assert seen["query"] == {"category": "Poetry", "rating": 4, "price_bucket": {"$gte": 10.0},
+                             "count": {"$gt": 0}}
+    assert r.json()["total"] == 7
+    assert client.get("/books/facets?bucket=7", headers={"x-api-key": API_KEY}).status_code == 400
+
+
+class FakeMeta:
+    def __init__(self):
+        self.docs = {}
+
+    async def find_one(self, query):
+        return self.docs.get(query["_id"])
+
+    async def update_one(self, query, update, upsert=False):
+        self.docs.setdefault(query["_id"], {"_id": query["_id"]}).update(update["$set"])
+
+
+@pytest.mark.asyncio
+async def test_ensure_facets_rebuilds_until_marked_built(monkeypatch):
+    fake_db = type("D", (), {"meta": FakeMeta()})()
+    rebuilds = []
+
+    async def rebuild():
+        rebuilds.append(1)
+        await fake_db.meta.update_one({"_id": facets.BUILT_ID}, {"$set": {"built_at": 0}}, upsert=True)
+
+    monkeypatch.setattr(facets, "db", fake_db)
+    monkeypatch.setattr(facets, "rebuild_facets", rebuild)
+    # cells a detector run left behind before the first build do not count as built
+    assert not await facets.facets_built(fake_db.meta)
+    await facets.ensure_facets()
+    await facets.ensure_facets()
+    assert len(rebuilds) == 1 and await facets.facets_built(fake_db.meta)
+
+
+class FakeCells:
+    def __init__(self, name, cells=()):
+        self.name = name
+        self.cells = {(c["category"], c["rating"], c["price_bucket"]): c["count"] for c in cells}
+
+    async def create_index(self, keys, unique=False):
+        pass
+
+    async def rename(self, name, dropTarget=False):
+        self.db.book_facets = self
+
+    async def bulk_write(self, ops, ordered=True):
+        for op in ops:
+            f = op._filter
+            self.cells[(f["category"], f["rating"], f["price_bucket"])] = op._doc["$set"]["count"]
+
+
+class FakeRebuildDB:
+    """books with a write landing while the cells are grouped; its delta goes to the cells being replaced"""
+
+    def __init__(self, books, write_during_rebuild):
+        self.books_docs = books
+        self.write = write_during_rebuild
+        self.book_facets = FakeCells("book_facets")
+        self.scratch = FakeCells(facets.REBUILD_COLLECTION)
+        self.scratch.db = self
+        self.meta = FakeMeta()
+        self.change_docs = []
+        db = self
+
+        class Books:
+            def aggregate(self, pipeline):
+                class Cursor:
+                    async def to_list(self, length=None):
+                        for doc in db.books_docs:
+                            cell = facets.facet_cell(doc)
+                            db.scratch.cells[cell] = db.scratch.cells.get(cell, 0) + 1
+                        db.write(db)
+                return Cursor()
+
+            async def find(self, query, projection=None):
+                for doc in db.books_docs:
+                    if doc["crawl_timestamp"] >= query["crawl_timestamp"]["$gte"]:
+                        yield dict(doc)
+
+            async def count_documents(self, query):
+                price = query[facets.PRICE_FIELD]
+                return sum(doc["category"] == query["category"] and doc["rating"] == query["rating"]
+                           and price["$gte"] <= doc[facets.PRICE_FIELD] < price["$lt"] for doc in db.books_docs)
+
+        class Changes:
+            async def find(self, query, projection=None):
+                for change in db.change_docs:
+                    if change["changed_at"] >= query["changed_at"]["$gte"]:
+                        yield change
+
+        self.books, self.changes = Books(), Changes()
+
+    def __getitem__(self, name):
+        return self.scratch
+
+
+@pytest.mark.asyncio
+async def test_rebuild_recounts_cells_written_while_it_ran(monkeypatch):
+    old = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    books = [{"source_url": f"b{i}", "category": "Poetry", "rating": 3, "price_including_tax": 11.0,
+              "crawl_timestamp": old} for i in range(3)]
+
+    def reprice(db):
+        # b0 moves from the 10 to the 20 bucket after the grouping read it; its $inc lands in the old cells
+        db.books_docs[0].update(price_including_tax=21.0, crawl_timestamp=datetime.now(timezone.utc))
+        db.change_docs.append({"source_url": "b0", "changed_at": datetime.now(timezone.utc),
+                               "old": {"price_including_tax": 11.0}})
+
+    fake_db = FakeRebuildDB(books, reprice)
+    monkeypatch.setattr(facets, "db", fake_db)
+    await facets.rebuild_facets()
+    assert fake_db.book_facets.name == facets.REBUILD_COLLECTION
+    assert fake_db.book_facets.cells == {("Poetry", 3, 10.0): 2, ("Poetry", 3, 20.0): 1}
+    assert await facets.facets_built(fake_db.meta)
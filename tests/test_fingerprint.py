@@ -0,0 +1,43 @@
+from crawler import fingerprint as fp_module
+from crawler.fingerprint import delta_update, field_hashes, fingerprint
+
+BOOK = {
+    "source_url": "https://books.toscrape.com/catalogue/test_1",
+    "title": "Test Book",
+    "description": "A  book\nabout tests.",
+    "category": "Poetry",
+    "price_including_tax": 10.0,
+    "price_excluding_tax": 9.0,
+    "availability": "In stock (20 available)",
+    "num_reviews": 2,
+    "image_url": "https://books.toscrape.com/media/cache/x.jpg",
+    "rating": 3,
+}
+
+
+def test_markup_noise_does_not_change_fingerprint():
+    noisy = dict(BOOK, title="  Test   Book ", description="A book about\ttests.", price_including_tax=10.000001)
+    assert fingerprint(noisy) == fingerprint(BOOK)
+    assert field_hashes(noisy) == field_hashes(BOOK)
+
+
+def test_delta_update_sets_only_changed_fields():
+    new = dict(BOOK, price_including_tax=12.5)
+    old = dict(BOOK, field_hashes=field_hashes(BOOK))
+    changed, update = delta_update(old, new)
+    assert changed == ["price_including_tax"]
+    assert set(update) == {"price_including_tax", "fingerprint", "field_hashes"}
+    assert update["fingerprint"] == fingerprint(new)
+
+
+def test_legacy_document_without_field_hashes_is_compared_by_value():
+    changed, update = delta_update(dict(BOOK, fingerprint="sha256-of-raw-html"), dict(BOOK))
+    assert changed == []
+    assert update["fingerprint"] == fingerprint(BOOK)
+
+
+def test_hash_algorithm_is_selectable(monkeypatch):
+    default = fingerprint(BOOK)
+    monkeypatch.setattr(fp_module, "FINGERPRINT_HASH", "sha256")
+    assert fingerprint(BOOK) != default
+    assert len(fingerprint(BOOK)) == 64
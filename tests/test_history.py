@@ -0,0 +1,118 @@
+from datetime import datetime, timedelta
+
+import pytest
+from pymongo import InsertOne, ReplaceOne
+
+from db import history, migrate_changes
+
+T0 = datetime(2025, 11, 1)
+URL = "https://books.toscrape.com/b1"
+
+
+def book(**fields):
+    doc = {"source_url": URL, "title": "Book 1", "category": "Poetry", "description": "A long description " * 50,
+           "price_including_tax": 10.0, "availability": "In stock (5 available)", "rating": 3,
+           "crawl_timestamp": T0}
+    doc.update(fields)
+    return doc
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, *args):
+        return self
+
+    def batch_size(self, n):
+        return self
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self.docs:
+            yield dict(doc)
+
+
+class FakeCollection:
+    def __init__(self, name, docs=()):
+        self.name = name
+        self.docs = list(docs)
+
+    def find(self, query=None, projection=None):
+        if query and "old.source_url" in query:
+            return FakeCursor([d for d in self.docs if "source_url" in d.get("old", {})])
+        return FakeCursor(self.docs)
+
+    async def distinct(self, field):
+        return list({d[field] for d in self.docs})
+
+    async def bulk_write(self, ops, ordered=True):
+        for op in ops:
+            if isinstance(op, InsertOne):
+                self.docs.append(op._doc)
+            elif isinstance(op, ReplaceOne):
+                self.docs = [{"_id": d["_id"], **op._doc} if d["_id"] == op._filter["_id"] else d for d in self.docs]
+        return type("R", (), {"upserted_ids": {}})()
+
+
+def test_history_point_keeps_only_the_tracked_fields():
+    point = history.history_point(book(), T0)
+    assert point == {"ts": T0, "source_url": URL, "price_including_tax": 10.0,
+                     "availability": "In stock (5 available)"}
+    assert history.touches_history(["availability"]) and not history.touches_history(["title"])
+
+
+@pytest.mark.asyncio
+async def test_migration_compacts_legacy_records_and_seeds_history(monkeypatch):
+    day1, day2 = T0 + timedelta(days=1), T0 + timedelta(days=2)
+    legacy = [
+        {"_id": 1, "source_url": URL, "changed_at": day1, "old_fingerprint": "a", "new_fingerprint": "b",
+         "changes": ["price"], "old": book(), "new": book(price_including_tax=12.0, crawl_timestamp=day1)},
+        # the detector only labelled price and availability moves; the rating changed too
+        {"_id": 2, "source_url": URL, "changed_at": day2, "old_fingerprint": "b", "new_fingerprint": "c",
+         "changes": ["availability"], "old": book(price_including_tax=12.0),
+         "new": book(price_including_tax=12.0, availability="Out of stock", rating=4, crawl_timestamp=day2)},
+    ]
+    compact = {"_id": 3, "source_url": URL, "changed_at": day2, "changes": ["rating"],
+               "old": {"rating": 3}, "new": {"rating": 4}}
+    fake_db = type("D", (), {
+        "changes": FakeCollection("changes", legacy + [compact]),
+        "price_history": FakeCollection("price_history"),
+        "books": FakeCollection("books", [book(price_including_tax=12.0),
+                                          book(source_url="https://books.toscrape.com/b2")]),
+    })()
+    monkeypatch.setattr(migrate_changes, "db", fake_db)
+
+    assert await migrate_changes.compact_changes(100) == 2
+    first, second, untouched = fake_db.changes.docs
+    assert first["old"] == {"price_including_tax": 10.0} and first["new"] == {"price_including_tax": 12.0}
+    assert (first["title"], first["category"], first["old_fingerprint"]) == ("Book 1", "Poetry", "a")
+    assert first["changes"] == ["price_including_tax"]
+    assert second["changes"] == ["availability", "rating"]
+    assert second["new"] == {"availability": "Out of stock", "rating": 4}
+    assert untouched == compact
+    # a baseline from the first record's old copy, then the price and availability changes
+    assert [(p["ts"], p["price_including_tax"], p["availability"]) for p in fake_db.price_history.docs] == [
+        (T0, 10.0, "In stock (5 available)"), (day1, 12.0, "In stock (5 available)"), (day2, 12.0, "Out of stock")]
+
+    # only the book with no history yet gets a point from its current values
+    assert await migrate_changes.backfill_history(100) == 1
+    assert fake_db.price_history.docs[-1]["source_url"] == "https://books.toscrape.com/b2"
+
+
+@pytest.mark.asyncio
+async def test_migration_keeps_embedded_pages_in_the_snapshot_store(monkeypatch, snapshot_store):
+    legacy = {"_id": 1, "source_url": URL, "changed_at": T0, "changes": ["price"],
+              "old": book(raw_html_snapshot="<html>old</html>"),
+              "new": book(price_including_tax=12.0, raw_html_snapshot="<html>new</html>")}
+    fake_db = type("D", (), {"changes": FakeCollection("changes", [legacy]),
+                             "price_history": FakeCollection("price_history")})()
+    monkeypatch.setattr(migrate_changes, "db", fake_db)
+
+    assert await migrate_changes.compact_changes(100) == 1
+    [record] = fake_db.changes.docs
+    assert record["changes"] == ["price_including_tax"]
+    assert await snapshot_store.get(record["old_snapshot_ref"]) == "<html>old</html>"
+    assert await snapshot_store.get(record["new_snapshot_ref"]) == "<html>new</html>"
@@ -0,0 +1,75 @@
+import pytest
+
+from crawler.index import FingerprintIndex
+
+FP = "a1b2c3d4e5f6a7b8c9d0e1f2a3b4c5d6e7f8a9b0c1d2e3f4a5b6c7d8e9f0a1b2"
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self._docs = docs
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self._docs:
+            yield doc
+
+
+class FakeBooks:
+    def __init__(self, docs):
+        self.docs = docs
+        self.projection = None
+
+    def find(self, query, projection=None):
+        self.projection = projection
+        return FakeCursor(self.docs)
+
+
+@pytest.mark.asyncio
+async def test_load_uses_projected_cursor_and_round_trips():
+    books = FakeBooks([
+        {"source_url": "https://b/1", "fingerprint": FP,
+         "validators": {"etag": '"x"', "last_modified": "Thu, 09 Feb 2023 20:31:07 GMT", "content_length": 10}},
+        {"source_url": "https://b/2", "fingerprint": "not-hex"},
+    ])
+    index = await FingerprintIndex.load(books)
+    assert "raw_html_snapshot" not in books.projection
+    assert len(index) == 2
+    assert index.get("https://b/1") == {
+        "fingerprint": FP,
+        "validators": {"etag": '"x"', "last_modified": "Thu, 09 Feb 2023 20:31:07 GMT", "content_length": 10},
+    }
+    assert index.get("https://b/2") == {"fingerprint": "not-hex", "validators": None}
+    assert index.get("https://b/3") is None
+    assert (index.hits, index.misses) == (2, 1)
+
+
+def test_put_updates_entry():
+    index = FingerprintIndex()
+    index.put("https://b/1", FP)
+    index.put("https://b/1", "ff" * 32, {"etag": '"y"'})
+    assert index.get("https://b/1")["fingerprint"] == "ff" * 32
+    assert index.get("https://b/1")["validators"]["etag"] == '"y"'
+    assert len(index) == 1
+
+
+def test_odd_fingerprints_round_trip():
+    index = FingerprintIndex()
+    index.put("https://b/none", None, {"etag": '"z"'})
+    index.put("https://b/short", "abcd")
+    assert index.get("https://b/none") == {
+        "fingerprint": None, "validators": {"etag": '"z"', "last_modified": None, "content_length": None},
+    }
+    assert index.get("https://b/short") == {"fingerprint": "abcd", "validators": None}
+
+
+def test_digests_starting_with_any_byte_round_trip():
+    index = FingerprintIndex()
+    for fp in ("00" + "ab" * 31, "1f" * 32, "00" * 32):
+        index.put("https://b/1", fp, {"etag": '"e"'})
+        assert index.get("https://b/1") == {"fingerprint": fp, "validators": {"etag": '"e"', "last_modified": None,
+                                                                              "content_length": None}}
+        index.put("https://b/1", fp)
+        assert index.get("https://b/1") == {"fingerprint": fp, "validators": None}
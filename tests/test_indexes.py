@@ -0,0 +1,73 @@
+"""Query-plan checks for GET /books; they need a reachable MongoDB and skip otherwise."""
+import itertools
+import os
+import random
+
+import pytest
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+from api.queries import build_book_query, keyset_filter, sort_spec
+from db.client import BOOK_SORTS, MONGO_URI, book_index_specs
+
+
+@pytest.fixture(scope="module")
+def books():
+    client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=500)
+    try:
+        client.admin.command("ping")
+    except PyMongoError:
+        pytest.skip("MongoDB is not reachable")
+    db_name = f"test_indexes_{os.getpid()}"
+    coll = client[db_name].books
+    rnd = random.Random(7)
+    coll.insert_many([{
+        "source_url": f"https://books.toscrape.com/b{i}",
+        "category": rnd.choice(["Poetry", "Travel", "Mystery"]),
+        "rating": rnd.choice([1, 2, 3, 4, 5, None]),
+        "price_including_tax": rnd.choice([round(rnd.uniform(10, 60), 2), None]),
+        "num_reviews": rnd.randint(0, 5),
+    } for i in range(300)])
+    for keys in book_index_specs():
+        coll.create_index(keys)
+    yield coll
+    client.drop_database(db_name)
+
+
+def _stages(plan):
+    yield plan.get("stage")
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            yield from _stages(plan[key])
+    for child in plan.get("inputStages", []):
+        yield from _stages(child)
+
+
+SHAPES = list(itertools.product(
+    [None, "Poetry"], [None, 4], [None, (15.0, 40.0)], list(BOOK_SORTS) + [None],
+))
+
+
+@pytest.mark.parametrize("category,rating,price,sort_by", SHAPES)
+def test_no_query_shape_scans_the_collection(books, category, rating, price, sort_by):
+    query = build_book_query(category, price and price[0], price and price[1], rating)
+    if not query and sort_by is None:
+        pytest.skip("unfiltered _id order is a plain _id index walk")
+    plan = books.find(query).sort(sort_spec(sort_by)).limit(20).explain()["queryPlanner"]["winningPlan"]
+    stages = set(_stages(plan))
+    assert "COLLSCAN" not in stages
+    assert "SORT" not in stages
+
+
+@pytest.mark.parametrize("sort_by", list(BOOK_SORTS) + [None])
+def test_keyset_pages_match_offset_pages(books, sort_by):
+    expected = [d["_id"] for d in books.find({}).sort(sort_spec(sort_by))]
+    seen, query = [], {}
+    while True:
+        page = list(books.find(query).sort(sort_spec(sort_by)).limit(25))
+        seen += [d["_id"] for d in page]
+        if len(page) < 25:
+            break
+        field = sort_spec(sort_by)[0][0]
+        query = keyset_filter(sort_by, page[-1].get(field) if field != "_id" else None, page[-1]["_id"])
+    assert seen == expected
@@ -0,0 +1,69 @@
+import io
+import json
+import logging
+
+import pytest
+
+from utils import logger as log
+
+
+def record(msg, created, **extra):
+    rec = logging.makeLogRecord({"name": "books_crawler", "levelno": logging.INFO, "levelname": "INFO",
+                                 "msg": msg, **extra})
+    rec.created = created
+    return rec
+
+
+def test_summarizer_passes_a_burst_then_reports_the_rest_once_per_interval():
+    summarizer = log.EventSummarizer(interval=10, burst=2)
+    admitted = [r for i in range(5) for r in summarizer.admit(record(f"minor {i}", 100 + i, summarize="minor"))]
+    assert [r.getMessage() for r in admitted] == ["minor 0", "minor 1"]
+    # other records are never held back
+    assert [r.getMessage() for r in summarizer.admit(record("page", 105))] == ["page"]
+
+    # the next record after the interval closes the window with a summary first
+    out = summarizer.admit(record("minor 5", 111, summarize="minor"))
+    assert [r.getMessage() for r in out] == ["minor: 3 more suppressed (5 in 11s)", "minor 5"]
+    assert out[0].suppressed == 3
+    assert summarizer.due(flush=True) == []  # one record in the new window: nothing to summarize
+
+
+@pytest.fixture
+def configured(tmp_path):
+    stream = io.StringIO()
+    yield stream, tmp_path / "crawler.log"
+    log.setup_logging()
+
+
+def test_queued_json_lines_carry_run_and_crawl_ids(configured):
+    stream, log_file = configured
+    logger = log.setup_logging(level="INFO", log_file=str(log_file), fmt="json", use_queue=True, stream=stream)
+    with log.log_context(crawl_id="c1"):
+        logger.alert("New Book Added", "New book discovered: %s", extra={"url": "u1"})
+        logger.info("Minor change detected: %s", "u2", extra={"summarize": "minor_change"})
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        logger.exception("Failed")
+    log.shutdown_logging()  # drains the queue
+
+    lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert log_file.read_text().splitlines() == stream.getvalue().splitlines()
+    alert, minor, failed = lines
+    assert alert["alert"] == "New Book Added" and alert["url"] == "u1" and alert["level"] == "INFO"
+    assert alert["run_id"] == log.RUN_ID and alert["crawl_id"] == "c1"
+    assert minor["message"] == "Minor change detected: u2" and minor["summarize"] == "minor_change"
+    assert "crawl_id" not in failed and "ValueError: boom" in failed["exc"]
+
+
+def test_listener_collapses_summarized_events(configured):
+    stream, log_file = configured
+    logger = log.setup_logging(level="INFO", log_file=str(log_file), fmt="text", use_queue=True, stream=stream)
+    log._listener.summarizer = log.EventSummarizer(interval=60, burst=3)
+    for i in range(1000):
+        logger.info("Minor change detected: %d", i, extra={"summarize": "minor_change"})
+    log.shutdown_logging()
+
+    lines = stream.getvalue().splitlines()
+    assert len(lines) == 4
+    assert "books_crawler - INFO - minor_change: 997 more suppressed (1000 in " in lines[-1]
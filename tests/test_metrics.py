@@ -0,0 +1,81 @@
+from collections import Counter as Stats
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+from api.main import app
+from crawler import crawler
+from utils import metrics
+
+
+def test_counters_gauges_and_histograms_render_in_prometheus_text_format():
+    registry = metrics.MetricsRegistry()
+    requests = registry.register(metrics.Counter("t_requests_total", "Requests", ("status",)))
+    depth = registry.register(metrics.Gauge("t_depth", "Queue depth"))
+    latency = registry.register(metrics.Histogram("t_seconds", "Latency", ("kind",), buckets=(0.1, 1.0)))
+    requests.inc(status=200)
+    requests.inc(2, status=200)
+    requests.inc(status='a "quoted" label')
+    depth.set(5)
+    depth.dec()
+    for value in (0.05, 0.1, 0.5, 3.0):
+        latency.observe(value, kind="book")
+    registry.on_collect(lambda: depth.inc(10))
+
+    text = registry.render()
+    assert "# TYPE t_requests_total counter" in text
+    assert 't_requests_total{status="200"} 3' in text
+    assert 't_requests_total{status="a \\"quoted\\" label"} 1' in text
+    assert "t_depth 14" in text
+    # buckets are cumulative and end in +Inf
+    assert 't_seconds_bucket{kind="book",le="0.1"} 2' in text
+    assert 't_seconds_bucket{kind="book",le="1.0"} 3' in text
+    assert 't_seconds_bucket{kind="book",le="+Inf"} 4' in text
+    assert 't_seconds_count{kind="book"} 4' in text
+    assert latency.sum(kind="book") == pytest.approx(3.65)
+
+
+def test_labels_must_match_the_declaration():
+    latency = metrics.Histogram("t_labelled", "Latency", ("kind",))
+    with pytest.raises(ValueError):
+        latency.observe(1.0)
+    registry = metrics.MetricsRegistry()
+    registry.register(metrics.Counter("t_twice_total", "Twice"))
+    assert registry.register(metrics.Counter("t_twice_total", "Twice")) is registry.get("t_twice_total")
+    with pytest.raises(ValueError):
+        registry.register(metrics.Gauge("t_twice_total", "Twice"))
+
+
+def test_dump_writes_the_registry_to_a_file(tmp_path):
+    target = tmp_path / "crawler.prom"
+    metrics.dump_metrics(str(target))
+    assert "# TYPE crawler_fetch_seconds histogram" in target.read_text()
+    assert not list(tmp_path.glob("*.tmp"))
+    metrics.dump_metrics("")  # disabled: nothing to do
+
+
+@pytest.mark.asyncio
+async def test_fetch_records_status_codes_retries_and_bytes(monkeypatch):
+    monkeypatch.setattr(crawler, "backoff_delay", lambda retries: 0)
+    answers = iter([httpx.Response(503), httpx.Response(200, text="<html>ok</html>")])
+    before = (crawler.FETCH_RESPONSES.value(status=503), crawler.FETCH_RESPONSES.value(status=200),
+              crawler.FETCH_RETRIES.value(), crawler.FETCH_BYTES.value(), crawler.FETCH_SECONDS.count())
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(lambda request: next(answers))) as client:
+        await crawler.request(client, "https://books.toscrape.com/", stats=Stats())
+
+    after = (crawler.FETCH_RESPONSES.value(status=503), crawler.FETCH_RESPONSES.value(status=200),
+             crawler.FETCH_RETRIES.value(), crawler.FETCH_BYTES.value(), crawler.FETCH_SECONDS.count())
+    assert [b - a for a, b in zip(before, after)] == [1, 1, 1, len("<html>ok</html>"), 2]
+
+
+def test_metrics_endpoint_reports_route_latency():
+    client = TestClient(app)
+    client.get("/books/facets", params={"bucket": 0.3}, headers={"x-api-key": "wrong"})
+    r = client.get("/metrics")
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith("text/plain; version=0.0.4")
+    # labelled with the route template and the response status
+    assert 'api_request_seconds_count{route="/books/facets",method="GET",status="401"}' in r.text
+    assert "# TYPE api_cache_lookups_total counter" in r.text
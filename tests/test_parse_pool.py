@@ -0,0 +1,113 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+
+from crawler import parse_pool
+from crawler.fingerprint import fingerprint
+from crawler.parser import parse_book_page
+
+PAGE = (Path(__file__).parent / "fixtures" / "pages" / "sharp-objects_997.html").read_text(encoding="utf-8")
+URL = "https://books.toscrape.com/catalogue/sharp-objects_997/index.html"
+BAD_PAGE = '<table class="table table-striped"><tr><td>orphan</td></tr></table>'
+LISTING = """
+<ol class="row">
+  <li><article class="product_pod"><h3><a href="a-light_1000/index.html">A Light</a></h3></article></li>
+  <li><article class="product_pod"><h3><a href="tipping_999/index.html">Tipping</a></h3></article></li>
+</ol>
+<ul class="pager"><li class="next"><a href="page-3.html">next</a></li></ul>
+"""
+
+
+def thread_pool(workers=1, batch_size=4):
+    return parse_pool.ParsePool(ThreadPoolExecutor(workers), workers, batch_size)
+
+
+@pytest.mark.asyncio
+async def test_parse_book_adds_fingerprint_and_field_hashes():
+    parsed = await parse_pool.ParsePool().parse_book(PAGE, URL)
+    assert parsed["title"] == "Sharp Objects"
+    assert parsed["fingerprint"] == fingerprint(parse_book_page(PAGE, URL))
+    assert set(parsed["field_hashes"]) >= {"title", "price_including_tax"}
+
+
+@pytest.mark.asyncio
+async def test_pages_queue_into_batches_while_workers_are_busy():
+    pool = thread_pool(workers=1, batch_size=4)
+    try:
+        results = await asyncio.gather(*(pool.parse_book(PAGE, f"{URL}?{i}") for i in range(9)))
+    finally:
+        pool.shutdown()
+    assert [r["source_url"] for r in results] == [f"{URL}?{i}" for i in range(9)]
+    # the first page goes out alone to the idle worker, the other eight wait and go out four at a time
+    assert pool.stats == {"batches": 3, "pages": 9}
+
+
+@pytest.mark.asyncio
+async def test_a_bad_page_fails_alone():
+    pool = thread_pool(workers=1, batch_size=8)
+    try:
+        results = await asyncio.gather(pool.parse_book(PAGE, URL), pool.parse_book(BAD_PAGE, URL),
+                                       pool.parse_book(PAGE, URL), return_exceptions=True)
+    finally:
+        pool.shutdown()
+    assert isinstance(results[1], AttributeError)
+    assert results[0]["title"] == results[2]["title"] == "Sharp Objects"
+
+
+@pytest.mark.asyncio
+async def test_parse_listing():
+    books, next_url = await parse_pool.ParsePool().parse_listing(LISTING, "https://books.toscrape.com/catalogue/page-2.html")
+    assert books == ["https://books.toscrape.com/catalogue/a-light_1000/index.html",
+                     "https://books.toscrape.com/catalogue/tipping_999/index.html"]
+    assert next_url == "https://books.toscrape.com/catalogue/page-3.html"
+
+
+@pytest.mark.asyncio
+async def test_process_pool_matches_inline():
+    pool = parse_pool.make_parse_pool("process", workers=1)
+    try:
+        parsed = await pool.parse_book(PAGE, URL)
+    finally:
+        pool.shutdown()
+    assert parsed == await parse_pool.ParsePool().parse_book(PAGE, URL)
+
+
+def test_unknown_executor():
+    with pytest.raises(ValueError):
+        parse_pool.make_parse_pool("gpu")
+
+
+@pytest.mark.asyncio
+async def test_pool_is_made_on_use_and_shut_down_after_the_last_run(monkeypatch):
+    made = []
+
+    def make(workers):
+        made.append(thread_pool(workers))
+        return made[-1]
+
+    monkeypatch.setattr(parse_pool, "make_parse_pool", make)
+    monkeypatch.setattr(parse_pool, "_pool", None)
+    parse_pool.set_parse_workers(2)
+    try:
+        async with parse_pool.parse_pool_run() as pool:
+            with parse_pool.parse_pool_run():
+                assert await pool.parse_book(PAGE, URL)
+            assert not pool.executor._shutdown  # still held by the outer run
+        assert pool.executor._shutdown and parse_pool._pool is None
+        assert [p.workers for p in made] == [2]
+        # the next run starts a fresh pool
+        with parse_pool.parse_pool_run() as again:
+            assert again is not pool
+    finally:
+        parse_pool.set_parse_workers(parse_pool.PARSE_WORKERS)
+
+
+def test_installed_pool_outlives_runs(monkeypatch):
+    pool = thread_pool()
+    monkeypatch.setattr(parse_pool, "_pool", pool)
+    with parse_pool.parse_pool_run() as used:
+        assert used is pool
+    assert parse_pool._pool is pool and not pool.executor._shutdown
+    pool.shutdown()
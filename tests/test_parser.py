@@ -1,6 +1,8 @@
 
+from pathlib import Path
+
 import pytest
-from crawler.parser import parse_book_page
+from crawler.parser import parse_book_page, parse_listing_page, parse_listing_summaries
 
 def test_parse_sample_html():
     # small sample html saved inline for a minimal test
@@ -22,3 +24,90 @@ def test_parse_sample_html():
     assert data["price_including_tax"] == 10.0
     assert data["price_excluding_tax"] == 9.0
     assert data["rating"] == 3
+
+
+FIXTURES = Path(__file__).parent / "fixtures" / "pages"
+CORPUS = sorted(FIXTURES.glob("*.html"))
+
+EDGE_CASES = [
+    "",
+    "<html><body><p>no book here</p></body></html>",
+    '<?xml version="1.0" encoding="utf-8"?><html><body><div class="product_main"><h1>X</h1></div></body></html>',
+    '<div class="product_main"><h1> a <!-- c --> b<script>s</script><style>t</style> <i> x </i>&amp;&nbsp;</h1></div>',
+    '<div class="product_main"><h1>T<template><p>hidden</p></template>ail</h1></div>',
+    '<ul class="breadcrumb"><li><a>Home</a></li><li><a>Books</a></li></ul><img src="x.jpg">',
+    '<div class="item  active"><img src="../../media/a.jpg"></div><div class="carousel"><img src=""></div>',
+    '<p class="star-rating\tFour Two"></p><p class="star-rating Five"></p><p class="instock availability">Out</p>',
+    '<table class="table-striped table extra"><tr><th> Availability </th><td><b>In</b> stock</td></tr>'
+    '<tr><th>Number of reviews</th><td></td></tr></table>',
+]
+
+
+def test_corpus_is_present():
+    assert len(CORPUS) >= 5
+
+
+@pytest.mark.parametrize("path", CORPUS, ids=lambda p: p.name)
+def test_backends_agree_on_saved_pages(path):
+    html = path.read_text(encoding="utf-8")
+    url = f"https://books.toscrape.com/catalogue/{path.stem}/index.html"
+    lxml_book = parse_book_page(html, url, backend="lxml")
+    assert lxml_book == parse_book_page(html, url, backend="bs4")
+    assert lxml_book["title"] and lxml_book["price_including_tax"] is not None
+
+
+@pytest.mark.parametrize("html", EDGE_CASES)
+def test_backends_agree_on_edge_cases(html):
+    url = "https://books.toscrape.com/catalogue/edge_1/index.html"
+    assert parse_book_page(html, url, backend="lxml") == parse_book_page(html, url, backend="bs4")
+
+
+def test_backends_agree_on_table_row_without_cells():
+    html = '<table class="table table-striped"><tr><td>orphan</td></tr></table>'
+    for backend in ("lxml", "bs4"):
+        with pytest.raises(AttributeError):
+            parse_book_page(html, "https://books.toscrape.com/", backend=backend)
+
+
+def test_saved_page_fields():
+    path = FIXTURES / "a-light-in-the-attic_1000.html"
+    data = parse_book_page(path.read_text(encoding="utf-8"), "https://books.toscrape.com/catalogue/a-light_1000/index.html")
+    assert data["title"] == "A Light in the Attic"
+    assert data["category"] == "Poetry"
+    assert data["price_including_tax"] == 51.77
+    assert data["availability"] == "In stock (22 available)"
+    assert data["rating"] == 3
+    assert data["image_url"] == "https://books.toscrape.com/media/cache/fe/72/fe72f0532301ec28892ae79a629a293c.jpg"
+    assert data["description"].endswith("...more")
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        parse_book_page("<html></html>", "https://books.toscrape.com/", backend="html5lib")
+
+
+LISTING_URL = "https://books.toscrape.com/catalogue/category/books/travel_2/index.html"
+LISTING = (Path(__file__).parent / "fixtures" / "listings" / "travel_2.html").read_text(encoding="utf-8")
+
+
+def test_listing_summaries():
+    books, next_url = parse_listing_summaries(LISTING, LISTING_URL)
+    assert next_url == "https://books.toscrape.com/catalogue/category/books/travel_2/page-2.html"
+    assert books[0] == {
+        "source_url": "https://books.toscrape.com/catalogue/its-only-the-himalayas_981/index.html",
+        "title": "It's Only the Himalayas",
+        "price_including_tax": 45.17,
+        "availability": "In stock",
+        "rating": 2,
+    }
+    # the full title comes from the link's title attribute, not the truncated link text
+    assert books[2]["title"] == "See America: A Celebration of Our National Parks & Treasured Sites"
+    assert books[2]["availability"] == "Out of stock"
+    assert [b["source_url"] for b in books] == parse_listing_page(LISTING, LISTING_URL)[0]
+
+
+@pytest.mark.parametrize("html", [LISTING, "", '<article class="product_pod"><h3><a>no href</a></h3></article>',
+                                  '<article class="product_pod"><h3><a href="b/index.html">B</a></h3></article>'])
+def test_listing_summary_backends_agree(html):
+    assert parse_listing_summaries(html, LISTING_URL, backend="lxml") == \
+        parse_listing_summaries(html, LISTING_URL, backend="bs4")
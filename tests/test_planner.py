@@ -0,0 +1,150 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from scheduler import planner as planner_module
+from scheduler.planner import DAY, RevisitPlanner
+
+HOUR = 3600.0
+T0 = 100 * DAY
+
+
+def make_planner(budget=10):
+    return RevisitPlanner(budget=budget, min_interval=6 * HOUR, max_interval=7 * DAY, staleness=0.2, prior=30 * DAY)
+
+
+def test_books_that_change_more_are_revisited_sooner():
+    planner = make_planner()
+    planner.add("static", 0, T0 - 90 * DAY, T0, now=T0)
+    planner.add("weekly", 13, T0 - 90 * DAY, T0, now=T0)
+    planner.add("hot", 300, T0 - 90 * DAY, T0, now=T0)
+    assert planner.due(T0 + 5 * HOUR) == []
+    # the hot book is capped at the minimum interval, the static one at the maximum
+    assert planner.due(T0 + 6 * HOUR) == ["hot"]
+    assert planner.due(T0 + 6 * DAY) == ["weekly"]
+    assert planner.due(T0 + 7 * DAY) == ["static"]
+
+
+def test_due_takes_the_most_overdue_within_the_budget():
+    planner = make_planner(budget=2)
+    for n in range(5):
+        planner.add(f"b{n}", 0, T0 - 90 * DAY, T0 - n * DAY, now=T0)
+    now = T0 + 7 * DAY
+    assert planner.due(now) == ["b4", "b3"]
+    assert planner.stats["overdue"] == 3
+    assert planner.due(now) == ["b2", "b1"]
+
+
+def test_visits_reschedule_and_learn_the_rate():
+    planner = make_planner()
+    planner.add("a", 0, T0 - 90 * DAY, T0, now=T0)
+    planner.add("b", 0, T0 - 90 * DAY, T0, now=T0)
+    now = T0 + 7 * DAY
+    assert sorted(planner.due(now)) == ["a", "b"]
+    planner.visited("a", now, changed=True)
+    planner.visited("b", now, changed=False)
+    assert planner.change_rate("a", now) > planner.change_rate("b", now)
+    # each book sits in the heap once more, at its new due time
+    assert planner.due(now) == []
+    assert planner.next_due() > now
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self._docs = docs
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self._docs:
+            yield dict(doc)
+
+
+class FakeCollection:
+    def __init__(self, docs=(), distinct=()):
+        self.docs = list(docs)
+        self.distinct_values = list(distinct)
+        self.pipelines = []
+
+    def find(self, query=None, projection=None):
+        return FakeCursor(self.docs)
+
+    def aggregate(self, pipeline):
+        self.pipelines.append(pipeline)
+        return FakeCursor(self.docs)
+
+    async def distinct(self, key, query=None):
+        return [v for v in self.distinct_values if v in query["source_url"]["$in"]]
+
+
+class FakeDB:
+    def __init__(self, books=(), changes=(), changed=()):
+        self.books = FakeCollection(books)
+        self.changes = FakeCollection(changes, changed)
+
+
+@pytest.mark.asyncio
+async def test_load_plans_books_from_their_change_history(monkeypatch):
+    now = datetime.now(timezone.utc)
+    fake_db = FakeDB(
+        books=[{"source_url": "hot", "created_at": now - timedelta(days=200), "crawl_timestamp": now},
+               {"source_url": "static", "created_at": now - timedelta(days=200),
+                "crawl_timestamp": now.replace(tzinfo=None)}],  # as Mongo returns it
+        changes=[{"_id": "hot", "n": 60}])
+    monkeypatch.setattr(planner_module, "db", fake_db)
+    planner = make_planner()
+
+    assert await planner.load(now.timestamp()) == 2
+    assert planner.change_rate("hot", now.timestamp()) > 10 * planner.change_rate("static", now.timestamp())
+    # only changes inside the history window are counted
+    assert "$gte" in fake_db.changes.pipelines[0][0]["$match"]["changed_at"]
+    # books already planned keep their schedule
+    assert await planner.load(now.timestamp()) == 0
+
+
+@pytest.mark.asyncio
+async def test_revisit_tick_fetches_due_books_and_reschedules_them(monkeypatch):
+    monkeypatch.setattr(planner_module, "db", FakeDB(changed=["a"]))
+    revisited = []
+
+    async def revisit_books(urls, client=None):
+        revisited.append(list(urls))
+
+    monkeypatch.setattr(planner_module, "revisit_books", revisit_books)
+    planner = make_planner(budget=2)
+    start = datetime.now(timezone.utc).timestamp() - 8 * DAY
+    for url in ("a", "b", "c"):
+        planner.add(url, 0, start, start, now=start)
+
+    await planner_module.revisit_due_books(planner)
+    assert len(revisited[0]) == 2
+    assert planner.stats["overdue"] == 1
+    await planner_module.revisit_due_books(planner)
+    assert sorted(revisited[0] + revisited[1]) == ["a", "b", "c"]
+    # the changed book earns a higher rate, and nothing is due again right away
+    assert planner.change_rate("a", start + 8 * DAY) > planner.change_rate("b", start + 8 * DAY)
+    await planner_module.revisit_due_books(planner)
+    assert len(revisited) == 2
+
+
+@pytest.mark.asyncio
+async def test_failed_revisit_tick_keeps_its_books_due(monkeypatch):
+    monkeypatch.setattr(planner_module, "db", FakeDB())
+    calls = []
+
+    async def revisit_books(urls, client=None):
+        calls.append(list(urls))
+        if len(calls) == 1:
+            raise ConnectionError("mongo down")
+
+    monkeypatch.setattr(planner_module, "revisit_books", revisit_books)
+    planner = make_planner(budget=2)
+    start = datetime.now(timezone.utc).timestamp() - 8 * DAY
+    for url in ("a", "b"):
+        planner.add(url, 0, start, start, now=start)
+
+    with pytest.raises(ConnectionError):
+        await planner_module.revisit_due_books(planner)
+    await planner_module.revisit_due_books(planner)
+    assert calls == [["a", "b"], ["a", "b"]]
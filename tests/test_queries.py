@@ -0,0 +1,49 @@
+import pytest
+from bson import ObjectId
+
+from api.queries import build_book_query, decode_cursor, encode_cursor, keyset_filter, sort_spec
+
+
+def test_cursor_round_trip():
+    oid = ObjectId()
+    token = encode_cursor("price", {"_id": oid, "price_including_tax": 51.77})
+    assert decode_cursor(token, "price") == (51.77, oid)
+
+
+@pytest.mark.parametrize("token", ["not-base64!", "e30=", "eyJpZCI6ICJ4In0="])
+def test_malformed_cursor_is_rejected(token):
+    with pytest.raises(ValueError):
+        decode_cursor(token, "rating")
+
+
+def test_cursor_for_another_sort_is_rejected():
+    token = encode_cursor("rating", {"_id": ObjectId(), "rating": 4})
+    with pytest.raises(ValueError):
+        decode_cursor(token, "price")
+
+
+def test_sort_spec_is_total():
+    assert sort_spec("rating") == [("rating", -1), ("_id", -1)]
+    assert sort_spec("price") == [("price_including_tax", 1), ("_id", 1)]
+    assert sort_spec(None) == [("_id", 1)]
+
+
+def test_keyset_filter_descending_includes_nulls_after_values():
+    oid = ObjectId()
+    assert keyset_filter("rating", 4, oid) == {"$or": [
+        {"rating": {"$lt": 4}}, {"rating": 4, "_id": {"$lt": oid}}, {"rating": None},
+    ]}
+    assert keyset_filter("rating", None, oid) == {"rating": None, "_id": {"$lt": oid}}
+
+
+def test_keyset_filter_ascending_moves_past_nulls():
+    oid = ObjectId()
+    assert keyset_filter("price", None, oid) == {"$or": [
+        {"price_including_tax": {"$ne": None}}, {"price_including_tax": None, "_id": {"$gt": oid}},
+    ]}
+
+
+def test_build_book_query():
+    assert build_book_query("Poetry", 10, None, 3) == {
+        "category": "Poetry", "rating": 3, "price_including_tax": {"$gte": 10},
+    }
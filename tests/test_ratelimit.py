@@ -0,0 +1,68 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from api.main import API_KEY, app
+from api.ratelimit import MemoryRateLimitBackend, MongoRateLimitBackend, RateLimiter
+
+client = TestClient(app)
+
+
+@pytest.mark.asyncio
+async def test_sliding_window_weights_previous_window():
+    limiter = RateLimiter(MemoryRateLimitBackend(), limit=10, window=100)
+    for _ in range(10):
+        assert (await limiter.hit("k", now=50)).allowed
+    rejected = await limiter.hit("k", now=99)
+    assert not rejected.allowed and rejected.remaining == 0 and rejected.reset == 1
+    # a quarter into the next window, 75% of the previous 10 hits still count
+    result = await limiter.hit("k", now=125)
+    assert result.allowed and result.remaining == 1  # 7.5 + 1 used
+    assert (await limiter.hit("k", now=125)).allowed
+    assert not (await limiter.hit("k", now=125)).allowed
+    # two windows later the history is gone
+    assert (await limiter.hit("k", now=350)).remaining == 9
+
+
+class FakeRateLimits:
+    def __init__(self):
+        self.docs = {}
+        self.finds = 0
+
+    async def find_one_and_update(self, query, update, upsert=False, return_document=None):
+        doc = self.docs.setdefault(query["_id"], {"_id": query["_id"], "count": 0})
+        doc["count"] += update["$inc"]["count"]
+        return dict(doc)
+
+    async def find_one(self, query, projection=None):
+        self.finds += 1
+        return self.docs.get(query["_id"])
+
+    async def update_one(self, query, update):
+        self.docs[query["_id"]]["count"] += update["$inc"]["count"]
+
+
+@pytest.mark.asyncio
+async def test_mongo_backend_is_shared_between_limiters():
+    coll = FakeRateLimits()
+    workers = [RateLimiter(MongoRateLimitBackend(coll), limit=3, window=100) for _ in range(2)]
+    assert (await workers[0].hit("k", now=10)).allowed
+    assert (await workers[1].hit("k", now=11)).allowed
+    assert (await workers[0].hit("k", now=12)).allowed
+    assert not (await workers[1].hit("k", now=13)).allowed
+    # the rejected hit was taken back; the closed window is read once per worker
+    assert [d["count"] for d in coll.docs.values()] == [3]
+    await workers[0].hit("k", now=14)
+    assert coll.finds == 2
+
+
+def test_responses_carry_rate_limit_headers(rate_limiter):
+    rate_limiter.limit = 2
+    headers = {"x-api-key": API_KEY}
+    first = client.get("/cache/stats", headers=headers)
+    assert first.headers["x-ratelimit-limit"] == "2"
+    assert first.headers["x-ratelimit-remaining"] == "1"
+    client.get("/cache/stats", headers=headers)
+    limited = client.get("/cache/stats", headers=headers)
+    assert limited.status_code == 429
+    assert limited.headers["x-ratelimit-remaining"] == "0"
+    assert int(limited.headers["retry-after"]) >= 1
@@ -0,0 +1,84 @@
+import httpx
+import pytest
+
+from crawler.replay import FixtureArchive, RecordingTransport, ReplayTransport, record_site
+
+BASE = "https://books.toscrape.com/"
+
+
+def listing(book_ids, next_href=None):
+    pods = "".join(f'<article class="product_pod"><h3><a href="catalogue/book-{i}_{i}/index.html">{i}</a></h3></article>'
+                   for i in book_ids)
+    pager = f'<ul class="pager"><li class="next"><a href="{next_href}">next</a></li></ul>' if next_href else ""
+    return f"<html><body>{pods}{pager}</body></html>"
+
+
+SITE = {
+    BASE: listing([0, 1], "page-2.html"),
+    BASE + "page-2.html": listing([2]),
+    **{f"{BASE}catalogue/book-{i}_{i}/index.html": f"<html><body><h1>Book {i}</h1></body></html>" for i in range(3)},
+}
+
+
+def live_site(requests=None):
+    def handler(request):
+        if requests is not None:
+            requests.append(str(request.url))
+        html = SITE.get(str(request.url))
+        if html is None:
+            return httpx.Response(404)
+        return httpx.Response(200, text=html, headers={"etag": f'"{len(html)}"', "server": "nginx"})
+
+    return httpx.MockTransport(handler)
+
+
+@pytest.mark.asyncio
+async def test_recorded_site_replays_from_disk(tmp_path):
+    archive = FixtureArchive(tmp_path)
+    async with httpx.AsyncClient(transport=RecordingTransport(archive, live_site())) as client:
+        assert await record_site(client, archive) == 2
+    archive.save()
+
+    replay = ReplayTransport(FixtureArchive(tmp_path))
+    async with httpx.AsyncClient(transport=replay) as client:
+        for url, html in SITE.items():
+            r = await client.get(url)
+            assert r.status_code == 200 and r.text == html
+        assert set(r.headers) >= {"etag"} and "server" not in r.headers
+        # revalidation with the recorded etag
+        r = await client.get(BASE, headers={"If-None-Match": f'"{len(SITE[BASE])}"'})
+        assert r.status_code == 304
+        assert (await client.get(BASE + "missing.html")).status_code == 404
+    assert replay.requests == len(SITE) + 2
+
+
+@pytest.mark.asyncio
+async def test_rerecording_skips_books_already_in_the_archive(tmp_path):
+    archive = FixtureArchive(tmp_path)
+    async with httpx.AsyncClient(transport=RecordingTransport(archive, live_site())) as client:
+        await record_site(client, archive, max_pages=1)
+    assert len(archive) == 3
+
+    requests = []
+    async with httpx.AsyncClient(transport=RecordingTransport(archive, live_site(requests))) as client:
+        await record_site(client, archive)
+    assert requests == [BASE, BASE + "page-2.html", f"{BASE}catalogue/book-2_2/index.html"]
+    assert len(archive) == len(SITE)
+
+
+@pytest.mark.asyncio
+async def test_replay_injects_errors(tmp_path):
+    archive = FixtureArchive(tmp_path)
+    await archive.put(BASE, 200, {}, SITE[BASE])
+
+    async with httpx.AsyncClient(transport=ReplayTransport(archive, error_rate=1.0, errors=[503])) as client:
+        assert (await client.get(BASE)).status_code == 503
+    async with httpx.AsyncClient(transport=ReplayTransport(archive, error_rate=1.0, errors=["timeout"])) as client:
+        with pytest.raises(httpx.ReadTimeout):
+            await client.get(BASE)
+
+    flaky = ReplayTransport(archive, error_rate=0.5, seed=7)
+    async with httpx.AsyncClient(transport=flaky) as client:
+        statuses = [(await client.get(BASE)).status_code for _ in range(200)]
+    assert statuses.count(503) == flaky.injected
+    assert 60 < flaky.injected < 140
@@ -1,3 +1,5 @@
+import json
+
 import pytest
 from scheduler import reporter
 from datetime import datetime, timezone
@@ -81,3 +83,64 @@ async def test_generate_daily_change_report_empty_csv(monkeypatch):
     monkeypatch.setattr(reporter, "db", FakeDB([]))
     csv_text = await reporter.generate_daily_change_report(format="csv")
     assert csv_text == ""
+
+
+class FakeStreamCursor:
+    def __init__(self, changes):
+        self._changes = changes
+        self.batch = None
+
+    def sort(self, *args, **kwargs):
+        return self
+
+    def batch_size(self, n):
+        self.batch = n
+        return self
+
+    async def __aiter__(self):
+        for change in self._changes:
+            yield change
+
+
+class FakeStreamChanges:
+    def __init__(self, changes):
+        self._changes = changes
+        self.projection = None
+
+    def find(self, query, projection=None):
+        self.projection = projection
+        return FakeStreamCursor(self._changes)
+
+
+@pytest.mark.asyncio
+async def test_stream_daily_change_report_csv_uses_fixed_columns(monkeypatch):
+    changed_at = datetime(2025, 11, 10, 12, 0, tzinfo=timezone.utc)
+    changes = [{"source_url": f"http://example.com/book{i}", "changed_at": changed_at,
+                "changes": ["price_including_tax", "availability"],
+                "old": {"price_including_tax": 10.0}, "new": {"price_including_tax": 9.0 + i}}
+               for i in range(5)]
+    fake = FakeStreamChanges(changes)
+    monkeypatch.setattr(reporter, "db", type("D", (), {"changes": fake})())
+
+    chunks = [c async for c in reporter.stream_daily_change_report("csv", batch_size=2)]
+    assert len(chunks) == 3  # one chunk per batch of rows
+    lines = b"".join(chunks).decode().splitlines()
+    assert lines[0].split(",") == reporter.REPORT_COLUMNS
+    assert len(lines) == 6
+    row = dict(zip(reporter.REPORT_COLUMNS, lines[1].split(",")))
+    assert row["changed_at"] == "2025-11-10T12:00:00+00:00"
+    assert row["changes"] == "price_including_tax;availability"
+    assert row["old.price_including_tax"] == "10.0" and row["new.price_including_tax"] == "9.0"
+    # only the declared columns are requested from Mongo
+    assert not any("snapshot" in key or key in ("old", "new") for key in fake.projection)
+
+
+@pytest.mark.asyncio
+async def test_stream_daily_change_report_ndjson(monkeypatch):
+    changes = [{"source_url": "http://example.com/book1", "changed_at": datetime(2025, 11, 10, tzinfo=timezone.utc),
+                "new": {"title": "New"}}]
+    monkeypatch.setattr(reporter, "db", type("D", (), {"changes": FakeStreamChanges(changes)})())
+
+    body = b"".join([c async for c in reporter.stream_daily_change_report("ndjson")]).decode()
+    assert json.loads(body.splitlines()[0]) == {"source_url": "http://example.com/book1",
+                                                "changed_at": "2025-11-10T00:00:00+00:00", "new": {"title": "New"}}
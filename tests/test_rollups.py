@@ -0,0 +1,116 @@
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+from fastapi.testclient import TestClient
+
+from api import main as api_main
+from api.main import API_KEY, app
+from scheduler import rollups
+from scheduler.rollups import day_key, merge_rollups, rollup_from_facets
+
+client = TestClient(app)
+
+
+def make_rollup(day, total, moves=(), flips=None, category="Poetry"):
+    return {"_id": day_key(day), "total": total,
+            "by_field": [{"value": "price_including_tax", "count": total}],
+            "by_category": [{"value": category, "count": total}],
+            "top_price_moves": list(moves),
+            "availability_flips": flips or {"back_in_stock": 0, "out_of_stock": 0, "other": 0}}
+
+
+def test_rollup_from_facets_shapes_counts_moves_and_flips():
+    facets = {
+        "total": [{"n": 4}],
+        "by_field": [{"_id": "price_including_tax", "count": 3}, {"_id": "availability", "count": 2}],
+        "by_category": [{"_id": "Poetry", "count": 4}],
+        "price_moves": [{"source_url": "u1", "title": "B1", "old_price": 20.0, "new_price": 15.0, "delta": -5.0}],
+        "availability": [{"_id": {"was": False, "now": True}, "count": 1},
+                         {"_id": {"was": True, "now": False}, "count": 1}],
+    }
+    rollup = rollup_from_facets(date(2025, 11, 10), facets)
+    assert rollup["_id"] == "2025-11-10" and rollup["total"] == 4
+    assert rollup["by_field"][0] == {"value": "price_including_tax", "count": 3}
+    assert rollup["top_price_moves"][0]["pct"] == -25.0
+    assert rollup["availability_flips"] == {"back_in_stock": 1, "out_of_stock": 1, "other": 0}
+    empty = rollup_from_facets(date(2025, 11, 11), {"total": [], "by_field": [], "by_category": [],
+                                                     "price_moves": [], "availability": []})
+    assert empty["total"] == 0
+
+
+def test_merge_rollups_sums_days_and_keeps_largest_moves():
+    d1, d2 = date(2025, 11, 10), date(2025, 11, 11)
+    merged = merge_rollups([
+        make_rollup(d1, 2, moves=[{"source_url": "a", "delta": 1.0}],
+                    flips={"back_in_stock": 1, "out_of_stock": 0, "other": 0}),
+        make_rollup(d2, 3, moves=[{"source_url": "b", "delta": -4.0}], category="Travel"),
+    ])
+    assert merged["total"] == 5
+    assert merged["by_category"] == [{"value": "Travel", "count": 3}, {"value": "Poetry", "count": 2}]
+    assert [m["source_url"] for m in merged["top_price_moves"]] == ["b", "a"]
+    assert merged["availability_flips"]["back_in_stock"] == 1
+    assert merged["days"] == [{"day": "2025-11-10", "total": 2}, {"day": "2025-11-11", "total": 3}]
+
+
+class FakeRollupsCursor:
+    def __init__(self, docs):
+        self._docs = docs
+
+    async def __aiter__(self):
+        for doc in self._docs:
+            yield doc
+
+
+class FakeRollups:
+    def __init__(self, docs):
+        self.docs = {d["_id"]: d for d in docs}
+        self.reads = 0
+
+    def find(self, query):
+        self.reads += 1
+        low, high = query["_id"]["$gte"], query["_id"]["$lte"]
+        return FakeRollupsCursor([d for k, d in sorted(self.docs.items()) if low <= k <= high])
+
+    async def replace_one(self, query, doc, upsert=False):
+        self.docs[query["_id"]] = doc
+
+
+@pytest.mark.asyncio
+async def test_change_report_reads_closed_days_and_aggregates_only_today(monkeypatch):
+    today = datetime.now(timezone.utc).date()
+    first = today - timedelta(days=3)
+    # rollups exist for every closed day but one, and a stale one for today
+    stored = [make_rollup(first, 1), make_rollup(first + timedelta(days=2), 1), make_rollup(today, 99)]
+    fake = FakeRollups(stored)
+    monkeypatch.setattr(rollups, "db", type("D", (), {"change_rollups": fake})())
+    computed = []
+
+    async def compute_rollup(day):
+        computed.append(day)
+        return make_rollup(day, 5)
+
+    monkeypatch.setattr(rollups, "compute_rollup", compute_rollup)
+
+    report = await rollups.change_report(first, today + timedelta(days=2))
+    assert fake.reads == 1
+    # the missing closed day is backfilled and stored, today is always aggregated live
+    assert computed == [first + timedelta(days=1), today]
+    assert day_key(first + timedelta(days=1)) in fake.docs
+    assert [d["total"] for d in report["days"]] == [1, 5, 1, 5]
+    assert report["total"] == 12
+
+
+def test_change_report_endpoint_validates_range(monkeypatch):
+    seen = {}
+
+    async def fake_report(first, last):
+        seen["range"] = (first, last)
+        return {"total": 0}
+
+    monkeypatch.setattr(api_main, "change_report", fake_report)
+    headers = {"X-API-Key": API_KEY}
+    r = client.get("/report/changes?from=2025-08-01&to=2025-10-29", headers=headers)
+    assert r.status_code == 200
+    assert seen["range"] == (date(2025, 8, 1), date(2025, 10, 29))
+    assert client.get("/report/changes?from=2025-10-02&to=2025-10-01", headers=headers).status_code == 400
+    assert client.get("/report/changes?from=2020-01-01&to=2025-10-01", headers=headers).status_code == 400
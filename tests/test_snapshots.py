@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+from db.snapshots import DirectorySnapshotBackend, MongoSnapshotBackend, SnapshotStore, snapshot_key
+
+HTML = "<html><body>" + "<p>A Light in the Attic</p>" * 200 + "</body></html>"
+
+
+class FakeSnapshots:
+    def __init__(self):
+        self.docs = {}
+        self.writes = 0
+
+    async def update_one(self, query, update, upsert=False):
+        self.writes += 1
+        self.docs.setdefault(query["_id"], update["$setOnInsert"])
+
+    async def find_one(self, query):
+        return self.docs.get(query["_id"])
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("codec", ["zlib", "none"])
+async def test_directory_backend_round_trip(tmp_path, codec):
+    store = SnapshotStore(DirectorySnapshotBackend(tmp_path), compression=codec)
+    ref = await store.put(HTML)
+    assert ref == snapshot_key(HTML)
+    assert await store.get(ref) == HTML
+    stored = list(tmp_path.rglob(f"{ref}.*"))
+    assert len(stored) == 1
+    if codec == "zlib":
+        assert stored[0].stat().st_size < len(HTML) / 10
+
+
+@pytest.mark.asyncio
+async def test_mongo_backend_deduplicates():
+    coll = FakeSnapshots()
+    store = SnapshotStore(MongoSnapshotBackend(coll))
+    refs = {await store.put(HTML) for _ in range(3)}
+    assert len(refs) == 1
+    assert coll.writes == 1 and store.duplicates == 2
+    # a second process writing the same content is a no-op upsert
+    other = SnapshotStore(MongoSnapshotBackend(coll))
+    await other.put(HTML)
+    assert len(coll.docs) == 1
+    assert await other.get(refs.pop()) == HTML
+
+
+@pytest.mark.asyncio
+async def test_missing_snapshot_returns_none(tmp_path):
+    store = SnapshotStore(DirectorySnapshotBackend(tmp_path))
+    assert await store.get("0" * 40) is None
+
+
+def test_unknown_codec_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        SnapshotStore(DirectorySnapshotBackend(tmp_path), compression="lz4")
+
+
+@pytest.mark.asyncio
+async def test_concurrent_puts_of_one_page_leave_one_whole_file(tmp_path):
+    stores = [SnapshotStore(DirectorySnapshotBackend(tmp_path)) for _ in range(8)]
+    refs = await asyncio.gather(*(store.put(HTML) for store in stores))
+    assert len(set(refs)) == 1
+    assert [path.suffix for path in tmp_path.rglob("*.*")] == [".zlib"]
+    assert await stores[0].get(refs[0]) == HTML
+
+
+@pytest.mark.asyncio
+async def test_known_keys_are_capped():
+    coll = FakeSnapshots()
+    store = SnapshotStore(MongoSnapshotBackend(coll), known_keys=2)
+    for page in ("a", "b", "a", "c"):
+        await store.put(page)
+    # "b" was the least recently used; the repeated "a" stayed known
+    assert list(store._known) == [snapshot_key("a"), snapshot_key("c")]
+    await store.put("b")
+    assert coll.writes == 4 and store.duplicates == 1
@@ -0,0 +1,204 @@
+import asyncio
+import time
+from collections import Counter
+
+import httpx
+import pytest
+
+from crawler import crawler, throttle
+
+URL = "https://books.toscrape.com/catalogue/book_1/index.html"
+
+
+class MockSite:
+    """A mock server: scripted responses per URL, with injected latency"""
+
+    def __init__(self, script=None, latency=0.0, default=200):
+        self.script = {url: list(steps) for url, steps in (script or {}).items()}
+        self.latency = latency
+        self.default = default
+        self.requests = Counter()
+        self.in_flight = 0
+        self.peak = 0
+
+    async def handler(self, request):
+        url = str(request.url)
+        self.requests[url] += 1
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            steps = self.script.get(url)
+            step = steps.pop(0) if steps else self.default
+            if isinstance(step, Exception):
+                raise step
+            status, headers = step if isinstance(step, tuple) else (step, {})
+            return httpx.Response(status, text="<html></html>", headers=headers)
+        finally:
+            self.in_flight -= 1
+
+    def client(self):
+        return httpx.AsyncClient(transport=httpx.MockTransport(self.handler))
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(throttle, "CRAWL_RETRY_BACKOFF", 0.001)
+
+
+def test_parse_retry_after():
+    assert throttle.parse_retry_after("3") == 3.0
+    assert throttle.parse_retry_after(None) is None
+    assert throttle.parse_retry_after("soon") is None
+    assert throttle.parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0  # in the past
+    assert throttle.parse_retry_after("86400") == throttle.CRAWL_RETRY_MAX_DELAY
+
+
+def test_aimd_grows_on_healthy_latency_and_halves_on_overload():
+    limiter = throttle.AdaptiveLimiter(initial=4, minimum=1, maximum=6, latency_target=0.5)
+    for _ in range(4):
+        limiter.on_success(0.1)
+    assert limiter.limit == pytest.approx(4.92, abs=0.01)  # roughly one slot per window of 4
+    limiter.on_success(2.0)  # slow: hold
+    assert limiter.limit == pytest.approx(4.92, abs=0.01)
+    limiter.on_overload()
+    assert limiter.limit == pytest.approx(2.46, abs=0.01)
+    limiter.on_overload()  # same burst: no second decrease
+    assert limiter.limit == pytest.approx(2.46, abs=0.01)
+    for _ in range(100):
+        limiter.on_success(0.1)
+    assert limiter.limit == 6
+
+
+@pytest.mark.asyncio
+async def test_limiter_caps_in_flight_requests():
+    site = MockSite(latency=0.02)
+    throttle._limiters = throttle.HostLimiters(initial=2, maximum=2)
+    async with site.client() as client:
+        await asyncio.gather(*(crawler.request(client, f"{URL}?{i}") for i in range(8)))
+    assert site.peak == 2
+
+
+@pytest.mark.asyncio
+async def test_retries_5xx_and_timeouts_then_succeeds():
+    site = MockSite({URL: [503, httpx.ReadTimeout("slow"), 200]})
+    stats = Counter()
+    async with site.client() as client:
+        response = await crawler.request(client, URL, stats=stats)
+    assert response.status_code == 200
+    assert site.requests[URL] == 3
+    assert stats == Counter({503: 1, 200: 1, "retries": 2})
+    assert throttle.get_host_limiters().for_url(URL).stats["overload"] == 2
+
+
+@pytest.mark.asyncio
+async def test_per_url_retry_cap_bounds_requests():
+    site = MockSite(default=500)
+    async with site.client() as client:
+        with pytest.raises(httpx.HTTPStatusError):
+            await crawler.fetch_conditional(client, URL)
+    # one attempt plus CRAWL_RETRIES, not 5 tenacity tries times 3 outer loops
+    assert site.requests[URL] == 1 + throttle.CRAWL_RETRIES
+
+
+@pytest.mark.asyncio
+async def test_global_budget_stops_retry_storms():
+    throttle._budget = throttle.RetryBudget(per_url=3, ratio=0.0, reserve=2)
+    site = MockSite(default=503)
+    async with site.client() as client:
+        results = await asyncio.gather(*(crawler.request(client, f"{URL}?{i}") for i in range(5)),
+                                       return_exceptions=True)
+    assert all(isinstance(r, httpx.HTTPStatusError) for r in results)
+    assert sum(site.requests.values()) == 5 + 2  # the two reserve retries, then no more
+    assert throttle.get_retry_budget().stats["budget_exhausted"] == 5
+
+
+@pytest.mark.asyncio
+async def test_client_errors_are_not_retried():
+    site = MockSite({URL: [404]})
+    async with site.client() as client:
+        with pytest.raises(httpx.HTTPStatusError):
+            await crawler.request(client, URL)
+    assert site.requests[URL] == 1
+
+
+@pytest.mark.asyncio
+async def test_not_modified_is_a_success():
+    site = MockSite({URL: [304]})
+    async with site.client() as client:
+        html, validators = await crawler.fetch_conditional(client, URL, {"etag": '"v1"'})
+    assert html is None and validators == {"etag": '"v1"'}
+
+
+@pytest.mark.asyncio
+async def test_retry_after_pauses_the_host_and_backoff_frees_the_slot():
+    # one slot: while the first URL waits out its Retry-After, the host is paused for everyone,
+    # but the waiting request does not hold the slot
+    throttle._limiters = throttle.HostLimiters(initial=1, maximum=1)
+    other = URL + "?other"
+    site = MockSite({URL: [(429, {"Retry-After": "0.2"}), 200]})
+    finished = {}
+
+    async def get(url):
+        await crawler.request(client, url)
+        finished[url] = time.monotonic()
+
+    async with site.client() as client:
+        started = time.monotonic()
+        first = asyncio.create_task(get(URL))
+        await asyncio.sleep(0.05)
+        limiter = throttle.get_host_limiters().for_url(URL)
+        assert limiter.in_flight == 0 and limiter.paused_until > time.monotonic()
+        await asyncio.gather(first, get(other))
+    assert finished[URL] - started >= 0.2
+    assert finished[other] - started >= 0.2  # held back by the host-wide pause
+
+
+@pytest.mark.asyncio
+async def test_backoff_sleeps_outside_the_slot(monkeypatch):
+    monkeypatch.setattr(throttle, "backoff_delay", lambda retry: 0.2)
+    monkeypatch.setattr(crawler, "backoff_delay", lambda retry: 0.2)
+    throttle._limiters = throttle.HostLimiters(initial=1, maximum=1, latency_target=10)
+    other = URL + "?other"
+    site = MockSite({URL: [503, 200]})
+    finished = {}
+
+    async def get(url):
+        await crawler.request(client, url)
+        finished[url] = time.monotonic()
+
+    async with site.client() as client:
+        await asyncio.gather(get(URL), get(other))
+    # the limit was halved to its floor of 1, yet the second URL went ahead during the first one's backoff
+    assert finished[other] < finished[URL]
+
+
+class CapacitySite(MockSite):
+    """Serves three requests at a time and answers 503 to the rest"""
+
+    async def handler(self, request):
+        if self.in_flight >= 3:
+            self.requests["rejected"] += 1
+            return httpx.Response(503)
+        return await super().handler(request)
+
+
+async def crawl_capacity_site(**limiter_kwargs):
+    throttle._limiters = throttle.HostLimiters(latency_target=0.05, **limiter_kwargs)
+    throttle._budget = throttle.RetryBudget(per_url=5, ratio=1.0, reserve=50)
+    site = CapacitySite(latency=0.005)
+    async with site.client() as client:
+        results = await asyncio.gather(*(crawler.request(client, f"{URL}?{i}") for i in range(200)),
+                                       return_exceptions=True)
+    return site, sum(isinstance(r, Exception) for r in results)
+
+
+@pytest.mark.asyncio
+async def test_limit_converges_below_an_overloaded_servers_capacity(monkeypatch):
+    monkeypatch.setattr(throttle, "CRAWL_RETRY_BACKOFF", 0.02)
+    fixed_site, fixed_failures = await crawl_capacity_site(initial=12, minimum=12, maximum=12)
+    site, failures = await crawl_capacity_site(initial=12, maximum=16)
+    assert throttle.get_host_limiters().for_url(URL).limit < 6
+    assert failures == 0 < fixed_failures
+    assert site.requests["rejected"] < fixed_site.requests["rejected"] / 2
@@ -1,57 +1,236 @@
+"""The books_crawler logger.
+
+Records are handed to a QueueListener thread that does the formatting and the
+console/file writes, so code on the event loop never waits on disk or on log
+rotation. Each line is a JSON object (LOG_FORMAT=json) carrying the process's
+run ID and whatever `log_context()` has bound, such as the crawl or worker ID;
+LOG_FORMAT=text keeps the old plain format. High-volume events are logged with
+`extra={"summarize": key}`: the first LOG_SUMMARY_BURST of a key in each
+LOG_SUMMARY_INTERVAL seconds are written, the rest become one summary line.
+"""
+import atexit
+import contextvars
+import copy
+import json
 import logging
 import os
-from logging.handlers import RotatingFileHandler
-from functools import wraps
+import queue
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Dict, List, Optional
 from dotenv import load_dotenv
 
 load_dotenv()
 
-# Email configuration
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.getenv("LOG_FILE", "books_crawler.log")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_QUEUE = os.getenv("LOG_QUEUE", "true").lower() in ("1", "true", "yes")
+LOG_SUMMARY_INTERVAL = float(os.getenv("LOG_SUMMARY_INTERVAL", "10"))
+LOG_SUMMARY_BURST = int(os.getenv("LOG_SUMMARY_BURST", "20"))
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+def new_id() -> str:
+    return uuid.uuid4().hex[:12]
+
+# one per process; spawned crawl workers and parse workers get their own
+RUN_ID = new_id()
+
+_context: contextvars.ContextVar = contextvars.ContextVar("log_context", default={})
+
+class log_context:
+    """Tag every record logged inside the block, and in tasks started from it, with `fields`.
+
+    Works with `with` and `async with`, so it can join a coroutine's other context managers.
+    """
+
+    def __init__(self, **fields):
+        self.fields = fields
+
+    def __enter__(self):
+        self._token = _context.set({**_context.get(), **self.fields})
+        return self
+
+    def __exit__(self, *exc):
+        _context.reset(self._token)
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, *exc):
+        self.__exit__(*exc)
+
+class ContextFilter(logging.Filter):
+    """Attach the run ID and bound context; runs in the calling thread, which is where the context is"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, "context"):
+            record.context = {"run_id": RUN_ID, **_context.get()}
+        return True
+
+# attributes every LogRecord has; anything else was passed as `extra`
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "context", "taskName"}
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: time, level, logger, message, context and `extra` fields"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "context", {}))
+        entry.update((k, v) for k, v in vars(record).items() if k not in _RECORD_ATTRS)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class EventSummarizer:
+    """Let `burst` records of each summarized key through per `interval`; count the rest"""
 
+    def __init__(self, interval: float = LOG_SUMMARY_INTERVAL, burst: int = LOG_SUMMARY_BURST):
+        self.interval = interval
+        self.burst = burst
+        self._windows: Dict[str, list] = {}  # key -> [window start, records seen, first record]
+
+    def admit(self, record: logging.LogRecord) -> List[logging.LogRecord]:
+        """The records to write for `record`: summaries of windows it closes, then itself unless suppressed"""
+        out = self.due(record.created)
+        key = getattr(record, "summarize", None)
+        if key is None:
+            return out + [record]
+        window = self._windows.setdefault(key, [record.created, 0, record])
+        window[1] += 1
+        if window[1] <= self.burst:
+            out.append(record)
+        return out
+
+    def due(self, now: Optional[float] = None, flush: bool = False) -> List[logging.LogRecord]:
+        """Close the windows older than `interval` (all of them with `flush`), summarizing what they suppressed"""
+        now = time.time() if now is None else now
+        out = []
+        for key, (started, seen, first) in list(self._windows.items()):
+            if flush or now - started >= self.interval:
+                del self._windows[key]
+                if seen > self.burst:
+                    out.append(self._summary(key, first, seen, now - started))
+        return out
+
+    def _summary(self, key: str, first: logging.LogRecord, seen: int, elapsed: float) -> logging.LogRecord:
+        return logging.makeLogRecord({
+            "name": first.name, "levelno": first.levelno, "levelname": first.levelname,
+            "msg": "%s: %d more suppressed (%d in %.0fs)", "args": (key, seen - self.burst, seen, elapsed),
+            "context": getattr(first, "context", {}), "summarize": key, "suppressed": seen - self.burst,
+        })
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # only the message is fixed here: its args may change after the call; the rest is the listener's work
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+class SummarizingListener(QueueListener):
+    """A QueueListener that passes records through an EventSummarizer, flushing it while idle and on stop"""
+
+    def __init__(self, log_queue, *handlers, summarizer: Optional[EventSummarizer] = None):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.summarizer = summarizer or EventSummarizer()
+
+    def dequeue(self, block: bool):
+        while True:
+            try:
+                return self.queue.get(timeout=min(self.summarizer.interval, 1.0))
+            except queue.Empty:
+                for summary in self.summarizer.due():
+                    super().handle(summary)
+
+    def handle(self, record: logging.LogRecord):
+        for admitted in self.summarizer.admit(record):
+            super().handle(admitted)
+
+    def stop(self):
+        super().stop()
+        for summary in self.summarizer.due(flush=True):
+            super().handle(summary)
+
+class _StderrHandler(logging.StreamHandler):
+    # the current sys.stderr: the listener may still be writing after a test runner put the original back
+    stream = property(lambda self: sys.stderr, lambda self, value: None)
 
 class AlertLogger:
     """A logger wrapper that can send email alerts for significant events"""
     def __init__(self, logger):
         self._logger = logger
-        
+
     def __getattr__(self, name):
         # Forward all standard logging methods to the wrapped logger
         return getattr(self._logger, name)
-    
-    def alert(self, subject, message, level="info"):
+
+    def alert(self, subject, message, level="info", extra=None):
         """Log a message and send an email alert"""
         # Log the message using the specified level
-        getattr(self._logger, level)(message)
+        getattr(self._logger, level)(message, extra={"alert": subject, **(extra or {})})
+
+_listener: Optional[SummarizingListener] = None
+
+def setup_logging(level: Optional[str] = None, log_file: Optional[str] = None, fmt: Optional[str] = None,
+                  use_queue: Optional[bool] = None, stream=None):
+    """(Re)configure the books_crawler logger; arguments default to the LOG_* settings"""
+    global _listener
+    log_level = (level or LOG_LEVEL).upper()
+    fmt = fmt or LOG_FORMAT
+    use_queue = LOG_QUEUE if use_queue is None else use_queue
 
-def setup_logging():
-    log_level = os.getenv("LOG_LEVEL", "INFO").upper()
-    
     # Create logger
     logger = logging.getLogger("books_crawler")
     logger.setLevel(log_level)
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
 
-    # Create console handler and set level to debug
-    ch = logging.StreamHandler()
-    ch.setLevel(log_level)
+    # Console handler, and a file handler rotating after 1MB, keeping 5 backup files
+    ch = logging.StreamHandler(stream) if stream is not None else _StderrHandler()
+    fh = RotatingFileHandler(log_file or LOG_FILE, maxBytes=1024*1024, backupCount=5)
+    formatter = JsonFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT)
+    for handler in (ch, fh):
+        handler.setLevel(log_level)
+        handler.setFormatter(formatter)
 
-    # Create file handler for logging to a file
-    # Rotate log file after 1MB, keep 5 backup files
-    log_file = os.getenv("LOG_FILE", "books_crawler.log")
-    fh = RotatingFileHandler(log_file, maxBytes=1024*1024, backupCount=5)
-    fh.setLevel(log_level)
+    if use_queue:
+        # the caller only enqueues; the listener thread formats and writes
+        qh = _QueueHandler(queue.SimpleQueue())
+        qh.addFilter(ContextFilter())
+        _listener = SummarizingListener(qh.queue, ch, fh)
+        _listener.start()
+        logger.addHandler(qh)
+    else:
+        for handler in (ch, fh):
+            handler.addFilter(ContextFilter())
+            logger.addHandler(handler)
 
-    # Create formatter
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-
-    # Add formatter to handlers
-    ch.setFormatter(formatter)
-    fh.setFormatter(formatter)
-
-    # Add handlers to logger
-    logger.addHandler(ch)
-    logger.addHandler(fh)
-    
     # Wrap logger with AlertLogger
     return AlertLogger(logger)
 
+def shutdown_logging():
+    """Write out whatever is still queued, and the pending summaries"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+atexit.register(shutdown_logging)
+
 logger = setup_logging()
@@ -0,0 +1,217 @@
+"""Counters, gauges and latency histograms for the crawler, scheduler and API.
+
+Metrics are declared at module level next to the code they measure and live in
+one process-wide registry, rendered in the Prometheus text format: GET /metrics
+on the API, and optionally a dump at the end of crawler and scheduler runs
+(METRICS_DUMP: empty for none, "-" for stdout, or a file path). An update is a dict lookup and
+an addition on the event loop thread, so they stay on in production; values
+that are cheaper to read than to track (pool and limiter occupancy) are read by
+collect callbacks when the metrics are rendered.
+"""
+import functools
+import os
+import sys
+import time
+from bisect import bisect_left
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+from dotenv import load_dotenv
+from utils.logger import logger
+
+load_dotenv()
+
+METRICS_DUMP = os.getenv("METRICS_DUMP", "")
+
+# seconds; fetches, parses and writes all land somewhere in here
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names: Sequence[str], values: Sequence, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values: Dict[tuple, object] = {}
+
+    def _key(self, labels: dict) -> tuple:
+        if len(labels) != len(self.labels):
+            raise ValueError(f"{self.name} takes labels {self.labels}, got {tuple(labels)}")
+        if len(labels) == 1:
+            return (labels[self.labels[0]],)
+        return tuple([labels[name] for name in self.labels])
+
+    def clear(self):
+        self._values.clear()
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        return [("", _format_labels(self.labels, key), value) for key, value in self._values.items()]
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{self.name}{suffix}{labels} {_format_number(value)}" for suffix, labels, value in self.samples()]
+        return "\n".join(lines)
+
+class Counter(Metric):
+    """A count that only goes up"""
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+class Gauge(Counter):
+    """A value that goes up and down"""
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram: "Histogram", labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+class Histogram(Metric):
+    """Observations counted into fixed buckets, plus their sum and count"""
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self._values.get(key)
+        if series is None:
+            # per-bucket counts (the last one is +Inf), sum, count
+            series = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def time(self, **labels) -> _Timer:
+        """`with histogram.time(...):` observes the block's duration in seconds"""
+        return _Timer(self, labels)
+
+    def count(self, **labels) -> int:
+        series = self._values.get(self._key(labels))
+        return series[2] if series else 0
+
+    def sum(self, **labels) -> float:
+        series = self._values.get(self._key(labels))
+        return series[1] if series else 0.0
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        samples = []
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                samples.append(("_bucket", _format_labels(self.labels, key, f'le="{_format_number(bound)}"'),
+                                cumulative))
+            samples.append(("_sum", _format_labels(self.labels, key), total))
+            samples.append(("_count", _format_labels(self.labels, key), count))
+        return samples
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._collectors: List[Callable[[], None]] = []
+
+    def register(self, metric: Metric) -> Metric:
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            # a module imported twice (e.g. as __main__) shares the series
+            if type(existing) is not type(metric) or existing.labels != metric.labels:
+                raise ValueError(f"Metric {metric.name} is already registered differently")
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def on_collect(self, callback: Callable[[], None]):
+        """Run `callback` before every render, to set gauges from live state"""
+        self._collectors.append(callback)
+
+    def get(self, name: str) -> Optional[Metric]:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        for callback in self._collectors:
+            try:
+                callback()
+            except Exception as e:
+                logger.error("Metrics collector %s failed: %s", getattr(callback, "__name__", callback), e)
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+_registry = MetricsRegistry()
+
+def get_registry() -> MetricsRegistry:
+    return _registry
+
+def counter(name: str, help: str, labels: Iterable[str] = ()) -> Counter:
+    return _registry.register(Counter(name, help, labels))
+
+def gauge(name: str, help: str, labels: Iterable[str] = ()) -> Gauge:
+    return _registry.register(Gauge(name, help, labels))
+
+def histogram(name: str, help: str, labels: Iterable[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+    return _registry.register(Histogram(name, help, labels, buckets))
+
+CONTENT_TYPE = "text/plain; version=0.0.4"  # the response adds the utf-8 charset
+
+def dump_metrics(target: Optional[str] = None):
+    """Write the current metrics to stdout ("-") or a file, replaced atomically for textfile collectors"""
+    target = METRICS_DUMP if target is None else target
+    if not target:
+        return
+    text = get_registry().render()
+    if target == "-":
+        sys.stdout.write(text)
+        sys.stdout.flush()
+        return
+    path = Path(target)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(text)
+    tmp.replace(path)
+    logger.info("Metrics written to %s", path)
+
+def dumps_metrics(fn):
+    """Wrap a coroutine function (a run or a scheduled job) to dump the metrics when it ends"""
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            dump_metrics()
+    return wrapper